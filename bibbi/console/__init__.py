@@ -5,7 +5,7 @@ from pathlib import Path
 from .update_webdewey import update_webdewey_cmd
 from .upload import upload_cmd
 from .extract_catalog import extract_catalog
-from .extract_authorities import extract_authorities
+from .extract_authorities import extract_authorities, parse_profiles
 from .config import Config
 from bibbi.logging import configure_logging
 
@@ -26,6 +26,32 @@ def add_catalog_parser(subparsers):
     parser = subparsers.add_parser('catalog')
     parser.set_defaults(func=extract_catalog)
     parser.add_argument('--no-cache', action='store_true', default=False)
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Stream items, MARC data and authority links from the database instead of '
+                             'loading them into memory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to use for building and serializing documents')
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help='Number of items per chunk when using --workers, --compression or --parts')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None,
+                        help='Compress the output (zstd requires the zstandard package)')
+    parser.add_argument('--parts', action='store_true', default=False,
+                        help='Write each chunk to a numbered part file, with an index in catalog.index.json')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only export items approved since the last run, as a delta file with upserts and '
+                             'deletes (catalog.delta.jsonl). Falls back to a full export if there is no previous run')
+    parser.add_argument('--max-report-rows', type=int, default=None,
+                        help='Max number of rows of each error type in the invalid links report. '
+                             'The remaining rows are written to a CSV file next to it')
+    parser.add_argument('--es-index', default=None,
+                        help='Index the exported documents in this Elasticsearch index (requires ELASTICSEARCH_HOST). '
+                             'With --incremental, only the changes are sent')
+    parser.add_argument('--es-chunk-size', type=int, default=500,
+                        help='Number of documents per bulk request')
+    parser.add_argument('--es-threads', type=int, default=4,
+                        help='Number of bulk requests to send in parallel')
+    parser.add_argument('--es-max-retries', type=int, default=5,
+                        help='Number of times to retry documents rejected with 429 Too Many Requests')
 
 
 def add_authorities_parser(subparsers):
@@ -33,6 +59,13 @@ def add_authorities_parser(subparsers):
     parser.set_defaults(func=extract_authorities)
     parser.add_argument('--use-cache', action='store_true', default=False)
     parser.add_argument('--remove-unused', action='store_true', default=False)
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Log each data problem as it is found, in addition to the diagnostics report')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to use for constructing entities')
+    parser.add_argument('--profiles', type=parse_profiles, default=None,
+                        help='Comma-separated list of export profiles to produce in addition to bibbi.nt, '
+                             'or "all" (default: none)')
 
 
 def app():
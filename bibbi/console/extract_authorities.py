@@ -15,21 +15,61 @@ from bibbi.wikidata_service import WikidataService
 from bibbi.label import LabelFactory
 
 from bibbi.serializers.rdf import RdfEntityAndMappingSerializer, RdfEntitySerializer, RdfReverseMappingSerializer, \
-    ConceptScheme
+    ConceptScheme, ExportProfile, RdfProfileSerializer
 
 from bibbi.constants import TYPE_TITLE_SUBJECT, TYPE_TITLE, TYPE_PERSON, TYPE_PERSON_SUBJECT, TYPE_CORPORATION_SUBJECT, \
-    TYPE_DEMOGRAPHIC_GROUP, TYPE_GEOGRAPHIC, TYPE_GENRE, TYPE_TOPICAL, TYPE_CORPORATION, TYPE_EVENT, TYPE_WORK
+    TYPE_DEMOGRAPHIC_GROUP, TYPE_GEOGRAPHIC, TYPE_GENRE, TYPE_TOPICAL, TYPE_CORPORATION, TYPE_EVENT, TYPE_WORK, \
+    TYPE_FICTIVE_PERSON, TYPE_EVENT_SUBJECT, TYPE_LAW
 from dotenv import load_dotenv
 
 from bibbi.db import Db
+from bibbi.diagnostics import Diagnostics
 from bibbi.entity_service import BibbiEntity, Entity, EntityCollection, Nation
+from bibbi.entity_table import EntityTable
 from bibbi.logging import configure_logging
+from bibbi.parallel import make_entities_parallel
 from bibbi.promus_cache import PromusCache
 from bibbi.promus_service import PromusService, GenreTable, PromusTable, PersonTable, TopicTable, \
     GeographicTable, CorporationTable, NationTable, ConferenceTable, WorkTable
 
 log = logging.getLogger(__name__)
 
+# Files to export, relative to the out dir. Each entity is included in all the profiles it matches.
+# Only 'bibbi' is exported by default, the others are opt-in with --profiles, since each profile is
+# built as a separate graph.
+# Note: upload.py uploads all *.nt files in the out dir, so only bibbi.nt should be placed there.
+EXPORT_PROFILES = [
+    ExportProfile('bibbi', 'bibbi.nt'),
+    ExportProfile('approved', 'profiles/bibbi-approved.nt', approved_only=True),
+    ExportProfile('topical', 'profiles/bibbi-topical.nt', entity_types=[TYPE_TOPICAL]),
+    ExportProfile('geographic', 'profiles/bibbi-geographic.nt', entity_types=[TYPE_GEOGRAPHIC]),
+    ExportProfile('genre', 'profiles/bibbi-genre.nt', entity_types=[TYPE_GENRE]),
+    ExportProfile('demographic_group', 'profiles/bibbi-demographic-group.nt', entity_types=[TYPE_DEMOGRAPHIC_GROUP]),
+    ExportProfile('person', 'profiles/bibbi-person.nt',
+                  entity_types=[TYPE_PERSON, TYPE_PERSON_SUBJECT, TYPE_FICTIVE_PERSON]),
+    ExportProfile('corporation', 'profiles/bibbi-corporation.nt',
+                  entity_types=[TYPE_CORPORATION, TYPE_CORPORATION_SUBJECT, TYPE_LAW]),
+    ExportProfile('event', 'profiles/bibbi-event.nt', entity_types=[TYPE_EVENT, TYPE_EVENT_SUBJECT]),
+    ExportProfile('film', 'profiles/bibbi-film.nt', concept_group='film'),
+    ExportProfile('spill', 'profiles/bibbi-spill.nt', concept_group='spill'),
+    ExportProfile('nasj', 'profiles/bibbi-nasj.nt', concept_group='nasj'),
+]
+
+
+def parse_profiles(value: str) -> List[str]:
+    """
+    Parse the --profiles option: A comma-separated list of profile names, or 'all'.
+    """
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    if names == ['all']:
+        return [profile.name for profile in EXPORT_PROFILES]
+    valid = [profile.name for profile in EXPORT_PROFILES]
+    unknown = [name for name in names if name not in valid]
+    if unknown:
+        raise argparse.ArgumentTypeError('Unknown export profile(s): %s. Valid profiles: %s' % (
+            ', '.join(unknown), ', '.join(valid)))
+    return names
+
 
 def timing(f):
     @wraps(f)
@@ -65,19 +105,23 @@ def update_cache(promus_cache: PromusCache, tables: TableDict) -> TableDict:
 # Transform
 
 @timing
-def transform_to_entities(tables: TableDict, collections):
+def transform_to_entities(tables: TableDict, collections, label_factory: LabelFactory, workers: int = 1):
+    # Note: The same label factory is used in transform_entities, so that labels are only constructed once
+    if workers > 1:
+        counts = {table.type: 0 for table in tables.values()}
+        for table, entities in make_entities_parallel(tables, label_factory, workers):
+            counts[table.type] += collections[table.vocabulary_code].extend(entities)
+        for table_type, n in counts.items():
+            log.info('Constructed %d entities from: %s', n, table_type)
+        return collections
     for table in tables.values():
-        collections[table.vocabulary_code].import_table(table)
-    for collection in collections.values():
-        collection.update_index()
+        table.make_labels(label_factory)
+        collections[table.vocabulary_code].import_table(table, label_factory)
     return collections
 
 
-def warning(msg: str, entity: Entity):
-    log.warning('%s: %s "%s"', msg, entity.id, entity.pref_label.nb)
-
-
-def add_relation_to_main_entity(label_factory: LabelFactory, collection: EntityCollection, entity: BibbiEntity, entity_map: dict):
+def add_relations_to_main_entities(label_factory: LabelFactory, collection: EntityCollection, entity_map: dict,
+                                   diagnostics: Diagnostics) -> int:
     """
     Hvis entiteten er en biautoritet av type <Tittel som emne>, sjekk først om vi finner
     den assosierte entiteten av type <Tittel>.
@@ -90,33 +134,40 @@ def add_relation_to_main_entity(label_factory: LabelFactory, collection: EntityC
     personentitet, via feltet "felles_id".
 
     I alle andre tilfeller, lager vi en relasjon fra biautoriteten til hovedautoriteten.
+
+    Returnerer antall relasjoner som ble lagt til.
     """
+    added = 0
+    remaining = []
+    for entity in collection.of_type(TYPE_PERSON_SUBJECT, TYPE_CORPORATION_SUBJECT, TYPE_TITLE_SUBJECT, TYPE_TITLE):
+        if entity.type in entity_map:
+            broader = collection.index.find(
+                label=label_factory.make(entity.row, include_subdivisions=False).nb,
+                entity_type=entity_map[entity.type],
+            )
+            if len(broader) > 1:
+                diagnostics.add('<Tittel som emne> har mer enn én mulig <Tittel>', entity, ', '.join(broader))
+            elif len(broader) == 1:
+                entity.broader.append(collection.get(broader[0]))
+                added += 1
+                continue
+            # else: diagnostics.add('<Tittel som emne> mangler assosiert <Tittel>', entity)
+        remaining.append(entity)
+
+    # Biautoritet -> hovedautoritet via felles_id
+    for entity in remaining:
+        felles_id = entity.row.get('felles_id')
+        if felles_id is not None and felles_id != entity.row.get('bibsent_id'):
+            broader = collection.get(felles_id)
+            if broader is None:
+                diagnostics.add('Biautoritet mangler hovedautoritet', entity)
+            else:
+                entity.broader.append(broader)
+                added += 1
+    return added
 
-    if entity.type in entity_map:
-        broader = collection.index.find(
-            label=label_factory.make(entity.row, include_subdivisions=False).nb,
-            entity_type=entity_map[entity.type],
-        )
-        if len(broader) > 1:
-            warning('<Tittel som emne> har mer enn én mulig <Tittel>', entity)
-            print(broader)
-        elif len(broader) == 0:
-            # warning('<Tittel som emne> mangler assosiert <Tittel>', entity)
-            pass
-        else:
-            entity.broader.append(collection.get(broader[0]))
-            return True
-
-    if entity.row.has('felles_id') and entity.row.get('felles_id') != entity.row.get('bibsent_id'):
-        broader = collection.get(entity.row.get('felles_id'))
-        if broader is None:
-            warning('Biautoritet mangler hovedautoritet', entity)
-        else:
-            entity.broader.append(broader)
-            return True
-
-
-def transform_person_nationality(entity: BibbiEntity, bibbi_map: dict):
+
+def transform_person_nationality(entity: BibbiEntity, bibbi_map: dict, diagnostics: Diagnostics):
     """
     For entiteter av type `Person`, som har `nationality` angitt:
     Slå opp `nationality`-verdiene for å finne de korresponderende
@@ -132,12 +183,13 @@ def transform_person_nationality(entity: BibbiEntity, bibbi_map: dict):
                 bibbi_entity = bibbi_map[nationality_code]
                 entity.nationality_entities.append(bibbi_entity)
             else:
-                warning('Nasjonalitetskode ble ikke funnet i Bibbi-emner: "%s"' % nationality_code, entity)
+                diagnostics.add('Nasjonalitetskode ble ikke funnet i Bibbi-emner', entity, nationality_code)
 
         return True
 
 
-def transform_demographic_group(entity: BibbiEntity, countries: EntityCollection, bibbi: EntityCollection, wikidata_country_map):
+def transform_demographic_group(entity: BibbiEntity, nation: Optional[Nation], country: Optional[BibbiEntity],
+                                wikidata_country_map, diagnostics: Diagnostics):
     """
     For entiteter av type `DemographicGroup` (fra Bibbi-emner), slå opp
     nasjonalitetskoden mot og legg til landinformasjon fra EnumCountries.
@@ -146,13 +198,14 @@ def transform_demographic_group(entity: BibbiEntity, countries: EntityCollection
     Eksempel: For entiteten 1130466:"Somaliere", legg til ISO 3166-kode "SO",
     MARC21-kode "so", demonym "somalisk", land 1163875:"Somalia", samt
     en invers relasjon 1163875:"Somalia" <demografisk gruppe> 1130466:"Somaliere".
-    """
 
-    nation: Optional[Nation] = countries.get(entity.bs_nasj_id)
+    `nation` og `country` er slått opp på forhånd fra hhv. nasjonalitetstabellen (via bs_nasj_id)
+    og Bibbi (via nation.geographic_concept_id).
+    """
     if nation is not None:
         entity.scopeNote = nation.description
         if nation.geographic_concept_id is not None:
-            entity.country = bibbi.find_first(local_id=nation.geographic_concept_id, entity_type=TYPE_GEOGRAPHIC)
+            entity.country = country
             if entity.country is not None:
                 entity.country.demographicGroup = entity  # Reverse relation
                 entity.country.iso3166_2_code = nation.iso3166_2_code
@@ -161,21 +214,21 @@ def transform_demographic_group(entity: BibbiEntity, countries: EntityCollection
                 if entity.country.iso3166_2_code in wikidata_country_map:
                     entity.country.exact_match.append(wikidata_country_map[entity.country.iso3166_2_code])
                 elif entity.country.iso3166_2_code is not None:
-                    warning('Landskode ikke funnet på Wikidata: "%s"' % entity.country.iso3166_2_code, entity)
+                    diagnostics.add('Landskode ikke funnet på Wikidata', entity, entity.country.iso3166_2_code)
             else:
-                warning('Fant ikke geografisk autoritet med ID "%s"' % nation.geographic_concept_id, entity)
+                diagnostics.add('Fant ikke geografisk autoritet', entity, nation.geographic_concept_id)
         return True
     else:
-        warning('Nasjonalitetskode ble ikke funnet i nasjonalitetstabell: "%s"' % entity.bs_nasj_id, entity)
+        diagnostics.add('Nasjonalitetskode ble ikke funnet i nasjonalitetstabell', entity, entity.bs_nasj_id)
 
 
-def transform_work(entity: BibbiEntity, bibbi: EntityCollection):
+def transform_work(entity: BibbiEntity, creator: Optional[BibbiEntity]):
     """
-    For entiteter av type `Work`, lenk til person.
+    For entiteter av type `Work`, lenk til person (slått opp på forhånd via creator_id).
     """
 
     if entity.creator_id:
-        entity.creator = bibbi.find_first(local_id=entity.creator_id, entity_type=TYPE_PERSON)
+        entity.creator = creator
         return True
     return False
 
@@ -184,7 +237,8 @@ def transform_work(entity: BibbiEntity, bibbi: EntityCollection):
 def transform_entities(label_factory: LabelFactory,
                        collections: Dict[str, EntityCollection],
                        tables: TableDict,
-                       wikidata_country_map):
+                       wikidata_country_map,
+                       diagnostics: Diagnostics):
     """
     Deduserer flere relasjoner mellom entiteter.
     """
@@ -204,28 +258,36 @@ def transform_entities(label_factory: LabelFactory,
         for nationality_code, bibbi_item in nationality_bibbi_map.items()
     }
 
+    # Each relation is added in a separate pass over the entities of the relevant type(s),
+    # with the lookups done in bulk against the index.
     counters = {'bi': 0, 'cn': 0, 'dm': 0, 'wp': 0}
     for collection in collections.values():
-        for entity in collection:
 
-            # Legg til relasjon mellom biautoritet og hovedautoritet
-            if entity.type in [TYPE_PERSON_SUBJECT, TYPE_CORPORATION_SUBJECT, TYPE_TITLE_SUBJECT, TYPE_TITLE]:
-                if add_relation_to_main_entity(label_factory, collection, entity, entity_map):
-                    counters['bi'] += 1
+        # Legg til relasjon mellom biautoritet og hovedautoritet
+        counters['bi'] += add_relations_to_main_entities(label_factory, collection, entity_map, diagnostics)
 
-            if entity.type in [TYPE_PERSON]:
-                if transform_person_nationality(entity, nationality_bibbi_map):
-                    counters['cn'] += 1
+        for entity in collection.of_type(TYPE_PERSON):
+            if transform_person_nationality(entity, nationality_bibbi_map, diagnostics):
+                counters['cn'] += 1
 
-            if entity.type in [TYPE_DEMOGRAPHIC_GROUP]:
-                if transform_demographic_group(entity, countries, bibbi, wikidata_country_map):
-                    counters['dm'] += 1
+        entities = list(collection.of_type(TYPE_DEMOGRAPHIC_GROUP))
+        nations = [countries.get(entity.bs_nasj_id) for entity in entities]
+        geographic_entities = bibbi.find_by_local_ids(
+            [nation.geographic_concept_id if nation is not None else None for nation in nations],
+            TYPE_GEOGRAPHIC
+        )
+        for entity, nation, country in zip(entities, nations, geographic_entities):
+            if transform_demographic_group(entity, nation, country, wikidata_country_map, diagnostics):
+                counters['dm'] += 1
 
-            if entity.type in [TYPE_WORK]:
-                if transform_work(entity, bibbi):
-                    counters['wp'] += 1
+        entities = list(collection.of_type(TYPE_WORK))
+        creators = bibbi.find_by_local_ids([entity.creator_id for entity in entities], TYPE_PERSON)
+        for entity, creator in zip(entities, creators):
+            if transform_work(entity, creator):
+                counters['wp'] += 1
 
     log.info('Relations added: broader: %(bi)s, nationality: %(cn)s, demographic_group: %(dm)s, work-person: %(wp)s', counters)
+    diagnostics.log_summary()
 
 #
 # @timing
@@ -243,7 +305,12 @@ def transform_entities(label_factory: LabelFactory,
 
 
 @timing
-def serialize_as_rdf(collections):
+def serialize_as_rdf(collections, entity_table: EntityTable, profiles: Optional[List[str]] = None):
+    """
+    Serialize the Bibbi collection, using the export profiles with the given names (only 'bibbi' if not
+    specified). The 'bibbi' profile is always included. The statistics and the WebDewey mappings
+    are written from the entity table.
+    """
 
     # RdfEntitySerializer() \
     #     .load('src/bs.ttl', 'turtle') \
@@ -266,7 +333,12 @@ def serialize_as_rdf(collections):
     concept_scheme_uri = URIRef('https://id.bs.no/bibbi')
 
     entities = collections['bibbi']
-    RdfEntityAndMappingSerializer() \
+    entity_table.write_statistics('out/bibbi.stats.json')
+    export_profiles = [
+        profile for profile in EXPORT_PROFILES
+        if profile.name == 'bibbi' or profile.name in (profiles or [])
+    ]
+    RdfProfileSerializer(export_profiles) \
         .load([
             'src/bs.ttl',
             'src/bibbi.scheme.ttl',
@@ -274,20 +346,21 @@ def serialize_as_rdf(collections):
         ]) \
         .set_concept_schemes([
             bibbi_concept_scheme,
-            ConceptScheme(concept_scheme_uri, entities.get_last_modified())
+            ConceptScheme(concept_scheme_uri, last_modified)
         ]) \
         .add_entities(entities) \
-        .serialize('out/bibbi.nt', 'ntriples')
+        .serialize('out', 'ntriples')
 
     RdfReverseMappingSerializer() \
-        .add_entities(collections['bibbi'], ) \
+        .add_table(entity_table) \
         .serialize('out/webdewey-bibbi-mappings.nt', 'ntriples')
 
 
 # ------------------------------------------------------------------------------------------------
 # Config and glue
 
-def run(services: dict, use_cache: bool, remove_unused: bool):
+def run(services: dict, use_cache: bool, remove_unused: bool, workers: int = 1,
+        profiles: Optional[List[str]] = None):
 
     wikidata_country_list = services['wikidata'].get_country_map()
 
@@ -307,25 +380,30 @@ def run(services: dict, use_cache: bool, remove_unused: bool):
     if not use_cache:
         update_cache(services['promus_cache'], tables)
 
-    # 3. Transform to entities
+    # 3. Transform to entities. The entity table is built from the same tables, for the statistics and mappings
+    entity_table = EntityTable.from_tables([
+        table for table in tables.values() if table.vocabulary_code == 'bibbi'
+    ])
     collections = transform_to_entities(tables, {
         'bibbi': EntityCollection('bibbi'),
         'bs-nasj': EntityCollection('bs-nasj'),
-    })
+    }, services['label_factory'], workers)
 
     # 4. Add relations between entities
     transform_entities(
         services['label_factory'],
         collections,
         tables,
-        wikidata_country_list
+        wikidata_country_list,
+        services['diagnostics']
     )
+    services['diagnostics'].write_report('out/diagnostics.txt')
 
     # 5. Serialize
-    serialize_as_rdf(collections)
+    serialize_as_rdf(collections, entity_table, profiles)
 
 
-def get_services(use_cache: bool):
+def get_services(use_cache: bool, verbose: bool = False):
     max_cache_age = timedelta(days=7)
 
     promus_cache = PromusCache('cache')
@@ -356,9 +434,10 @@ def get_services(use_cache: bool):
         'promus_adapter': promus_adapter,
         'label_factory': LabelFactory(),
         'wikidata': WikidataService(),
+        'diagnostics': Diagnostics(verbose=verbose),
     }
 
 
 def extract_authorities(config, options):
-    services = get_services(options.use_cache)
-    run(services, options.use_cache, options.remove_unused)
+    services = get_services(options.use_cache, options.verbose)
+    run(services, options.use_cache, options.remove_unused, options.workers, options.profiles)
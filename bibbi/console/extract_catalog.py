@@ -1,6 +1,9 @@
 # encoding=utf-8
 import argparse
+import csv
+import gzip
 import logging
+import multiprocessing
 import os
 import re
 import unicodedata
@@ -9,23 +12,238 @@ from functools import wraps
 import hashlib
 from pathlib import Path
 from time import time
-from typing import Generator
+from datetime import datetime
+from typing import Deque, Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple
 from itertools import groupby
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
 from tqdm import tqdm
 
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 import orjson
-from elasticsearch import Elasticsearch, helpers
+import feather
+import pyarrow as pa
+from elasticsearch import Elasticsearch
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from bibbi.console.config import Config
-from bibbi.db import Db, ColumnDataTypes
+from bibbi.db import Db, ColumnDataTypes, Schema
 from bibbi.promus_service import PromusService
+from bibbi.search_index import BulkIndexer
 
 log = logging.getLogger(__name__)
 
+# Queries shared by the batch and the streaming mode. The streaming mode adds ORDER BY Item_ID to each
+# query, so the result sets can be merge-joined on the item ID.
+AUTHORITY_LINKS_QUERY = '''
+    SELECT
+        ItemField_ID as field_id,
+        LTRIM(STR(Item_ID)) AS item_id,
+        LTRIM(STR(Authority_ID)) AS local_id,
+        FieldCode as field
+    FROM ItemField
+    WHERE
+        Authority_ID IS NOT NULL AND Authority_ID != '0'
+        AND (
+            FieldCode LIKE '1%'
+            OR FieldCode LIKE '6%'
+            OR FieldCode LIKE '7%'
+            OR FieldCode LIKE '8%'
+        )
+'''
+
+MARC_DATA_QUERY = '''
+    SELECT
+        LTRIM(STR(ItemField.Item_ID)) AS item_id,
+        ItemField.FieldCode AS field,
+        ItemSubField.SubFieldCode AS subfield,
+        ItemSubField.Text AS value
+    FROM ItemField
+    INNER JOIN ItemSubField ON ItemSubField.ItemField_ID = ItemField.ItemField_ID
+    WHERE ItemField.FieldCode IN ('019', '020', '024', '082', '245', '260')
+'''
+
+ITEMS_QUERY = '''
+    SELECT
+        LTRIM(STR(Item_ID)) AS item_id,
+        ApproveDateFirst AS cataloguing_date,
+        ApproveDate AS approve_date,
+        TRY_CAST(ItemYear AS INT) as pub_year,
+        Title AS title_ax,
+        --, dbo.fn_ItemSubFieldText(Item_ID, '245', 'a') as f245a,
+        --, dbo.fn_ItemSubFieldText(Item_ID, '245', 'b') as f245b,
+        --, dbo.fn_ItemSubFieldText(Item_ID, '260', 'c') as f260c,
+        Varenr AS varenr,
+        LTRIM(STR(BibbiNr)) AS bibbi_id
+    FROM Item
+    WHERE ApproveDateFirst IS NOT NULL
+    AND ApproveDate IS NOT NULL
+    -- AND ApproveDate >= '2019'
+'''
+
+# The MARC subfields used in the catalog documents
+MARC_KEYS = ['019$b', '019$d', '020$a', '025$a', '082$a', '245$a', '245$b', '260$a', '260$b']
+
+# Column types for the queries, see Db.select_typed
+AUTHORITY_LINKS_SCHEMA = {
+    'field_id': 'int',
+    'item_id': 'str',
+    'local_id': 'str',
+    'field': 'category',
+}
+
+MARC_DATA_SCHEMA = {
+    'item_id': 'str',
+    'field': 'category',
+    'subfield': 'category',
+    'value': 'str',
+}
+
+ITEMS_SCHEMA = {
+    'item_id': 'str',
+    'cataloguing_date': 'date',
+    'approve_date': 'date',
+    'pub_year': 'int',
+    'title_ax': 'str',
+    'varenr': 'str',
+    'bibbi_id': 'str',
+}
+
+# NotInUse and Approved are bits, returned as 'True' / 'False'
+AUTHORITY_SCHEMA = {
+    'local_id': 'str',
+    'bibsent_id': 'str',
+    'not_in_use': 'category',
+    'approved': 'category',
+    'title': 'str',
+    'label': 'str',
+}
+
+ITEM_STATE_SCHEMA = {
+    'item_id': 'str',
+    'bibbi_id': 'str',
+    'approve_date': 'date',
+}
+
+ITEM_STATE_QUERY = '''
+    SELECT
+        LTRIM(STR(Item_ID)) AS item_id,
+        LTRIM(STR(BibbiNr)) AS bibbi_id,
+        ApproveDate AS approve_date
+    FROM Item
+    WHERE ApproveDateFirst IS NOT NULL
+    AND ApproveDate IS NOT NULL
+'''
+
+# Report of links to authorities that are not in use, not approved or missing a Bibbi ID
+REPORT_FILE = 'ugyldige_autoritetskoblinger.xlsx'
+DELTA_REPORT_FILE = 'ugyldige_autoritetskoblinger.delta.xlsx'
+
+FORM_MAP = {
+    "A": "Antologi",
+    "B": "Billedbok",
+    "D": "Dikt",
+    "L": "Lærebok",
+    "N": "Novelle",
+    "P": "Pekebok",
+    "R": "Roman",
+    "S": "Skuespill",
+    "T": "Tegneserie",
+}
+
+
+def pivot_marc_data(marc_data: pd.DataFrame, keys: List[str], policy: str = 'last',
+                    item_ids=None) -> pd.DataFrame:
+    """
+    Pivot MARC data in long form (item_id, field, subfield, value) into a wide frame with one row per
+    item and one column per 'field$subfield' key in keys.
+
+    :param policy: How to handle repeated subfields: Keep the 'first' or the 'last' value
+        (in the order of marc_data), or 'all' values as a list.
+    :param item_ids: If given, the rows are returned in this order (with None for items without MARC data),
+        and the index is reset.
+    """
+    if policy not in ('first', 'last', 'all'):
+        raise ValueError('Invalid policy: %s' % policy)
+
+    df = pd.DataFrame({
+        'item_id': marc_data.item_id.values,
+        'key': (marc_data.field.astype(object) + '$' + marc_data.subfield.astype(object)).values,
+        'value': marc_data.value.values,
+    })
+    df = df[df.key.isin(keys)]
+    if policy == 'all':
+        values = df.groupby(['item_id', 'key'], sort=False).value.agg(list)
+    else:
+        values = df.drop_duplicates(['item_id', 'key'], keep=policy).set_index(['item_id', 'key']).value
+
+    wide = values.unstack('key').reindex(columns=keys)
+    log.info('✔ MARC pivot done (%d items)', len(wide))
+    if item_ids is not None:
+        wide = wide.reindex(item_ids).reset_index(drop=True)
+    return wide.astype(object).where(wide.notnull(), None)
+
+
+class CatalogData(NamedTuple):
+    # Everything needed to build the catalog documents, in item order
+    items: list
+    marc_records: List[dict]
+    export2ax_map: dict
+    item_map: Dict[str, list]
+    doctype_map: dict
+    link_counts: dict
+
+
+# Row classes by field names, see make_row_class
+_row_classes: Dict[Tuple[str, ...], type] = {}
+
+
+def make_row_class(fields: Tuple[str, ...]) -> type:
+    """
+    Named tuple class for rows with the given fields. Unlike the classes made by DataFrame.itertuples,
+    the instances can be pickled, so they can be sent to worker processes that are not forked.
+    """
+    cls = _row_classes.get(fields)
+    if cls is None:
+        cls = namedtuple('Row', fields, rename=True)
+        cls.__reduce__ = lambda row: (make_row, (fields, tuple(row)))
+        _row_classes[fields] = cls
+    return cls
+
+
+def make_row(fields: Tuple[str, ...], values: tuple):
+    return make_row_class(fields)._make(values)
+
+
+def iter_records(df: pd.DataFrame) -> Generator:
+    """
+    Like DataFrame.itertuples, but the rows can be pickled.
+    """
+    cls = make_row_class(('Index',) + tuple(df.columns))
+    for values in df.itertuples(name=None):
+        yield cls._make(values)
+
+
+def percent(n: int, total: int) -> float:
+    return n / total * 100 if total else 0.
+
+
+def compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
 
 def timing(f):
     @wraps(f)
@@ -62,37 +280,157 @@ class ReportHeader(object):
 
 
 class Cache:
+    """
+    Query result cache. Each result is stored as a Feather (Arrow) file, which keeps the column dtypes,
+    can be memory-mapped and can be read column by column. A JSON manifest next to it records the query,
+    the params, the row count, the dtypes and when the result was fetched.
+    """
+
     def __init__(self, dir, max_age,):
         self.dir = Path(dir)
         self.max_age = max_age
 
-    def get(self, key):
-        cache_file = self.dir.joinpath(key)
-        if not cache_file.exists():
+    @staticmethod
+    def make_key(query: str, params: ColumnDataTypes = None, schema: Optional[Schema] = None) -> str:
+        # The schema is part of the key, so that changing a column type doesn't return cached data with the old type
+        return hashlib.sha1(orjson.dumps([query, params or [], schema or {}])).hexdigest()
+
+    def data_file(self, key: str) -> Path:
+        return self.dir.joinpath('%s.feather' % key)
+
+    def manifest_file(self, key: str) -> Path:
+        return self.dir.joinpath('%s.json' % key)
+
+    def get_manifest(self, key: str) -> Optional[dict]:
+        manifest_file = self.manifest_file(key)
+        if not manifest_file.exists() or not self.data_file(key).exists():
             return None
-        cache_age = time() - cache_file.stat().st_mtime
+        return orjson.loads(manifest_file.read_bytes())
+
+    def get(self, key: str, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        manifest = self.get_manifest(key)
+        if manifest is None:
+            return None
+        cache_age = time() - manifest['created']
         if cache_age > self.max_age:
             log.info('Cache age: %d secs => Too old, will refresh.', cache_age)
             return None
         log.info('Cache age: %d secs => Using cache.', cache_age)
-        return pd.read_pickle(str(cache_file))
 
-    def put(self, key, data):
-        cache_file = self.dir.joinpath(key)
-        cache_file.parent.mkdir(exist_ok=True)
-        data.to_pickle(str(cache_file))
+        df = feather.read_dataframe(str(self.data_file(key)), columns=columns, memory_map=True)
+        if len(df) != manifest['rows']:
+            log.warning('Cache file has %d rows, expected %d => Will refresh.', len(df), manifest['rows'])
+            return None
+
+        # String columns may be read back with a string dtype. Restore them as object columns with None for NULLs,
+        # like Db.select_typed returns them.
+        for column in df.columns:
+            if manifest['dtypes'][column] == 'object' and df[column].dtype != object:
+                df[column] = df[column].astype(object).where(df[column].notnull(), None)
+        return df
+
+    def put(self, key: str, data: pd.DataFrame, query: str, params: ColumnDataTypes = None):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        try:
+            feather.write_dataframe(data.reset_index(drop=True), str(self.data_file(key)))
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as err:
+            log.warning('Could not cache query result: %s', err)
+            self.manifest_file(key).unlink(missing_ok=True)
+            return
+        self.manifest_file(key).write_bytes(orjson.dumps({
+            'query': query,
+            'params': params or [],
+            'rows': len(data),
+            'dtypes': {column: str(dtype) for column, dtype in data.dtypes.items()},
+            'created': time(),
+        }, option=orjson.OPT_INDENT_2))
+
+
+class OrderedGroups:
+    """
+    Groups rows ordered by item ID, for merge-joining several ordered result sets in a single pass.
+    Call `take` with increasing item IDs to get the rows for each item.
+    """
+
+    def __init__(self, rows: Iterable):
+        self._groups = groupby(rows, key=lambda row: int(row.item_id))
+        self._current = next(self._groups, None)
+
+    def take(self, item_id: int) -> list:
+        # Skip groups for items that were not asked for
+        while self._current is not None and self._current[0] < item_id:
+            self._current = next(self._groups, None)
+        if self._current is None or self._current[0] != item_id:
+            return []
+        rows = list(self._current[1])
+        self._current = next(self._groups, None)
+        return rows
 
 
 class Report:
+    """
+    Spreadsheet report, written with openpyxl in write-only mode.
+
+    If a filename is given, the workbook is opened right away and rows are written as they are added,
+    so the rows are not kept in memory. Otherwise the rows are collected in `data` and written by `save`.
 
-    def __init__(self, headers):
+    :param max_rows_per_category: If set, at most this many rows are written to the spreadsheet for each
+        value of the category column, to keep it usable. The remaining rows are written to a CSV file
+        next to it, so they are not lost.
+    """
+
+    def __init__(self, headers, filename=None, max_rows_per_category: Optional[int] = None,
+                 category_column: Optional[int] = None):
         self.headers = headers
         self.data = []
+        self.max_rows_per_category = max_rows_per_category
+        self.category_column = category_column
+        self.category_counts: Dict[str, int] = {}
+        self.filename = None
+        self.wb = None
+        self.ws = None
+        self.rows_written = 0
+        self.overflow_file = None
+        self.overflow_writer = None
+        self.overflow_rows = 0
+
+        # Shared styles
+        self.header_font = Font(bold=True)
+        self.header_fill = PatternFill('solid', fgColor='FFFFEE')
+        self.link_font = Font(color='0000FF')
+
+        if filename is not None:
+            self.open(filename)
 
     @staticmethod
     def remove_control_characters(s):
         return ''.join(ch for ch in s if unicodedata.category(ch)[0] != 'C')
 
+    def open(self, filename):
+        self.filename = filename
+        # The overflow file is only written if needed, so remove any file left from an earlier run
+        self.overflow_filename().unlink(missing_ok=True)
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet()
+
+        for n, header in enumerate(self.headers):
+            self.ws.column_dimensions[chr(65 + n)].width = header.width
+
+        self.ws.freeze_panes = 'A3'
+
+        for line in ['line1', 'line2']:
+            cells = []
+            for header in self.headers:
+                cell = WriteOnlyCell(self.ws, value=getattr(header, line))
+                cell.font = self.header_font
+                cell.fill = self.header_fill
+                cells.append(cell)
+            self.ws.append(cells)
+
+        for row in self.data:
+            self.write_row(row)
+        self.data = []
+
     def add(self, row, wash=False):
         # Jeg fant bare én post med kontrolltegn i hele basen, så sannsynligheten for å støte på dem er så
         # lav at jeg deaktiverer vasking inntil videre, selv om det ikke krever noe særlig ekstra behandlingstid.
@@ -102,35 +440,28 @@ class Report:
             washed = [self.remove_control_characters(col) for col in row]
             if washed != row:
                 log.warning('Row included control characters: %s', str(row))
-            self.data.append(washed)
-        else:
+            row = washed
+        if self.ws is None:
             self.data.append(row)
-
-    def save(self, filename):
-        wb = Workbook()
-        ws = wb.active
-
-        for n, header in enumerate(self.headers):
-            ws.column_dimensions[chr(65 + n)].width = header.width
-
-        ws.freeze_panes = 'A3'
-
-        header_font = Font(bold=True)
-        header_fill = PatternFill('solid', fgColor='FFFFEE')
-        link_font = Font(color='0000FF')
-
-        for n, header in enumerate(self.headers):
-            cell = ws.cell(row=1, column=n + 1, value=header.line1)
-            cell.font = header_font
-            cell.fill = header_fill
-
-            cell = ws.cell(row=2, column=n + 1, value=header.line2)
-            cell.font = header_font
-            cell.fill = header_fill
-
-        for row_no, values in enumerate(self.data):
-            for col_no, value in enumerate(values):
-                link = None
+        else:
+            self.write_row(row)
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def write_row(self, values):
+        if self.max_rows_per_category is not None:
+            category = values[self.category_column]
+            self.category_counts[category] = self.category_counts.get(category, 0) + 1
+            if self.category_counts[category] > self.max_rows_per_category:
+                self.write_overflow_row(values)
+                return
+
+        cells = []
+        for value in values:
+            link = None
+            if isinstance(value, str):
                 if value.startswith('{BIBBI}'):
                     value = value[7:]
                     link = 'https://id.bs.no/bibbi/' + value
@@ -138,54 +469,76 @@ class Report:
                     value = value[7:]
                     link = 'https://bsaut.toolforge.org/show/' + value
 
-                cell = ws.cell(row=row_no + 3, column=col_no + 1, value=value)
-
-                if link is not None:
-                    cell.hyperlink = link
-                    cell.font = link_font
-
-        last_row_no = len(self.data) + 2
+            if link is None:
+                # Plain values are much cheaper than cells in write-only mode
+                cells.append(value)
+                continue
+            cell = WriteOnlyCell(self.ws, value=value)
+            cell.hyperlink = link
+            cell.font = self.link_font
+            cells.append(cell)
+
+        self.ws.append(cells)
+        self.rows_written += 1
+
+    def overflow_filename(self) -> Path:
+        return Path(self.filename).with_suffix('.csv')
+
+    def write_overflow_row(self, values):
+        if self.overflow_writer is None:
+            self.overflow_file = open(str(self.overflow_filename()), 'w', encoding='utf-8', newline='')
+            self.overflow_writer = csv.writer(self.overflow_file)
+            self.overflow_writer.writerow([header.line2 for header in self.headers])
+        self.overflow_writer.writerow(values)
+        self.overflow_rows += 1
+
+    def save(self, filename=None):
+        if self.ws is None:
+            self.open(filename)
+
+        last_row_no = self.rows_written + 2
         last_col_chr = chr(64 + len(self.headers))
-        ws.auto_filter.ref = "A2:%s%s" % (last_col_chr, last_row_no)
+        self.ws.auto_filter.ref = "A2:%s%s" % (last_col_chr, last_row_no)
+
+        self.wb.save(self.filename)
+        log.info('Wrote %d data rows to %s', self.rows_written, self.filename)
 
-        wb.save(filename)
-        log.info('Wrote %d data rows to %s', len(self.data), filename)
+        if self.overflow_file is not None:
+            self.overflow_file.close()
+            log.info('Wrote %d more rows to %s (more than %d rows of the same type)',
+                     self.overflow_rows, self.overflow_file.name, self.max_rows_per_category)
 
 
 class Runner:
 
-    def __init__(self, promus_adapter: PromusService, cache: Cache, config: Config):
-        # self.es = elasticsearch
+    def __init__(self, promus_adapter: PromusService, cache: Cache, config: Config,
+                 max_report_rows: Optional[int] = None, elasticsearch: Optional[Elasticsearch] = None):
+        self.es = elasticsearch
         self.conn = promus_adapter.connection
         self.cache = cache
         self.config = config
-
-    def get_data(self, query: str, params: ColumnDataTypes = None, **kwargs) -> pd.DataFrame:
-        key = hashlib.sha1(query.encode('utf-8')).hexdigest()
-        df = self.cache.get(key)
+        self.max_report_rows = max_report_rows
+
+    def get_data(self, query: str, schema: Schema, params: ColumnDataTypes = None,
+                 columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Get the result of a query, from the cache if possible.
+
+        :param schema: Column types, see Db.select_typed
+        :param columns: Only return these columns. The cache stores all the columns, but only reads these.
+        """
+        key = self.cache.make_key(query, params, schema)
+        df = self.cache.get(key, columns)
         if df is None:
-            df = self.conn.select_dataframe_sa(query, params, **kwargs)
-            self.cache.put(key, df)
+            df = self.conn.select_typed(query, schema, params)
+            self.cache.put(key, df, query, params)
+            if columns is not None:
+                df = df[columns]
         return df
 
     @timing
     def get_authority_links(self):
-        return self.get_data('''
-            SELECT
-                ItemField_ID as field_id,
-                LTRIM(STR(Item_ID)) AS item_id,
-                LTRIM(STR(Authority_ID)) AS local_id,
-                FieldCode as field
-            FROM ItemField
-            WHERE
-                Authority_ID IS NOT NULL AND Authority_ID != '0'
-                AND (
-                    FieldCode LIKE '1%'
-                    OR FieldCode LIKE '6%'
-                    OR FieldCode LIKE '7%'
-                    OR FieldCode LIKE '8%'
-                )
-        ''')
+        return self.get_data(AUTHORITY_LINKS_QUERY, AUTHORITY_LINKS_SCHEMA)
         # Analytiske biinførsler: Hadde først utelatt dem med Indicator2 <> 2, men husker ikke hvorfor. Det fører til
         # at vi får noen autoriteter som tilsynelatende ikke er i bruk i Skosmos, som https://id.bs.no/bibbi/1023449,
         # så prøver å ta dem med og se hvordan det går. DM 2021-08-04
@@ -202,7 +555,7 @@ class Runner:
                 %(title_column)s AS title,
                 %(display_column)s AS label
             FROM %(name)s
-        ''' % table.__dict__)
+        ''' % table.__dict__, AUTHORITY_SCHEMA)
 
     @timing
     def get_authorities(self):
@@ -222,37 +575,11 @@ class Runner:
 
     @timing
     def get_marc_data(self):
-        return self.get_data('''
-          SELECT
-            LTRIM(STR(ItemField.Item_ID)) AS item_id,
-            ItemField.FieldCode AS field,
-            ItemSubField.SubFieldCode AS subfield,
-            ItemSubField.Text AS value
-          FROM ItemField
-          INNER JOIN ItemSubField ON ItemSubField.ItemField_ID = ItemField.ItemField_ID
-          WHERE ItemField.FieldCode IN ('019', '020', '024', '082', '245', '260')
-          ORDER BY ItemField.Item_ID, ItemField.FieldCode
-        ''')
+        return self.get_data(MARC_DATA_QUERY + ' ORDER BY ItemField.Item_ID, ItemField.FieldCode', MARC_DATA_SCHEMA)
 
     @timing
     def get_items(self):
-        return self.get_data('''
-            SELECT
-                LTRIM(STR(Item_ID)) AS item_id,
-                ApproveDateFirst AS cataloguing_date,
-                ApproveDate AS approve_date,
-                ItemYear as pub_year,
-                Title AS title_ax,
-                --, dbo.fn_ItemSubFieldText(Item_ID, '245', 'a') as f245a,
-                --, dbo.fn_ItemSubFieldText(Item_ID, '245', 'b') as f245b,
-                --, dbo.fn_ItemSubFieldText(Item_ID, '260', 'c') as f260c,
-                Varenr AS varenr,
-                LTRIM(STR(BibbiNr)) AS bibbi_id
-            FROM Item
-            WHERE ApproveDateFirst IS NOT NULL
-            AND ApproveDate IS NOT NULL
-            -- AND ApproveDate >= '2019'
-        ''', dont_touch=['cataloguing_date', 'approve_date'], )
+        return self.get_data(ITEMS_QUERY, ITEMS_SCHEMA)
 
     @timing
     def get_export2ax(self):
@@ -263,21 +590,30 @@ class Runner:
                 EAN AS ean,
                 DocumentType AS doc_type
             FROM Export_PromusToAx
-        ''')
+        ''', {
+            'id': 'int',
+            'item_id': 'str',
+            'ean': 'str',
+            'doc_type': 'category',
+        }, columns=['id', 'item_id', 'doc_type'])
 
 
     @timing
     def get_person_roles(self):
-        res = self.get_data('''
+        return self.get_data('''
             SELECT
                 ItemField_ID AS field_id,
-                Text AS value
+                LOWER(Text) AS value
             FROM ItemSubField
-            WHERE SubField_ID = 33   -- 100 $e
-               OR SubField_ID = 219  -- 700 $e
-        ''')
-        res.value = res.value.str.lower()
-        return res
+            WHERE (
+                SubField_ID = 33   -- 100 $e
+                OR SubField_ID = 219  -- 700 $e
+            )
+            AND Text IS NOT NULL
+        ''', {
+            'field_id': 'int',
+            'value': 'category',
+        })
 
     @timing
     def get_doc_types(self):
@@ -289,218 +625,495 @@ class Runner:
                 RDAmedia AS rda_media,
                 RDAcarrier AS rda_carrier
             FROM EnumDocTypes
-        ''')
+        ''', {
+            'code': 'str',
+            'value': 'str',
+            'rda_content': 'str',
+            'rda_media': 'str',
+            'rda_carrier': 'str',
+        }, columns=['code', 'value'])
         return res
 
-    def convert(self, items, export2ax, marc_data, roles, doc_types, authority_links, authorities) -> Generator:
-        valid = 0
-        invalid = 0
-
-        report = Report([
-            ReportHeader('Vare', 'ID', 12),
-            ReportHeader('', 'Tittel', 60),
-            ReportHeader('', 'Godkjent', 12),
-            ReportHeader('Autoritetskobling', 'MARC-felt', 10),
-            ReportHeader('', 'Feil', 30),
-            ReportHeader('Autoritet', 'ID', 12),
-            ReportHeader('', 'Streng', 80),
-        ])
-
-        #print("SORT")
-        # export2ax = sorted(export2ax, key=lambda x: x.id, reverse=True)
+    @staticmethod
+    def make_export2ax_map(export2ax) -> dict:
+        # Map: item.item_id -> latest export2ax record
         export2ax_map = {}
-        for rec in tqdm(export2ax.itertuples()):
+        for rec in tqdm(iter_records(export2ax)):
             cur = export2ax_map.get(rec.item_id)
             if cur is None or rec.id > cur.id:
                 export2ax_map[rec.item_id] = rec
-        del export2ax # Free some memory (maybe)
         log.info('✔ export2ax map done (%d items)', len(export2ax_map))
+        return export2ax_map
 
-        # Map: item.item_id -> MARC fields
-        marc_map = {}
-        for rec in tqdm(marc_data.itertuples()):
-            if rec.item_id not in marc_map:
-                marc_map[rec.item_id] = {}
-            k = rec.field + '$' + rec.subfield
-            marc_map[rec.item_id][k] = rec.value  # Note: If multiple values, only the last one is used
-        del marc_data  # Free some memory (maybe)
-        log.info('✔ MARC map done (%d items)', len(marc_map))
-
+    @staticmethod
+    def make_authority_map(authorities) -> dict:
         # Map: aut.local_id -> aut.bibsent_id
         authority_map = {}
         for key, df in authorities.items():
             for authority in df.itertuples():
                 authority_map['%s-%s' % (key, authority.local_id)] = authority
+        return authority_map
 
+    @staticmethod
+    def make_role_map(roles) -> dict:
         # Map: field.field_id -> role
         role_map = {}
         for rec in tqdm(roles.itertuples()):
             role_map[rec.field_id] = rec.value
+        return role_map
 
+    @staticmethod
+    def make_doctype_map(doc_types) -> dict:
         # Map: doc_type.code -> value
         doctype_map = {}
         for rec in tqdm(doc_types.itertuples()):
             doctype_map[rec.code] = rec.value
+        return doctype_map
 
+    @staticmethod
+    def resolve_link(link, authority_map: dict, role_map: dict, authorities: dict, link_counts: dict):
+        """
+        Look up the authority of an authority link. Returns a tuple (marc field, authority, role),
+        or None if the link can't be resolved.
+        """
+        code = link.field[1:]
+        sig = '%s-%s' % (code, link.local_id)
+        aut_role = role_map.get(link.field_id)
+        try:
+            authority = authority_map[sig]
+            link_counts['valid'] += 1
+            return link.field, authority, aut_role
+        except KeyError:
+            if code not in authorities:
+                log.debug('Cannot authorize field %s', link.field)
+            else:
+                link_counts['invalid'] += 1
+                log.warning('Item %s contains link from field X%s to unknown authority %s',
+                            link.item_id, link.field, link.local_id)
 
-        # Map: item.bibbi_id -> [authority.bibsent_id]
-        item_map = {}
-        for link in tqdm(authority_links.itertuples()):
-            code = link.field[1:]
-            sig = '%s-%s' % (code, link.local_id)
-            aut_role = role_map.get(link.field_id)
-            try:
-                authority = authority_map[sig]
-                item_map[link.item_id] = item_map.get(link.item_id, []) + [(link.field, authority, aut_role)]
-                valid += 1
-            except KeyError:
-                if code not in authorities:
-                    log.debug('Cannot authorize field %s', link.field)
-                else:
-                    invalid += 1
-                    log.warning('Item %s contains link from field X%s to unknown authority %s',
-                                link.item_id, link.field, link.local_id)
+    @staticmethod
+    def make_item_map(authority_links: pd.DataFrame, authorities: Dict[str, pd.DataFrame],
+                      role_map: dict) -> Tuple[Dict[str, list], dict]:
+        """
+        Map: item.item_id -> [(marc field, authority, role)]
+
+        The links are matched against all the authority tables in a single merge on (code, local_id),
+        and then grouped by item using a stable sort and group offsets, so no per-item lists are copied.
+        Returns the map and the number of valid and invalid links.
+        """
+        authority_rows = []
+        authority_keys = [pd.DataFrame({'code': [], 'local_id': []}, dtype=str)]
+        for code, df in authorities.items():
+            authority_rows += list(iter_records(df))
+            authority_keys.append(pd.DataFrame({'code': code, 'local_id': df.local_id.astype(str).values}))
+        keys = pd.concat(authority_keys, ignore_index=True)
+        keys['authority_pos'] = np.arange(len(keys))
+        # If a local ID occurs more than once, the last one wins (like in a dict)
+        keys = keys.drop_duplicates(['code', 'local_id'], keep='last')
+
+        links = pd.DataFrame({
+            'item_id': authority_links.item_id.values,
+            'field_id': authority_links.field_id.values,
+            'field': authority_links.field.values,
+            'code': authority_links.field.str[1:].values,
+            'local_id': authority_links.local_id.astype(str).values,
+        }).merge(keys, how='left', on=['code', 'local_id'], sort=False)
+
+        matched = links.authority_pos.notnull().values
+        known_code = links.code.isin(authorities.keys()).values
+
+        for field in links.field[~matched & ~known_code].unique():
+            log.debug('Cannot authorize field %s', field)
+        for link in links[~matched & known_code].itertuples():
+            log.warning('Item %s contains link from field X%s to unknown authority %s',
+                        link.item_id, link.field, link.local_id)
+
+        links = links[matched]
+        item_codes, item_ids = pd.factorize(links.item_id)
+        order = np.argsort(item_codes, kind='stable')
+        offsets = np.zeros(len(item_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(item_codes, minlength=len(item_ids)), out=offsets[1:])
+
+        resolved = [
+            (field, authority_rows[pos], role_map.get(field_id))
+            for field, pos, field_id in zip(links.field.values[order],
+                                            links.authority_pos.values[order].astype(np.int64),
+                                            links.field_id.values[order])
+        ]
+        item_map = {
+            item_id: resolved[offsets[n]:offsets[n + 1]]
+            for n, item_id in enumerate(item_ids)
+        }
+        link_counts = {'valid': int(matched.sum()), 'invalid': int((~matched & known_code).sum())}
+        return item_map, link_counts
 
-        log.info('Authority links: %d of %d invalid (%.2f %%)',
-                 invalid, valid + invalid, (invalid / (valid + invalid) * 100))
+    @staticmethod
+    def make_report(filename=None, max_rows_per_category: Optional[int] = None) -> Report:
+        # The category is the 'Feil' column
+        return Report([
+            ReportHeader('Vare', 'ID', 12),
+            ReportHeader('', 'Tittel', 60),
+            ReportHeader('', 'Godkjent', 12),
+            ReportHeader('Autoritetskobling', 'MARC-felt', 10),
+            ReportHeader('', 'Feil', 30),
+            ReportHeader('Autoritet', 'ID', 12),
+            ReportHeader('', 'Streng', 80),
+        ], filename, max_rows_per_category, category_column=4)
 
-        def warn(item, marc_field, authority, msg):
+    @staticmethod
+    def make_document(item, export2ax_item, marc_map_item: dict, links: list, doctype_map: dict, report: Report,
+                      error_counts: dict) -> dict:
+        """
+        Build the catalog document for a single item.
+
+        :param item: The item row
+        :param export2ax_item: The latest export2ax record for the item, if any
+        :param marc_map_item: MARC values for the item, keyed by 'field$subfield'
+        :param links: The item's authority links as (marc field, authority, role) tuples
+        :param doctype_map: Map of doc type codes to values
+        :param report: Report to add invalid links to
+        :param error_counts: Counters for the invalid links, updated in place
+        """
+        def warn(marc_field, authority, msg):
             #log.warning('Katalogpost %s ("%s", godkjent %s) har et %s-felt %s: %s (%s)',
             #            item.item_id, item.title_ax, item.cataloguing_date.strftime('%Y-%m-%d'), marc_field, msg, authority.local_id, authority.label)
             report.add([item.item_id, item.title_ax, item.cataloguing_date.strftime('%Y-%m-%d'), marc_field, msg, authority.local_id, authority.label])
 
-        record_count = 0
-        link_count = 0
-        error_counts = {
+        title = marc_map_item.get('245$a')
+        subtitle = marc_map_item.get('245$b')
+        if subtitle is not None:
+            title += ' : ' + subtitle
+        doc = {
+            '_id': item.bibbi_id,
+            # 'title_ax': item.title_ax,
+            'ean': marc_map_item.get('025$a') or marc_map_item.get('020$a'),
+            'webdewey': marc_map_item.get('082$a'),
+            'cataloguing_date': item.cataloguing_date.strftime('%Y-%m-%d'),
+            'approve_date': item.approve_date.strftime('%Y-%m-%d'),
+            'title': title,
+            'pub_year': None if pd.isnull(item.pub_year) else int(item.pub_year),
+            'pub_place': marc_map_item.get('260$a'),
+            'publisher': marc_map_item.get('260$b'),
+            'authorities': [],
+            'doc_types': marc_map_item.get('019$b'),
+            'form': marc_map_item.get('019$d'),
+        }
+        if doc['webdewey'] is not None:
+            doc['webdewey'] = doc['webdewey'].replace('/', '')
+        if export2ax_item:
+            # doc['ean'] = export2ax_item.ean
+            doc['doc_type'] = export2ax_item.doc_type
+        if doc['doc_types'] is None:
+            doc['doc_types'] = []
+        else:
+            doc['doc_types'] = [doctype_map.get(x, x) for x in doc['doc_types'].split(',')]
+
+        doc['form'] = FORM_MAP.get(doc['form'], doc['form'])
+
+        for marc_field, authority, aut_role in links:
+            if authority.not_in_use == 'True':
+                warn(marc_field, authority, 'NotInUse-autoritet')
+                error_counts['NotInUse-autoritet'] += 1
+
+            elif authority.approved == 'False':
+                warn(marc_field, authority, 'ikke-godkjent autoritet')
+                error_counts['ikke-godkjent autoritet'] += 1
+
+            elif pd.isnull(authority.bibsent_id):
+                warn(marc_field, authority, 'mangler Bibbi-ID')
+                error_counts['mangler Bibbi-ID'] += 1
+
+            else:
+                authority_dict = {
+                    'id': authority.bibsent_id,
+                    'label': authority.label,
+                    # Obs: label er greit som søkehjelp, men ikke alltid visning.
+                    # Eks: Smaaland, Tor : 1958- : n.  : Småland, Tor
+                    'type': 'unknown',
+                }
+                if aut_role is not None:
+                    authority_dict['role'] = aut_role
+                if marc_field.startswith('1') or marc_field.startswith('7'):
+                    if authority.title:
+                        authority_dict['type'] = 'work'
+                        authority_dict['title'] = authority.title
+                    else:
+                        authority_dict['type'] = 'creator'
+                        if marc_field.startswith('10') or marc_field.startswith('70'):
+                            authority_dict['is_person'] = True
+
+                elif marc_field.startswith('655'):
+                    authority_dict['type'] = 'genre'
+                elif marc_field.startswith('651'):
+                    # Dog... Oslo - Grønland - Kulturhistorie er ikke et sted..
+                    authority_dict['type'] = 'place'
+                elif marc_field.startswith('6'):
+                    authority_dict['type'] = 'topic'
+                #else:
+                #    # log.debug('%s - Ignoring %s field', item.item_id, marc_field)
+                #    pass
+                doc['authorities'].append(authority_dict)
+
+        doc['_id'] = item.bibbi_id
+        return doc
+
+    @staticmethod
+    def new_error_counts() -> dict:
+        return {
             'NotInUse-autoritet': 0,
             'ikke-godkjent autoritet': 0,
             'mangler Bibbi-ID': 0,
         }
-        for item in tqdm(items.itertuples()):
-            # print(item.item_id)
-            export2ax_item = export2ax_map.get(item.item_id)
-            marc_map_item = marc_map.get(item.item_id, {})
-            title = marc_map_item.get('245$a')
-            subtitle = marc_map_item.get('245$b')
-            if subtitle is not None:
-                title += ' : ' + subtitle
-            doc = {
-                '_id': item.bibbi_id,
-                # 'title_ax': item.title_ax,
-                'ean': marc_map_item.get('025$a') or marc_map_item.get('020$a'),
-                'webdewey': marc_map_item.get('082$a'),
-                'cataloguing_date': item.cataloguing_date.strftime('%Y-%m-%d'),
-                'approve_date': item.approve_date.strftime('%Y-%m-%d'),
-                'title': title,
-                'pub_year': item.pub_year,
-                'pub_place': marc_map_item.get('260$a'),
-                'publisher': marc_map_item.get('260$b'),
-                'authorities': [],
-                'doc_types': marc_map_item.get('019$b'),
-                'form': marc_map_item.get('019$d'),
-            }
-            if doc['webdewey'] is not None:
-                doc['webdewey'] = doc['webdewey'].replace('/', '')
-            if export2ax_item:
-                # doc['ean'] = export2ax_item.ean
-                doc['doc_type'] = export2ax_item.doc_type
-            if doc['doc_types'] is None:
-                doc['doc_types'] = []
-            else:
-                doc['doc_types'] = [doctype_map.get(x, x) for x in doc['doc_types'].split(',')]
-
-            form_map = {
-                "A": "Antologi",
-                "B": "Billedbok",
-                "D": "Dikt",
-                "L": "Lærebok",
-                "N": "Novelle",
-                "P": "Pekebok",
-                "R": "Roman",
-                "S": "Skuespill",
-                "T": "Tegneserie",
-            }
-            doc['form'] = form_map.get(doc['form'], doc['form'])
-
-            for marc_field, authority, aut_role in item_map.get(item.item_id, []):
-                link_count += 1
-                if authority.not_in_use == 'True':
-                    warn(item, marc_field, authority, 'NotInUse-autoritet')
-                    error_counts['NotInUse-autoritet'] += 1
-
-                elif authority.approved == 'False':
-                    warn(item, marc_field, authority, 'ikke-godkjent autoritet')
-                    error_counts['ikke-godkjent autoritet'] += 1
-                    lab = authority.label.replace('&', '').replace('-', '').replace(':', '').lower().split(' ')
-
-                elif pd.isnull(authority.bibsent_id):
-                    warn(item, marc_field, authority, 'mangler Bibbi-ID')
-                    error_counts['mangler Bibbi-ID'] += 1
-
-                else:
-                    authority_dict = {
-                        'id': authority.bibsent_id,
-                        'label': authority.label,
-                        # Obs: label er greit som søkehjelp, men ikke alltid visning.
-                        # Eks: Smaaland, Tor : 1958- : n.  : Småland, Tor
-                        'type': 'unknown',
-                    }
-                    if aut_role is not None:
-                        authority_dict['role'] = aut_role
-                    if marc_field.startswith('1') or marc_field.startswith('7'):
-                        if authority.title:
-                            authority_dict['type'] = 'work'
-                            authority_dict['title'] = authority.title
-                        else:
-                            authority_dict['type'] = 'creator'
-                            if marc_field.startswith('10') or marc_field.startswith('70'):
-                                authority_dict['is_person'] = True
-
-                    elif marc_field.startswith('655'):
-                        authority_dict['type'] = 'genre'
-                    elif marc_field.startswith('651'):
-                        # Dog... Oslo - Grønland - Kulturhistorie er ikke et sted..
-                        authority_dict['type'] = 'place'
-                    elif marc_field.startswith('6'):
-                        authority_dict['type'] = 'topic'
-                    #else:
-                    #    # log.debug('%s - Ignoring %s field', item.item_id, marc_field)
-                    #    pass
-                    doc['authorities'].append(authority_dict)
 
-            record_count += 1
-            doc['_id'] = item.bibbi_id
-            yield doc
+    @staticmethod
+    def log_summary(record_count: int, link_count: int, link_counts: dict, error_counts: dict, report: Report):
+        valid, invalid = link_counts['valid'], link_counts['invalid']
+        log.info('Authority links: %d of %d invalid (%.2f %%)',
+                 invalid, valid + invalid, percent(invalid, valid + invalid))
 
         log.info('Behandlet %d katalogposter med %d autoritetskoblinger', record_count, link_count)
         for error, cnt in error_counts.items():
-            log.info(' - %d feil av typen "%s" (%.2f %%)', cnt, error, cnt / link_count * 100)
-
-        #log.info('%d terms. Top terms:', len(terms))
-        #groups = [(key, len(list(group))) for key, group in groupby(sorted(terms))]
-        #for top_group in sorted(groups, key=lambda x: x[1], reverse=True)[:10]:
-        #    print(top_group)
+            log.info(' - %d feil av typen "%s" (%.2f %%)', cnt, error, percent(cnt, link_count))
 
         total_errors = sum(error_counts.values())
         log.info('Totalt %d lenker (%.2f %%) som ikke peker til en godkjent autoritetspost',
-                 total_errors, total_errors / link_count * 100)
+                 total_errors, percent(total_errors, link_count))
 
-        report.save('ugyldige_autoritetskoblinger.xlsx')
+        report.save()
+
+    def prepare(self, items, export2ax, marc_data, roles, doc_types, authority_links, authorities) -> CatalogData:
+        export2ax_map = self.make_export2ax_map(export2ax)
+        del export2ax # Free some memory (maybe)
+
+        # MARC fields for each item, in the same order as the items
+        marc_records = pivot_marc_data(marc_data, MARC_KEYS, item_ids=items.item_id.values).to_dict('records')
+        del marc_data  # Free some memory (maybe)
+
+        role_map = self.make_role_map(roles)
+        doctype_map = self.make_doctype_map(doc_types)
+
+        item_map, link_counts = self.make_item_map(authority_links, authorities, role_map)
+        del authority_links  # Free some memory (maybe)
+        log.info('✔ Item map done (%d items)', len(item_map))
+
+        return CatalogData(list(iter_records(items)), marc_records, export2ax_map, item_map, doctype_map, link_counts)
+
+    @classmethod
+    def make_documents(cls, catalog: CatalogData, start: int, stop: int, report: Report, error_counts: dict,
+                       counts: dict) -> Generator:
+        """
+        Build the documents for the items catalog.items[start:stop]. The number of records and links
+        are added to counts.
+        """
+        for item, marc_record in zip(catalog.items[start:stop], catalog.marc_records[start:stop]):
+            links = catalog.item_map.get(item.item_id, [])
+            counts['links'] += len(links)
+            counts['records'] += 1
+            yield cls.make_document(item, catalog.export2ax_map.get(item.item_id), marc_record, links,
+                                    catalog.doctype_map, report, error_counts)
+
+    def convert(self, items, export2ax, marc_data, roles, doc_types, authority_links, authorities,
+                report_file: str = REPORT_FILE) -> Generator:
+        catalog = self.prepare(items, export2ax, marc_data, roles, doc_types, authority_links, authorities)
+        report = self.make_report(report_file, self.max_report_rows)
+        error_counts = self.new_error_counts()
+        counts = {'records': 0, 'links': 0}
+        yield from tqdm(self.make_documents(catalog, 0, len(catalog.items), report, error_counts, counts),
+                        total=len(catalog.items))
+
+        self.log_summary(counts['records'], counts['links'], catalog.link_counts, error_counts, report)
+
+    def write_chunked(self, catalog: CatalogData, dest_file: Path, workers: int, chunk_size: int = 50000,
+                      compression: Optional[str] = None, parts: bool = False, start_method: Optional[str] = None):
+        """
+        Build and serialize the documents in chunks of chunk_size items using a pool of worker processes.
+        The chunks are written in order, either to dest_file or, if parts is set, to numbered part files
+        next to it (catalog.00001.jsonl etc.) together with an index file (catalog.index.json).
+
+        :param compression: 'gzip' or 'zstd' (requires the zstandard package). Each chunk is compressed
+            separately by the worker, and the compressed chunks are valid gzip members / zstd frames,
+            so a single compressed file can be decompressed as a whole.
+        :param start_method: Start method for the worker processes. Defaults to 'fork' where available,
+            so the workers inherit the catalog data instead of unpickling a copy of it.
+        """
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError('Invalid compression: %s' % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+
+        n = len(catalog.items)
+        chunks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+        log.info('Writing %d items in %d chunks using %d workers', n, len(chunks), workers)
+
+        report = self.make_report(REPORT_FILE, self.max_report_rows)
+        error_counts = self.new_error_counts()
+        counts = {'records': 0, 'links': 0}
+        index = []
+        t0 = time()
+
+        if start_method is None and 'fork' in multiprocessing.get_all_start_methods():
+            start_method = 'fork'
+        mp_context = multiprocessing.get_context(start_method)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_chunk_worker,
+                                 initargs=(catalog, compression)) as executor:
+            fp = None if parts else open(str(dest_file) + suffix, 'wb')
+            progress = tqdm(total=len(chunks))
+
+            def handle(result):
+                data, chunk_counts, chunk_errors, report_rows = result
+                if parts:
+                    part_file = dest_file.with_name('%s.%05d%s%s' % (dest_file.stem, len(index) + 1,
+                                                                     dest_file.suffix, suffix))
+                    part_file.write_bytes(data)
+                    index.append({'file': part_file.name, 'records': chunk_counts['records'], 'bytes': len(data)})
+                else:
+                    fp.write(data)
+                for key in counts:
+                    counts[key] += chunk_counts[key]
+                for key in error_counts:
+                    error_counts[key] += chunk_errors[key]
+                report.add_rows(report_rows)
+                progress.update()
+
+            # Keep at most 2 * workers chunks in flight, so that the written chunks can be freed
+            pending: Deque[Future] = deque()
+            try:
+                for start, stop in chunks:
+                    pending.append(executor.submit(_write_chunk, start, stop))
+                    if len(pending) >= 2 * workers:
+                        handle(pending.popleft().result())
+                while pending:
+                    handle(pending.popleft().result())
+            finally:
+                progress.close()
+                if fp is not None:
+                    fp.close()
+
+        if parts:
+            index_file = dest_file.with_name(dest_file.stem + '.index.json')
+            index_file.write_bytes(orjson.dumps({
+                'records': counts['records'],
+                'compression': compression,
+                'parts': index,
+            }, option=orjson.OPT_INDENT_2))
+            log.info('Wrote %d records to %d part files, see %s', counts['records'], len(index), index_file.name)
+        else:
+            log.info('Wrote %d records to %s', counts['records'], dest_file.name + suffix)
+
+        elapsed = time() - t0
+        log.info('%.0f records/sec (%d records in %.1f secs)', counts['records'] / elapsed if elapsed else 0,
+                 counts['records'], elapsed)
+
+        self.log_summary(counts['records'], counts['links'], catalog.link_counts, error_counts, report)
+
+    def convert_stream(self, items, export2ax, marc_data, roles, doc_types, authority_links, authorities) -> Generator:
+        """
+        Same as convert, but items, marc_data and authority_links are iterables of rows ordered by item ID
+        (like the ones returned by Db.iter_rows), that are merge-joined in a single pass. Only the authority
+        tables and the small lookup tables are kept in memory.
+        """
+        report = self.make_report(REPORT_FILE, self.max_report_rows)
+        export2ax_map = self.make_export2ax_map(export2ax)
+        authority_map = self.make_authority_map(authorities)
+        role_map = self.make_role_map(roles)
+        doctype_map = self.make_doctype_map(doc_types)
+
+        marc_groups = OrderedGroups(marc_data)
+        link_groups = OrderedGroups(authority_links)
+
+        record_count = 0
+        link_count = 0
+        link_counts = {'valid': 0, 'invalid': 0}
+        error_counts = self.new_error_counts()
+        for item in tqdm(items):
+            item_key = int(item.item_id)
+
+            marc_map_item = {}
+            for rec in marc_groups.take(item_key):
+                # Note: If multiple values, only the last one is used
+                marc_map_item[rec.field + '$' + rec.subfield] = rec.value
+
+            links = []
+            for link in link_groups.take(item_key):
+                resolved = self.resolve_link(link, authority_map, role_map, authorities, link_counts)
+                if resolved is not None:
+                    links.append(resolved)
+
+            link_count += len(links)
+            record_count += 1
+            yield self.make_document(item, export2ax_map.get(item.item_id), marc_map_item, links, doctype_map, report,
+                                     error_counts)
+
+        self.log_summary(record_count, link_count, link_counts, error_counts, report)
 
     @timing
     def dump(self, data) -> bytes:
         return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
 
     @timing
-    def push_to_es(self, records):
-        try:
-            # make the bulk call, and get a response
-            response = helpers.bulk(self.es, records, index='bibbi_cat', doc_type='bib_record')
-            print("\nRESPONSE:", response)
-        except Exception as e:
-            print("\nERROR:", e)
+    def push_to_es(self, source_file: Path, index: str, **kwargs) -> dict:
+        """
+        Index the documents (or delta operations) in a JSONL file written by the export.
+        Takes the same options as BulkIndexer.
+        """
+        if self.es is None:
+            raise ValueError('Elasticsearch is not configured, set ELASTICSEARCH_HOST')
+
+        def read_records():
+            with source_file.open('rb') as fp:
+                for line in fp:
+                    yield orjson.loads(line)
+
+        log.info('Indexing %s in %s', source_file.name, index)
+        return BulkIndexer(self.es, index, **kwargs).index(read_records())
+
+    def write_jsonl(self, records: Iterable[dict], dest_file: Path):
+        nrecs = 0
+        t0 = time()
+        with dest_file.open('wb') as fp:
+            for record in records:
+                fp.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+                nrecs += 1
+
+        elapsed = time() - t0
+        log.info('Wrote %d records to %s (%.0f records/sec)', nrecs, dest_file.name, nrecs / elapsed if elapsed else 0)
+
+    def run(self, stream: bool = False, workers: int = 1, chunk_size: int = 50000,
+            compression: Optional[str] = None, parts: bool = False, incremental: bool = False,
+            es_index: Optional[str] = None, es_options: Optional[dict] = None):
+        dest_file = self.config.dest_dir.joinpath('catalog.jsonl')
+        state_file = self.config.dest_dir.joinpath('catalog.state.json')
+        if es_index is not None and (compression is not None or parts):
+            raise ValueError('Indexing in Elasticsearch requires an uncompressed catalog.jsonl')
+
+        if incremental:
+            state = self.load_state(state_file)
+            if state is not None and dest_file.exists():
+                self.run_incremental(state, state_file, dest_file)
+                if es_index is not None:
+                    self.push_to_es(dest_file.with_name(dest_file.stem + '.delta.jsonl'), es_index,
+                                    **(es_options or {}))
+                return
+            log.info('No previous catalog state found, doing a full export')
+
+        # Get the state before the export, so that items approved during the export are included next time
+        state = self.get_state()
+        self.run_full(dest_file, stream, workers, chunk_size, compression, parts)
+        if compression is None and not parts:
+            self.save_state(state, state_file)
+        elif state_file.exists():
+            # The incremental mode updates catalog.jsonl, which wasn't written this time
+            state_file.unlink()
+
+        if es_index is not None:
+            self.push_to_es(dest_file, es_index, **(es_options or {}))
+
+    def run_full(self, dest_file: Path, stream: bool = False, workers: int = 1, chunk_size: int = 50000,
+                 compression: Optional[str] = None, parts: bool = False):
+        if stream:
+            return self.run_stream()
 
-    def run(self):
         log.info('Get export2ax')
         export2ax = self.get_export2ax()
         log.info("Got %d rows", len(export2ax))
@@ -520,15 +1133,15 @@ class Runner:
         log.info('Got %d items, %d authority_links, %d authorities',
                  len(items), len(authority_links), len(authorities))
 
-        dest_file = self.config.dest_dir.joinpath('catalog.jsonl')
-
-        nrecs = 0
-        with dest_file.open('wb') as fp:
-            for record in self.convert(items, export2ax, marc_data, roles, doc_types, authority_links, authorities):
-                fp.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
-                nrecs += 1
-
-        log.info('Wrote %d records to %s', nrecs, dest_file.name)
+        if workers > 1 or compression is not None or parts:
+            catalog = self.prepare(items, export2ax, marc_data, roles, doc_types, authority_links, authorities)
+            del items, export2ax, marc_data, authority_links  # Free some memory (maybe)
+            self.write_chunked(catalog, dest_file, workers, chunk_size, compression, parts)
+        else:
+            self.write_jsonl(
+                self.convert(items, export2ax, marc_data, roles, doc_types, authority_links, authorities),
+                dest_file
+            )
 
         # for record in records[:20]:
         #     print(orjson.dumps(record, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE).decode('utf-8'))
@@ -540,6 +1153,152 @@ class Runner:
 
         #self.push_to_es(records)
 
+    def get_state(self) -> dict:
+        """
+        The current catalog state: The latest ApproveDate, and the Bibbi IDs of all the items to export,
+        which are used to find deleted items on the next incremental run.
+        """
+        df = self.conn.select_typed(ITEM_STATE_QUERY, ITEM_STATE_SCHEMA)
+        return {
+            'approve_date': df.approve_date.max().isoformat() if len(df) else None,
+            'items': dict(zip(df.item_id, df.bibbi_id)),
+        }
+
+    @staticmethod
+    def load_state(state_file: Path) -> Optional[dict]:
+        if not state_file.exists():
+            return None
+        state = orjson.loads(state_file.read_bytes())
+        if state.get('approve_date') is None:
+            return None
+        return state
+
+    @staticmethod
+    def save_state(state: dict, state_file: Path):
+        state_file.write_bytes(orjson.dumps(state))
+        log.info('Saved catalog state to %s (approve date %s, %d items)',
+                 state_file.name, state['approve_date'], len(state['items']))
+
+    def run_incremental(self, state: dict, state_file: Path, dest_file: Path):
+        """
+        Incremental mode: Only the items approved since the last run (ApproveDate >= the last ApproveDate)
+        are extracted again, together with their MARC data and authority links. Items that are no longer
+        in the catalog are deleted, and so are the old documents of items whose Bibbi ID has changed (those
+        items are extracted again too). The changes are written to catalog.delta.jsonl as upsert and delete
+        operations, and applied to catalog.jsonl.
+        """
+        new_state = self.get_state()
+        since = datetime.fromisoformat(state['approve_date'])
+        log.info('Incremental export of items approved since %s', state['approve_date'])
+
+        # Documents to delete: Items that are gone, or that have a new Bibbi ID (and so a new document ID)
+        rekeyed = []
+        deleted = []
+        for item_id, bibbi_id in state['items'].items():
+            if new_state['items'].get(item_id) != bibbi_id:
+                if bibbi_id is not None:
+                    deleted.append(bibbi_id)
+                if item_id in new_state['items']:
+                    rekeyed.append(item_id)
+
+        condition = 'ApproveDate >= ?'
+        params = [since]
+        if rekeyed:
+            condition += ' OR Item_ID IN (%s)' % ', '.join('?' * len(rekeyed))
+            params += [int(item_id) for item_id in rekeyed]
+        items_since = 'SELECT Item_ID FROM Item WHERE %s' % condition
+        items = self.conn.select_typed(ITEMS_QUERY + ' AND (%s)' % condition, ITEMS_SCHEMA, params)
+        marc_data = self.conn.select_typed(
+            MARC_DATA_QUERY + ' AND ItemField.Item_ID IN (%s) ORDER BY ItemField.Item_ID, ItemField.FieldCode'
+            % items_since, MARC_DATA_SCHEMA, params
+        )
+        authority_links = self.conn.select_typed(
+            AUTHORITY_LINKS_QUERY + ' AND Item_ID IN (%s)' % items_since, AUTHORITY_LINKS_SCHEMA, params
+        )
+
+        docs = list(self.convert(items, self.get_export2ax(), marc_data, self.get_person_roles(),
+                                 self.get_doc_types(), authority_links, self.get_authorities(),
+                                 report_file=DELTA_REPORT_FILE))
+
+        # A new document may take over the ID of a deleted one
+        upserted = {doc['_id'] for doc in docs}
+        deleted = [bibbi_id for bibbi_id in deleted if bibbi_id not in upserted]
+        log.info('Got %d changed items (%d with a new Bibbi ID), %d authority links, %d deleted documents',
+                 len(items), len(rekeyed), len(authority_links), len(deleted))
+
+        delta_file = dest_file.with_name(dest_file.stem + '.delta.jsonl')
+        with delta_file.open('wb') as fp:
+            for doc in docs:
+                fp.write(orjson.dumps({'op': 'upsert', 'doc': doc}, option=orjson.OPT_APPEND_NEWLINE))
+            for bibbi_id in deleted:
+                fp.write(orjson.dumps({'op': 'delete', '_id': bibbi_id}, option=orjson.OPT_APPEND_NEWLINE))
+        log.info('Wrote %d upserts and %d deletes to %s', len(docs), len(deleted), delta_file.name)
+
+        self.apply_delta(dest_file, docs, deleted)
+        self.save_state(new_state, state_file)
+
+    @staticmethod
+    def apply_delta(dest_file: Path, docs: List[dict], deleted: List[str]):
+        # Update the full catalog file, so it can still be used for a full upload
+        changed = {doc['_id'] for doc in docs}.union(deleted)
+        tmp_file = dest_file.with_name(dest_file.name + '.tmp')
+        nrecs = 0
+        with dest_file.open('rb') as src, tmp_file.open('wb') as dst:
+            for line in src:
+                if orjson.loads(line)['_id'] not in changed:
+                    dst.write(line)
+                    nrecs += 1
+            for doc in docs:
+                dst.write(orjson.dumps(doc, option=orjson.OPT_APPEND_NEWLINE))
+                nrecs += 1
+        tmp_file.replace(dest_file)
+        log.info('Updated %s: %d records', dest_file.name, nrecs)
+
+    def run_stream(self):
+        """
+        Streaming mode: Items, MARC data and authority links are read from server-side cursors ordered by
+        item ID, and the JSONL file is written as we go, so memory use doesn't grow with the catalog size.
+        The cache is only used for the authority tables and the small lookup tables.
+        """
+        export2ax = self.get_export2ax()
+        roles = self.get_person_roles()
+        doc_types = self.get_doc_types()
+        authorities = self.get_authorities()
+
+        log.info('Streaming items, marc data and links')
+        items = self.conn.iter_rows(ITEMS_QUERY + ' ORDER BY Item_ID')
+        marc_data = self.conn.iter_rows(MARC_DATA_QUERY + ' ORDER BY ItemField.Item_ID, ItemField.FieldCode')
+        authority_links = self.conn.iter_rows(AUTHORITY_LINKS_QUERY + ' ORDER BY Item_ID, ItemField_ID')
+
+        dest_file = self.config.dest_dir.joinpath('catalog.jsonl')
+        self.write_jsonl(
+            self.convert_stream(items, export2ax, marc_data, roles, doc_types, authority_links, authorities),
+            dest_file
+        )
+
+
+# Worker process state for Runner.write_chunked, set by _init_chunk_worker
+_catalog: Optional[CatalogData] = None
+_compression: Optional[str] = None
+
+
+def _init_chunk_worker(catalog: CatalogData, compression: Optional[str]):
+    global _catalog, _compression
+    _catalog = catalog
+    _compression = compression
+
+
+def _write_chunk(start: int, stop: int) -> Tuple[bytes, dict, dict, list]:
+    # Build and serialize the documents for one chunk. Returns the (compressed) JSONL data, the record
+    # and link counts, the error counts and the report rows.
+    report = Runner.make_report()
+    error_counts = Runner.new_error_counts()
+    counts = {'records': 0, 'links': 0}
+    data = b''.join(
+        orjson.dumps(doc, option=orjson.OPT_APPEND_NEWLINE)
+        for doc in Runner.make_documents(_catalog, start, stop, report, error_counts, counts)
+    )
+    return compress(data, _compression), counts, error_counts, report.data
 
 
 def get_services(config: Config):
@@ -551,16 +1310,18 @@ def get_services(config: Config):
         'password': os.getenv('DB_PASSWORD'),
     }))
 
-    #elasticsearch_adapter = Elasticsearch(
-    #    [os.getenv('ELASTICSEARCH_HOST')],
-    #    http_auth=(os.getenv('ELASTICSEARCH_USER'), os.getenv('ELASTICSEARCH_PASSWORD'))
-    #)
+    elasticsearch_adapter = None
+    if os.getenv('ELASTICSEARCH_HOST'):
+        elasticsearch_adapter = Elasticsearch(
+            [os.getenv('ELASTICSEARCH_HOST')],
+            http_auth=(os.getenv('ELASTICSEARCH_USER'), os.getenv('ELASTICSEARCH_PASSWORD'))
+        )
 
     return {
         'config': config,
         'promus_adapter': promus_adapter,
-        #'elasticsearch': elasticsearch_adapter,
-        'cache': Cache('cache', 36000),
+        'elasticsearch': elasticsearch_adapter,
+        'cache': Cache('cache/catalog', 36000),
     }
 
 
@@ -572,4 +1333,11 @@ def extract_catalog(config: Config, options):
     if options.no_cache:
         services['cache'].max_age = 0
 
-    Runner(**services).run()
+    runner = Runner(**services, max_report_rows=options.max_report_rows)
+    runner.run(stream=options.stream, workers=options.workers, chunk_size=options.chunk_size,
+               compression=options.compression, parts=options.parts, incremental=options.incremental,
+               es_index=options.es_index, es_options={
+                   'chunk_size': options.es_chunk_size,
+                   'thread_count': options.es_threads,
+                   'max_retries': options.es_max_retries,
+               })
@@ -2,6 +2,9 @@ SUB_DELIM = ' - '
 QUA_DELIM = ' : '
 INNER_DELIM = ', '
 
+# Pattern for splitting subdivision strings ($x, $z) into individual subdivisions
+SUBDIV_SPLIT = r' - |\$z|\$x'
+
 # Base types
 TYPE_TOPICAL = 'topical'
 TYPE_GEOGRAPHIC = 'geographic'
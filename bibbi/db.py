@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import Generator, List, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 from urllib.parse import quote_plus
 from time import time
 
@@ -13,8 +13,52 @@ from sqlalchemy.sql import select
 
 
 ColumnDataTypes = List[Union[str, int, None]]
+Schema = Dict[str, str]
 log = logging.getLogger(__name__)
 
+# Column types for Db.select_typed, and the pandas dtypes they are returned as. NULLs are kept as
+# None / <NA> / NaT, never filled with 0.
+SCHEMA_TYPES = {
+    'str': 'object',
+    'int': 'Int64',
+    'bool': 'boolean',
+    'date': 'datetime64[ns]',
+    'category': 'category',
+}
+
+
+def make_typed_chunk(values: list, column_type: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # Convert a chunk of values for one column to a typed array (and a NULL mask for int and bool)
+    n = len(values)
+    if column_type in ('str', 'category'):
+        out = np.empty(n, dtype=object)
+        out[:] = [x if x is None or isinstance(x, str) else str(x) for x in values]
+        return out, None
+    if column_type == 'date':
+        return np.array(values, dtype='datetime64[ns]'), None
+    mask = np.fromiter((x is None for x in values), dtype=bool, count=n)
+    if column_type == 'int':
+        return np.fromiter((0 if x is None else int(x) for x in values), dtype=np.int64, count=n), mask
+    if column_type == 'bool':
+        return np.fromiter((False if x is None else bool(x) for x in values), dtype=bool, count=n), mask
+    raise ValueError('Unknown column type: %s' % column_type)
+
+
+def make_typed_column(chunks: List[Tuple[np.ndarray, Optional[np.ndarray]]], column_type: str):
+    if not chunks:
+        return pd.Series([], dtype=SCHEMA_TYPES[column_type])
+    values = np.concatenate([chunk[0] for chunk in chunks])
+    if column_type == 'category':
+        return pd.Categorical(values)
+    if column_type == 'int':
+        return pd.arrays.IntegerArray(values, np.concatenate([chunk[1] for chunk in chunks]))
+    if column_type == 'bool':
+        return pd.arrays.BooleanArray(values, np.concatenate([chunk[1] for chunk in chunks]))
+    if column_type == 'str':
+        # Keep None for NULLs (a plain object array might be inferred as a string dtype with NaN)
+        return pd.Series(values, dtype=object)
+    return values
+
 
 class Db:
 
@@ -39,6 +83,7 @@ class Db:
             ]
         log.info('Connecting to %s from %s', db_settings['server'], os.name)
         connection_string = ';'.join(connection_args) % db_settings
+        self.connection_string = connection_string
         self.connection: pyodbc.Connection = pyodbc.connect(connection_string)
         log.info('Connected (pyodbc)')
 
@@ -88,6 +133,40 @@ class Db:
                  df.memory_usage().sum() / 1024 ** 2, t1 - t0)
         return df
 
+    def select_typed(self, query: str, schema: Schema, params: ColumnDataTypes = None,
+                     chunk_size: int = 10000) -> pd.DataFrame:
+        """
+        Select into a DataFrame with declared column types, instead of guessing and converting them afterwards
+        like select_dataframe_sa does. The rows are fetched in chunks of chunk_size rows, and each chunk is
+        converted into typed arrays right away.
+
+        :param schema: Column name -> type ('str', 'int', 'bool', 'date' or 'category', see SCHEMA_TYPES).
+            Every column in the result must be declared. Do any casting that is needed to get the values
+            into one of these types in the SQL.
+        """
+        t0 = time()
+        with self.cursor() as cursor:
+            cursor.execute(query, params or [])
+            columns = [column[0] for column in cursor.description]
+            undeclared = [column for column in columns if column not in schema]
+            if undeclared:
+                raise ValueError('Columns missing from schema: %s' % ', '.join(undeclared))
+
+            chunks = {column: [] for column in columns}
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for n, column in enumerate(columns):
+                    chunks[column].append(make_typed_chunk([row[n] for row in rows], schema[column]))
+
+        df = pd.DataFrame({column: make_typed_column(chunks[column], schema[column]) for column in columns},
+                          columns=columns)
+        t1 = time()
+        log.info('Fetched %d rows (%d MB) in %.1f secs', df.shape[0],
+                 df.memory_usage().sum() / 1024 ** 2, t1 - t0)
+        return df
+
     def select_dataframe(self, query: str, params: ColumnDataTypes = None, **kwargs) -> pd.DataFrame:
         with self.cursor() as cursor:
             cursor.execute(query, params or [])
@@ -100,6 +179,25 @@ class Db:
 
         return pd.DataFrame(rows, dtype='str', columns=columns, **kwargs)
 
+    def iter_rows(self, query: str, params: ColumnDataTypes = None, batch_size: int = 10000) -> Generator:
+        """
+        Stream the rows of a query in batches of batch_size rows, without materializing the result set.
+
+        Each call opens its own connection, so several queries can be streamed side by side
+        (a connection can only have one active result set).
+        """
+        connection = pyodbc.connect(self.connection_string)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, params or [])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            connection.close()
+
     def select(self, query: str, params: ColumnDataTypes = None, normalize: bool = False,
                date_fields: list = None, int_fields: list = None) -> Generator[dict, None, None]:
         if 'SELECT' not in query:
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from .util import ensure_parent_dir_exists
+
+if TYPE_CHECKING:
+    from .entity_service import Entity
+
+log = logging.getLogger(__name__)
+
+
+class Diagnostics:
+    """
+    Collects data problems found while processing entities, grouped by category.
+
+    Instead of logging one warning per problem entity (which is slow on a full run), we count
+    the problems per category and keep a bounded sample of the affected entities for each.
+    A summary is logged at the end, and a full report can be written to a file.
+    """
+
+    def __init__(self, max_samples: int = 20, verbose: bool = False):
+        """
+        :param max_samples: Max number of sample entities to keep per category.
+        :param verbose: If set to true, each problem is also logged as a warning when it is added.
+        """
+        self.max_samples = max_samples
+        self.verbose = verbose
+        self.counts: Dict[str, int] = {}
+        self.samples: Dict[str, List[Tuple[str, str, Optional[str]]]] = {}
+
+    def __len__(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, category: str, entity: Entity, detail: Optional[str] = None):
+        """
+        Register a problem.
+
+        :param category: A short, constant description of the problem, like "Biautoritet mangler hovedautoritet".
+        :param entity: The entity having the problem.
+        :param detail: Optional value specific to this occurrence, like the code that could not be resolved.
+        """
+        if self.verbose:
+            if detail is None:
+                log.warning('%s: %s "%s"', category, entity.id, entity.pref_label.nb)
+            else:
+                log.warning('%s: "%s": %s "%s"', category, detail, entity.id, entity.pref_label.nb)
+
+        if category not in self.counts:
+            self.counts[category] = 0
+            self.samples[category] = []
+        self.counts[category] += 1
+        if len(self.samples[category]) < self.max_samples:
+            self.samples[category].append((entity.id, entity.pref_label.nb, detail))
+
+    def log_summary(self):
+        for category, count in self.counts.items():
+            log.warning('%s: %d entities', category, count)
+
+    def write_report(self, filename: Union[str, Path]):
+        ensure_parent_dir_exists(str(filename))
+        with open(filename, 'w', encoding='utf-8') as fp:
+            for category, count in self.counts.items():
+                fp.write('%s: %d entities\n' % (category, count))
+                for entity_id, label, detail in self.samples[category]:
+                    if detail is None:
+                        fp.write('    %s "%s"\n' % (entity_id, label))
+                    else:
+                        fp.write('    %s "%s": %s\n' % (entity_id, label, detail))
+                if count > len(self.samples[category]):
+                    fp.write('    (... and %d more)\n' % (count - len(self.samples[category])))
+                fp.write('\n')
+        log.info('Wrote diagnostics report (%d problems in %d categories) to %s',
+                 len(self), len(self.counts), filename)
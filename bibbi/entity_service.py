@@ -1,13 +1,19 @@
 from __future__ import annotations
 
+from bisect import bisect_left
+import heapq
+import json
 from datetime import datetime
 from dataclasses import dataclass, field
 import logging
-from typing import Iterator, TYPE_CHECKING, List, Set, Dict, Optional
+from typing import Callable, Iterator, TYPE_CHECKING, List, Set, Dict, Optional, Tuple, Iterable, Union
 
 from rdflib import Namespace, URIRef
 
+from .util import normalize_label, ensure_parent_dir_exists
+
 if TYPE_CHECKING:
+    from .label import LabelFactory
     from .util import LanguageMap
     from .promus_service import DataRow, PromusTable
 
@@ -87,61 +93,178 @@ class BibbiEntity(Entity):
 
 
 class EntityIndex:
+    """
+    Index for looking up entity IDs by label + entity type, label + source type or local ID + entity type.
+
+    Keys are tuples, and labels are normalized using `normalize_label`, so lookups are case-insensitive
+    and not affected by the Unicode normalization form of the data. Each key maps to a tuple of entity IDs
+    (in most cases just one). A sorted list of the label keys is built on demand for prefix lookups.
+    """
 
     def __init__(self):
-        self.indices = {
+        self.indices: Dict[str, Dict[Tuple[str, str], Tuple[str, ...]]] = {
             'label+entity_type': {},
             'label+source_type': {},
             'local_id+entity_type': {},
         }
+        self._sorted_labels: Optional[List[Tuple[str, str]]] = None
 
-    def add_label(self, label: LanguageMap, entity: Entity):
-        label_str = label.nb.lower()
-        key = label_str + '@' + entity.type
-        self.add_to('label+entity_type', key, entity.id)
-
-    def add_to(self, idx, key, eid):
-        if key not in self.indices[idx]:
-            self.indices[idx][key] = []
-        self.indices[idx][key].append(eid)
+    def __len__(self) -> int:
+        return len(self.indices['local_id+entity_type'])
 
-    def find(self, label: str = None, entity_type=None, source_type=None, local_id=None) -> list:
+    def add_label(self, label: LanguageMap, entity: Entity):
+        label_str = normalize_label(label.nb)
+        self.add_to('label+entity_type', (label_str, entity.type), entity.id)
+        self.add_to('label+source_type', (label_str, entity.source_type), entity.id)
+
+    def add_to(self, idx: str, key: Tuple[str, str], eid: str):
+        self._add(self.indices[idx], key, eid)
+        if idx == 'label+entity_type':
+            self._sorted_labels = None
+
+    @staticmethod
+    def _add(index: dict, key: Tuple[str, str], eid: str):
+        ids = index.get(key)
+        if ids is None:
+            index[key] = (eid,)
+        elif eid not in ids:
+            index[key] = ids + (eid,)
+
+    def find(self, label: str = None, entity_type=None, source_type=None, local_id=None) -> Tuple[str, ...]:
         """
         Find an entity, either by label + entity type, or label + source_type, or local_id + entity_type
 
         Args:
             label: The entity's label
-            entity_type: The type of the
-            source_type: The source type, e.g.
+            entity_type: The type of the entity
+            source_type: The source type, i.e. the type of the table the entity originates from
             local_id: Originating table primary key
 
         Returns:
-
+            Tuple of matching entity IDs
         """
         if label is not None:
-            label = label.lower()
+            label = normalize_label(label)
             if entity_type is not None:
-                return self.indices['label+entity_type'].get(label + '@' + entity_type) or []
-            # if source_type is not None:
-            #     return self.indices['label+source_type'].get(label + '@' + source_type) or []
+                return self.indices['label+entity_type'].get((label, entity_type), ())
+            if source_type is not None:
+                return self.indices['label+source_type'].get((label, source_type), ())
         elif local_id is not None:
             if entity_type is not None:
-                return self.indices['local_id+entity_type'].get(local_id + '@' + entity_type) or []
+                return self.indices['local_id+entity_type'].get((local_id, entity_type), ())
         raise ValueError('Invalid argument combination')
 
-    def add_entity(self, entity):
-        self.add_to('local_id+entity_type', entity.local_id + '@' + entity.type, entity.id)
+    def find_prefix(self, prefix: str, entity_type: Optional[str] = None, limit: Optional[int] = None) -> List[str]:
+        """
+        Find entities having a label starting with the given prefix, for autocomplete-style lookups.
+
+        Args:
+            prefix: The start of the label
+            entity_type: If given, only return entities of this type
+            limit: Max number of entity IDs to return
+
+        Returns:
+            List of matching entity IDs, ordered by label
+        """
+        if self._sorted_labels is None:
+            self._sorted_labels = sorted(self.indices['label+entity_type'].keys())
+        prefix = normalize_label(prefix)
+        out = []
+        seen = set()
+        for n in range(bisect_left(self._sorted_labels, (prefix, '')), len(self._sorted_labels)):
+            key = self._sorted_labels[n]
+            if not key[0].startswith(prefix):
+                break
+            if entity_type is not None and key[1] != entity_type:
+                continue
+            for eid in self.indices['label+entity_type'][key]:
+                if eid not in seen:
+                    seen.add(eid)
+                    out.append(eid)
+            if limit is not None and len(out) >= limit:
+                return out[:limit]
+        return out
+
+    def _entity_keys(self, entity: Entity) -> Iterator[Tuple[str, Tuple[str, str]]]:
+        yield 'local_id+entity_type', (entity.local_id, entity.type)
+        labels = [label.nb for label in entity.alt_labels]
         if entity.pref_label.nb is not None:
-            self.add_label(entity.pref_label, entity)
-        for alt_label in entity.alt_labels:
-            self.add_label(alt_label, entity)
+            labels.insert(0, entity.pref_label.nb)
+        for label in labels:
+            label = normalize_label(label)
+            yield 'label+entity_type', (label, entity.type)
+            yield 'label+source_type', (label, entity.source_type)
+
+    def add_entity(self, entity: Entity):
+        add = self._add
+        indices = self.indices
+        eid = entity.id
+        for idx, key in self._entity_keys(entity):
+            add(indices[idx], key, eid)
+        self._sorted_labels = None
+
+    def add_entities(self, entities: Iterable[Entity]) -> int:
+        """
+        Bulk-load entities into the index in a single pass. Returns the number of entities added.
+        """
+        # Note: Same as calling add_entity for each entity, but with the key generation inlined, since
+        # this is used to index ~200k entities.
+        add = self._add
+        by_local_id = self.indices['local_id+entity_type']
+        by_entity_type = self.indices['label+entity_type']
+        by_source_type = self.indices['label+source_type']
+        n = 0
+        for entity in entities:
+            eid = entity.id
+            add(by_local_id, (entity.local_id, entity.type), eid)
+            if entity.pref_label.nb is not None:
+                label = normalize_label(entity.pref_label.nb)
+                add(by_entity_type, (label, entity.type), eid)
+                add(by_source_type, (label, entity.source_type), eid)
+            for alt_label in entity.alt_labels:
+                label = normalize_label(alt_label.nb)
+                add(by_entity_type, (label, entity.type), eid)
+                add(by_source_type, (label, entity.source_type), eid)
+            n += 1
+        self._sorted_labels = None
+        return n
+
+    def remove_entity(self, entity: Entity):
+        # Note: The keys are derived from the entity's current labels and types, so these should not be
+        # modified while the entity is in the index.
+        for idx, key in self._entity_keys(entity):
+            index = self.indices[idx]
+            ids = index.get(key)
+            if ids is not None and entity.id in ids:
+                ids = tuple(x for x in ids if x != entity.id)
+                if len(ids):
+                    index[key] = ids
+                else:
+                    del index[key]
+        self._sorted_labels = None
 
 
 class EntityCollection:
 
     def __init__(self, vocabulary_code, members=None):
         self._members: Dict[str, Entity] = members or {}
+        # Members partitioned by entity type and by approval state (Bibbi entities only), in insertion order:
+        # {entity_type: {entity_id: entity}}, {approved: {entity_id: entity}}
+        self._by_type: Dict[str, Dict[str, Entity]] = {}
+        self._by_approval: Dict[Optional[str], Dict[str, Entity]] = {}
+        # Position of each member in insertion order, used to merge partitions in collection order
+        self._positions: Dict[str, int] = {}
+        self._next_position = 0
+        # Running aggregates, updated as entities are added and removed
+        self._last_modified: Optional[datetime] = None
+        self._last_modified_stale = False
+        self._items_totals = {'items_as_entry': 0, 'items_as_subject': 0}
+        for entity in self._members.values():
+            self._by_type.setdefault(entity.type, {})[entity.id] = entity
+            self._add_position(entity)
+            self._add_stats(entity)
         self.index = EntityIndex()
+        self.index.add_entities(self._members.values())
         self.vocabulary_code = vocabulary_code
 
     def __len__(self) -> int:
@@ -150,8 +273,80 @@ class EntityCollection:
     def __iter__(self) -> Iterator[Entity]:
         return iter(self._members.values())
 
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self._members
+
     def add(self, entity: Entity):
+        """
+        Add an entity to the collection, replacing any existing entity with the same ID. The index is updated.
+        """
+        if entity.id in self._members:
+            self._remove_member(entity.id)
         self._members[entity.id] = entity
+        self._by_type.setdefault(entity.type, {})[entity.id] = entity
+        self._add_position(entity)
+        self._add_stats(entity)
+        self.index.add_entity(entity)
+
+    def extend(self, entities: Iterable[Entity]) -> int:
+        """
+        Bulk-add entities to the collection, updating the index in a single pass.
+        Returns the number of entities added.
+        """
+        return self.index.add_entities(self._extend_members(entities))
+
+    def _extend_members(self, entities: Iterable[Entity]) -> Iterator[Entity]:
+        by_type = self._by_type
+        for entity in entities:
+            if entity.id in self._members:
+                self._remove_member(entity.id)
+            self._members[entity.id] = entity
+            if entity.type not in by_type:
+                by_type[entity.type] = {}
+            by_type[entity.type][entity.id] = entity
+            self._add_position(entity)
+            self._add_stats(entity)
+            yield entity
+
+    def _remove_member(self, entity_id: str) -> Optional[Entity]:
+        entity = self._members.pop(entity_id, None)
+        if entity is not None:
+            del self._by_type[entity.type][entity_id]
+            del self._positions[entity_id]
+            self._remove_stats(entity)
+            self.index.remove_entity(entity)
+        return entity
+
+    def _add_position(self, entity: Entity):
+        self._positions[entity.id] = self._next_position
+        self._next_position += 1
+
+    def _add_stats(self, entity: Entity):
+        if not isinstance(entity, BibbiEntity):
+            return
+        if entity.modified is not None and (self._last_modified is None or entity.modified > self._last_modified):
+            self._last_modified = entity.modified
+        if entity.approved not in self._by_approval:
+            self._by_approval[entity.approved] = {}
+        self._by_approval[entity.approved][entity.id] = entity
+        self._items_totals['items_as_entry'] += int(entity.items_as_entry)
+        self._items_totals['items_as_subject'] += int(entity.items_as_subject)
+
+    def _remove_stats(self, entity: Entity):
+        if not isinstance(entity, BibbiEntity):
+            return
+        if entity.modified is not None and entity.modified == self._last_modified:
+            # The max can't be updated incrementally, so it's recomputed on next access
+            self._last_modified_stale = True
+        del self._by_approval[entity.approved][entity.id]
+        self._items_totals['items_as_entry'] -= int(entity.items_as_entry)
+        self._items_totals['items_as_subject'] -= int(entity.items_as_subject)
+
+    def remove(self, entity_id: str) -> Optional[Entity]:
+        """
+        Remove an entity from the collection and the index. Returns the removed entity, if any.
+        """
+        return self._remove_member(entity_id)
 
     def get(self, entity_id: str, default=None):
         return self._members.get(entity_id, default)
@@ -160,29 +355,205 @@ class EntityCollection:
         return [self.get(entity_id) for entity_id in self.index.find(**kwargs)]
 
     def find_first(self, **kwargs) -> Optional[Entity]:
-        results = self.find(**kwargs)
-        return results[0] if len(results) else None
+        entity_ids = self.index.find(**kwargs)
+        return self._members.get(entity_ids[0]) if len(entity_ids) else None
+
+    def find_by_local_ids(self, local_ids: Iterable[Optional[str]], entity_type: str) -> List[Optional[Entity]]:
+        """
+        Bulk version of `find_first(local_id=..., entity_type=...)`. Returns the first matching entity
+        for each local ID, or None if there is no match (or the local ID is None).
+        """
+        index = self.index.indices['local_id+entity_type']
+        members = self._members
+        out = []
+        for local_id in local_ids:
+            entity_ids = index.get((local_id, entity_type))
+            out.append(members.get(entity_ids[0]) if entity_ids else None)
+        return out
+
+    def of_type(self, *entity_types: str) -> Iterator[Entity]:
+        """
+        Iterate over the entities of the given type(s), without scanning the whole collection.
+        Entities are returned grouped by type, and in insertion order within each type.
+        """
+        for entity_type in entity_types:
+            yield from self._by_type.get(entity_type, {}).values()
+
+    def with_approval(self, approved: Optional[str]) -> Iterator[Entity]:
+        """
+        Iterate over the Bibbi entities having the given approval state, in insertion order.
+        """
+        yield from self._by_approval.get(approved, {}).values()
 
-    def filter(self, filter_fn) -> EntityCollection:
-        return EntityCollection(self.vocabulary_code, {k: v for k, v in self._members.items() if filter_fn(v)})
+    def filter(self, filter_fn: Optional[Callable[[Entity], bool]] = None,
+               entity_type: Optional[Union[str, Iterable[str]]] = None,
+               approved: Optional[str] = None) -> EntityCollectionView:
+        """
+        Get a lazy view of the entities matching all the given criteria. The view shares the storage
+        and index of this collection, so creating it is cheap. Filtering on entity type and approval
+        state uses the partitions, and is much cheaper than a filter_fn.
+
+        Example: Approved topical terms: collection.filter(entity_type=TYPE_TOPICAL, approved='1')
+        """
+        return EntityCollectionView(self, filter_fn, entity_type, approved)
 
     def update_index(self):
+        # Rebuild the index from scratch. Not needed as long as entities are added and removed
+        # using add/extend/remove, which keep the index up to date.
         self.index = EntityIndex()
-        for entity_id, entity in self._members.items():
-            self.index.add_entity(entity)
+        self.index.add_entities(self._members.values())
 
-    def import_table(self, table: PromusTable):
-        n = 0
-        for entity in table.make_entities():
-            self.add(entity)
-            n += 1
+    def import_table(self, table: PromusTable, label_factory: Optional[LabelFactory] = None):
+        n = self.extend(table.make_entities(label_factory))
         log.info('Constructed %d entities from: %s', n, table.type)
 
+    @property
+    def last_modified(self) -> Optional[datetime]:
+        """
+        The latest modification date of any entity in the collection, or None if unknown.
+        """
+        if self._last_modified_stale:
+            modified = [
+                entity.modified for entity in self._members.values()
+                if isinstance(entity, BibbiEntity) and entity.modified is not None
+            ]
+            self._last_modified = max(modified) if len(modified) else None
+            self._last_modified_stale = False
+        return self._last_modified
+
+    @property
+    def type_counts(self) -> Dict[str, int]:
+        return {entity_type: len(members) for entity_type, members in self._by_type.items() if len(members)}
+
+    @property
+    def approval_counts(self) -> Dict[Optional[str], int]:
+        return {approved: len(members) for approved, members in self._by_approval.items() if len(members)}
+
+    @property
+    def items_totals(self) -> Dict[str, int]:
+        return dict(self._items_totals)
+
     def get_last_modified(self):
-        last_modified = datetime(2000, 1, 1, 0, 0, 0)
-        for entity in self._members.values():
-            if isinstance(entity, BibbiEntity) and entity.modified is not None:
-                if entity.modified > last_modified:
-                    last_modified = entity.modified
+        last_modified = self.last_modified
+        if last_modified is None or last_modified < datetime(2000, 1, 1, 0, 0, 0):
+            last_modified = datetime(2000, 1, 1, 0, 0, 0)
         log.info('Concept scheme (%d members) last modified: %s', len(self._members), last_modified.isoformat())
         return last_modified
+
+    def get_statistics(self) -> dict:
+        last_modified = self.last_modified
+        return {
+            'vocabulary': self.vocabulary_code,
+            'entities': len(self._members),
+            'last_modified': last_modified.isoformat() if last_modified is not None else None,
+            'types': self.type_counts,
+            'approved': {str(k): v for k, v in self.approval_counts.items()},
+            'items': self.items_totals,
+        }
+
+    def write_statistics(self, filename: str):
+        ensure_parent_dir_exists(filename)
+        with open(filename, 'w', encoding='utf-8') as fp:
+            json.dump(self.get_statistics(), fp, indent=2, ensure_ascii=False)
+        log.info('Wrote collection statistics to %s', filename)
+
+
+class EntityCollectionView:
+    """
+    Lazy, read-only view of the entities in an EntityCollection matching some criteria, see
+    `EntityCollection.filter`. Nothing is copied: Iteration and lookups go to the parent collection,
+    and the parent's index is used for `find`, with the results filtered. Changes to the parent are
+    reflected in the view.
+    """
+
+    def __init__(self, parent: EntityCollection, filter_fn: Optional[Callable[[Entity], bool]] = None,
+                 entity_type: Optional[Union[str, Iterable[str]]] = None, approved: Optional[str] = None):
+        self.parent = parent
+        self.vocabulary_code = parent.vocabulary_code
+        self.index = parent.index
+        self.filter_fn = filter_fn
+        if isinstance(entity_type, str):
+            entity_type = [entity_type]
+        self.entity_types = tuple(entity_type) if entity_type is not None else None
+        self.approved = approved
+
+    def matches(self, entity: Entity) -> bool:
+        if self.entity_types is not None and entity.type not in self.entity_types:
+            return False
+        if self.approved is not None and getattr(entity, 'approved', None) != self.approved:
+            return False
+        return self.filter_fn is None or self.filter_fn(entity)
+
+    def _candidates(self) -> Iterator[Entity]:
+        # Start from the smallest partition(s) matching the criteria
+        if self.entity_types is not None:
+            partitions = [self.parent._by_type.get(x, {}) for x in self.entity_types]
+            if self.approved is not None:
+                by_approval = self.parent._by_approval.get(self.approved, {})
+                if len(by_approval) < sum(len(partition) for partition in partitions):
+                    partitions = [by_approval]
+        elif self.approved is not None:
+            partitions = [self.parent._by_approval.get(self.approved, {})]
+        else:
+            return iter(self.parent)
+
+        # Each partition is in insertion order. Several partitions are merged on the position in the
+        # collection, so that the view is always in the same order as the collection.
+        if len(partitions) == 1:
+            return iter(partitions[0].values())
+        positions = self.parent._positions
+        return heapq.merge(*[partition.values() for partition in partitions], key=lambda x: positions[x.id])
+
+    def __iter__(self) -> Iterator[Entity]:
+        for entity in self._candidates():
+            if self.matches(entity):
+                yield entity
+
+    def __len__(self) -> int:
+        if self.filter_fn is None:
+            if self.approved is None and self.entity_types is not None:
+                return sum(len(self.parent._by_type.get(x, {})) for x in self.entity_types)
+            if self.entity_types is None and self.approved is not None:
+                return len(self.parent._by_approval.get(self.approved, {}))
+            if self.entity_types is None and self.approved is None:
+                return len(self.parent)
+        return sum(1 for _ in self)
+
+    def __contains__(self, entity_id: str) -> bool:
+        return self.get(entity_id) is not None
+
+    def get(self, entity_id: str, default=None):
+        entity = self.parent.get(entity_id)
+        if entity is None or not self.matches(entity):
+            return default
+        return entity
+
+    def find(self, **kwargs):
+        return [entity for entity in self.parent.find(**kwargs) if self.matches(entity)]
+
+    def find_first(self, **kwargs) -> Optional[Entity]:
+        results = self.find(**kwargs)
+        return results[0] if len(results) else None
+
+    def filter(self, filter_fn: Optional[Callable[[Entity], bool]] = None,
+               entity_type: Optional[Union[str, Iterable[str]]] = None,
+               approved: Optional[str] = None) -> EntityCollectionView:
+        return self.parent.filter(
+            lambda entity: self.matches(entity) and (filter_fn is None or filter_fn(entity)),
+            entity_type if entity_type is not None else self.entity_types,
+            approved if approved is not None else self.approved,
+        )
+
+    @property
+    def last_modified(self) -> Optional[datetime]:
+        modified = [
+            entity.modified for entity in self
+            if isinstance(entity, BibbiEntity) and entity.modified is not None
+        ]
+        return max(modified) if len(modified) else None
+
+    def get_last_modified(self):
+        last_modified = self.last_modified
+        if last_modified is None or last_modified < datetime(2000, 1, 1, 0, 0, 0):
+            last_modified = datetime(2000, 1, 1, 0, 0, 0)
+        return last_modified
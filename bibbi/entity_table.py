@@ -0,0 +1,143 @@
+"""
+Columnar storage for entity fields.
+
+An EntityTable holds one NumPy array per field, with one entry per entity, and is built directly from
+the DataFrames of the Promus tables, without constructing Entity objects. It holds the fields that
+don't depend on the relations between entities, and is used for the collection statistics and the
+WebDewey mapping file, which only need those. The entity type is derived using the same rules as
+PromusAuthorityTable.make_entity.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+from rdflib import Namespace, URIRef
+
+from .promus_service import PromusAuthorityTable
+from .util import ensure_parent_dir_exists
+
+log = logging.getLogger(__name__)
+
+# Fields copied from the main row of each entity, stored as object arrays with None for null values
+STRING_FIELDS = ['local_id', 'approved', 'webdewey_nr', 'webdewey_approved', 'noraf_id', 'external_uri']
+
+INT_FIELDS = ['items_as_entry', 'items_as_subject']
+DATETIME_FIELDS = ['modified']
+
+
+def object_array(series: pd.Series) -> np.ndarray:
+    return series.astype(object).where(series.notnull(), None).to_numpy()
+
+
+class EntityTable:
+    """
+    Columnar, read-only entity fields. Create one using `EntityTable.from_tables`.
+    """
+
+    def __init__(self, vocabulary_code: str, namespace: Namespace, columns: Dict[str, np.ndarray]):
+        self.vocabulary_code = vocabulary_code
+        self.namespace = namespace
+        self.columns = columns
+
+    @classmethod
+    def from_tables(cls, tables: Iterable[PromusAuthorityTable]) -> EntityTable:
+        """
+        Build the table from the main rows of the entity groups of each table. As with
+        EntityCollection.import_table, an entity replaces an earlier entity with the same ID,
+        and groups with only references are skipped.
+        """
+        tables = list(tables)
+        parts: List[Dict[str, np.ndarray]] = [cls._table_columns(table) for table in tables]
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+        # Keep the last entity for each ID, ordered by its position
+        keep = ~pd.Index(columns['id']).duplicated(keep='last')
+        columns = {name: values[keep] for name, values in columns.items()}
+
+        log.info('Built entity table with %d entities from %d tables', keep.sum(), len(tables))
+        return cls(tables[0].vocabulary_code, tables[0].namespace, columns)
+
+    @staticmethod
+    def _table_columns(table: PromusAuthorityTable) -> Dict[str, np.ndarray]:
+        groups = table.entity_groups()
+        starts = np.asarray(groups.starts, dtype=np.int64)
+        main_counts = np.asarray(groups.main_counts, dtype=np.int64)
+        has_main = main_counts > 0
+
+        # If there are duplicate main rows, the last one wins (as in PromusTable.iter_groups)
+        df = table.df.iloc[groups.positions[starts[has_main] + main_counts[has_main] - 1]]
+        n = df.shape[0]
+
+        def column(name: str) -> pd.Series:
+            return df[name] if name in df.columns else pd.Series([None] * n, index=df.index, dtype=object)
+
+        type_fields = PromusAuthorityTable.entity_type_fields
+        type_values = zip(*[object_array(column(name)) for name in type_fields])
+        columns = {
+            'id': object_array(df[table.index_column]),
+            'source_type': np.full(n, table.type, dtype=object),
+            'type': np.array([
+                table.get_entity_type(table.type, dict(zip(type_fields, values))) for values in type_values
+            ], dtype=object),
+        }
+        for name in STRING_FIELDS:
+            columns[name] = object_array(column('row_id' if name == 'local_id' else name))
+        for name in INT_FIELDS:
+            columns[name] = pd.to_numeric(column(name)).fillna(0).to_numpy(dtype=np.int64)
+        for name in DATETIME_FIELDS:
+            columns[name] = pd.to_datetime(column(name)).to_numpy(dtype='datetime64[ns]')
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+    def uris(self) -> Iterator[URIRef]:
+        for entity_id in self.columns['id']:
+            yield self.namespace.term(entity_id)
+
+    @property
+    def last_modified(self) -> Optional[pd.Timestamp]:
+        modified = pd.Series(self.columns['modified']).max()
+        return None if pd.isnull(modified) else modified
+
+    @staticmethod
+    def _counts(values: np.ndarray) -> Dict[str, int]:
+        # Note: Counter keeps None as a key, while value_counts would turn it into NaN
+        return dict(Counter(values.tolist()))
+
+    @property
+    def type_counts(self) -> Dict[str, int]:
+        return self._counts(self.columns['type'])
+
+    @property
+    def approval_counts(self) -> Dict[Optional[str], int]:
+        return self._counts(self.columns['approved'])
+
+    @property
+    def items_totals(self) -> Dict[str, int]:
+        return {name: int(self.columns[name].sum()) for name in INT_FIELDS}
+
+    def get_statistics(self) -> dict:
+        """
+        Same as EntityCollection.get_statistics.
+        """
+        last_modified = self.last_modified
+        return {
+            'vocabulary': self.vocabulary_code,
+            'entities': len(self),
+            'last_modified': last_modified.isoformat() if last_modified is not None else None,
+            'types': self.type_counts,
+            'approved': {str(k): v for k, v in self.approval_counts.items()},
+            'items': self.items_totals,
+        }
+
+    def write_statistics(self, filename: str):
+        ensure_parent_dir_exists(filename)
+        with open(filename, 'w', encoding='utf-8') as fp:
+            json.dump(self.get_statistics(), fp, indent=2, ensure_ascii=False)
+        log.info('Wrote entity table statistics to %s', filename)
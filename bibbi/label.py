@@ -1,13 +1,53 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import pandas as pd
+
 from .constants import SUB_DELIM, TYPE_CORPORATION, QUA_DELIM, TYPE_GEOGRAPHIC, TYPE_PERSON, INNER_DELIM, TYPE_EVENT, \
-    TYPE_EVENT_SUBJECT, TYPE_PERSON_SUBJECT, TYPE_CORPORATION_SUBJECT, TYPE_TITLE_SUBJECT, TYPE_WORK
+    TYPE_EVENT_SUBJECT, TYPE_PERSON_SUBJECT, TYPE_CORPORATION_SUBJECT, TYPE_TITLE_SUBJECT, TYPE_WORK, SUBDIV_SPLIT
 from .util import LanguageMap
 
 if TYPE_CHECKING:
     from .promus_service import DataRow
 
 
+# A pair of (nb, nn) string Series, used for vectorized label construction
+SeriesPair = Tuple[pd.Series, pd.Series]
+
+
+def _column(df: pd.DataFrame, name: str) -> pd.Series:
+    # Column as an object Series with None for missing values. Columns not in the table are all None.
+    if name not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    col = df[name].astype(object)
+    return col.where(col.notnull(), None)
+
+
+def _lang_columns(df: pd.DataFrame, nb: str, nn: Optional[str] = None) -> Tuple[pd.Series, pd.Series, pd.Series]:
+    # Vectorized version of DataRow.get_lang_map. Returns (nb, nn, mask), where nb and nn
+    # are filled with empty strings where the mask is false.
+    nb_col = _column(df, nb)
+    nn_col = _column(df, nn or nb + '_nn')
+    mask = nb_col.notnull()
+    return nb_col.fillna(''), nn_col.where(nn_col.notnull(), nb_col).fillna(''), mask
+
+
+def _subdivision_columns(df: pd.DataFrame, subdiv_type: str) -> Tuple[pd.Series, pd.Series, pd.Series]:
+    # Vectorized version of DataRow.get_subdivisions. Returns (nb, nn, mask) where nb and nn are
+    # Series of lists. If the number of nb and nn subdivisions differ, the nb subdivisions are used for nn.
+    nb_col = _column(df, subdiv_type)
+    nn_col = _column(df, subdiv_type + '_nn')
+    nb_parts = nb_col.fillna('').str.split(SUBDIV_SPLIT, regex=True)
+    nn_parts = nn_col.fillna('').str.split(SUBDIV_SPLIT, regex=True)
+    aligned = nn_col.notnull() & (nb_parts.str.len() == nn_parts.str.len())
+    return nb_parts, nn_parts.where(aligned, nb_parts), nb_col.notnull()
+
+
+def _append(label: SeriesPair, mask: pd.Series, nb: pd.Series, nn: pd.Series) -> SeriesPair:
+    # Append nb and nn to the label where mask is true
+    return label[0].where(~mask, label[0] + nb), label[1].where(~mask, label[1] + nn)
+
+
 class LabelFactory:
     """
     A service that can format labels in different ways.
@@ -29,6 +69,14 @@ class LabelFactory:
         #self.include_subdivisions = include_subdivisions
         #self.include_qualifier = include_qualifier
 
+        # Labels are cached by (row type, row id, include_subdivisions, include_qualifier, transform),
+        # so that each label variant is only constructed once per row, even if it is requested
+        # both when making entities and when adding relations between them.
+        self._cache: Dict[Tuple, LanguageMap] = {}
+
+    def clear_cache(self):
+        self._cache = {}
+
     @staticmethod
     def get_label_and_detail(row: DataRow) -> LanguageMap:
         # 1. Navn ($a)
@@ -36,8 +84,8 @@ class LabelFactory:
 
         # 2. Forklarende tilføyelse i parentes
         if detail := row.get_lang_map('detail'):
-            label.nb += ' (%s)' % detail.nb
-            label.nn += ' (%s)' % detail.nn
+            return LanguageMap(nb='%s (%s)' % (label.nb, detail.nb),
+                               nn='%s (%s)' % (label.nn, detail.nn))
 
         return label
 
@@ -67,41 +115,204 @@ class LabelFactory:
 
     def make(self, row: DataRow, include_subdivisions: bool = True,
              include_qualifier: bool = True) -> LanguageMap:
+        """
+        Make a label for the row. Labels are cached, so the returned LanguageMap should not be modified.
+        """
+        row_id = row.get('row_id')
+        if row_id is None:
+            # Not cacheable
+            return self._make(row, include_subdivisions, include_qualifier)
+
+        key = (row.type, row_id, include_subdivisions, include_qualifier, self.transform)
+        label = self._cache.get(key)
+        if label is None:
+            label = self._make(row, include_subdivisions, include_qualifier)
+            self._cache[key] = label
+        return label
+
+    def _make(self, row: DataRow, include_subdivisions: bool, include_qualifier: bool) -> LanguageMap:
 
-        label = self.get_base_label(row, include_subdivisions)
+        base_label = self.get_base_label(row, include_subdivisions)
+        nb: List[str] = [base_label.nb]
+        nn: List[str] = [base_label.nn]
 
         if include_subdivisions:
 
             # Geografisk underavdeling ($z)
             if row.type != TYPE_GEOGRAPHIC and row.has('sub_geo'):
-                label += SUB_DELIM
-                label += self.get_geographic_label(row, include_subdivisions)
+                geographic_label = self.get_geographic_label(row, include_subdivisions)
+                nb += [SUB_DELIM, geographic_label.nb]
+                nn += [SUB_DELIM, geographic_label.nn]
 
             # Generell underavdeling ($x)
             for subdivison in row.get_subdivisions('sub_topic'):
-                label.nb += SUB_DELIM + subdivison.nb
-                label.nn += SUB_DELIM + subdivison.nn
+                nb += [SUB_DELIM, subdivison.nb]
+                nn += [SUB_DELIM, subdivison.nn]
 
         # Tittel på analytter for personer og korporasjoner (lover, musikkalbum, verk)
         if work_title := row.get_lang_map('work_title'):
             if self.transform:
-                label.nb = '%s (%s)' % (work_title.nb, label.nb)
-                label.nn = '%s (%s)' % (work_title.nn, label.nn)
+                nb = [work_title.nb, ' ('] + nb + [')']
+                nn = [work_title.nn, ' ('] + nn + [')']
             else:
-                label.nb += SUB_DELIM + work_title.nb
-                label.nn += SUB_DELIM + work_title.nn
+                nb += [SUB_DELIM, work_title.nb]
+                nn += [SUB_DELIM, work_title.nn]
 
         if include_qualifier:
             # Kolon-kvalifikator (Blir litt gæren av disse!)
             if qualifier := row.get_lang_map('qualifier'):
-                label.nb += QUA_DELIM + qualifier.nb
-                label.nn += QUA_DELIM + qualifier.nn
+                nb += [QUA_DELIM, qualifier.nb]
+                nn += [QUA_DELIM, qualifier.nn]
 
         if row.type == TYPE_TITLE_SUBJECT or row.type == TYPE_PERSON_SUBJECT:
-            label.nb += ' (emne)'
-            label.nn += ' (emne)'
+            nb.append(' (emne)')
+            nn.append(' (emne)')
 
-        return label
+        return LanguageMap(nb=''.join(nb), nn=''.join(nn))
+
+    def make_frame(self, df: pd.DataFrame, row_type: str, include_subdivisions: bool = True,
+                   include_qualifier: bool = True) -> pd.DataFrame:
+        """
+        Vectorized version of `make` that makes labels for all rows of a table DataFrame at once,
+        where all rows are of the type `row_type`. The labels are not cached.
+
+        Returns a DataFrame with "nb" and "nn" columns, with the same index as `df`.
+        """
+        label = self._get_base_label_frame(df, row_type, include_subdivisions)
+
+        if include_subdivisions:
+
+            # Geografisk underavdeling ($z)
+            if row_type != TYPE_GEOGRAPHIC:
+                geo_nb, geo_nn, geo_mask = self._get_geographic_label_frame(df, row_type, include_subdivisions)
+                label = _append(label, geo_mask, SUB_DELIM + geo_nb, SUB_DELIM + geo_nn)
+
+            # Generell underavdeling ($x)
+            sub_nb, sub_nn, sub_mask = _subdivision_columns(df, 'sub_topic')
+            label = _append(label, sub_mask, SUB_DELIM + sub_nb.str.join(SUB_DELIM), SUB_DELIM + sub_nn.str.join(SUB_DELIM))
+
+        # Tittel på analytter for personer og korporasjoner (lover, musikkalbum, verk)
+        title_nb, title_nn, title_mask = _lang_columns(df, 'work_title')
+        if self.transform:
+            label = (label[0].where(~title_mask, title_nb + ' (' + label[0] + ')'),
+                     label[1].where(~title_mask, title_nn + ' (' + label[1] + ')'))
+        else:
+            label = _append(label, title_mask, SUB_DELIM + title_nb, SUB_DELIM + title_nn)
+
+        if include_qualifier:
+            # Kolon-kvalifikator
+            qualifier_nb, qualifier_nn, qualifier_mask = _lang_columns(df, 'qualifier')
+            label = _append(label, qualifier_mask, QUA_DELIM + qualifier_nb, QUA_DELIM + qualifier_nn)
+
+        if row_type == TYPE_TITLE_SUBJECT or row_type == TYPE_PERSON_SUBJECT:
+            label = (label[0] + ' (emne)', label[1] + ' (emne)')
+
+        return pd.DataFrame({'nb': label[0], 'nn': label[1]}, index=df.index)
+
+    def cache_frame(self, df: pd.DataFrame, row_type: str, include_subdivisions: bool = True,
+                    include_qualifier: bool = True) -> int:
+        """
+        Make the labels for all rows of a table DataFrame with `make_frame`, and add them to the cache,
+        so that `make` doesn't have to construct them row by row. Returns the number of labels added.
+        """
+        if 'row_id' not in df.columns:
+            return 0
+        labels = self.make_frame(df, row_type, include_subdivisions, include_qualifier)
+        n = 0
+        for row_id, nb, nn in zip(df.row_id.tolist(), labels.nb.tolist(), labels.nn.tolist()):
+            if row_id is None or pd.isnull(row_id):
+                continue
+            key = (row_type, row_id, include_subdivisions, include_qualifier, self.transform)
+            self._cache[key] = LanguageMap(nb=nb, nn=nn)
+            n += 1
+        return n
+
+    def _get_label_and_detail_frame(self, df: pd.DataFrame) -> SeriesPair:
+        label_nb, label_nn, _ = _lang_columns(df, 'label')
+        detail_nb, detail_nn, detail_mask = _lang_columns(df, 'detail')
+        return _append((label_nb, label_nn), detail_mask, ' (' + detail_nb + ')', ' (' + detail_nn + ')')
+
+    def _get_base_label_frame(self, df: pd.DataFrame, row_type: str, include_subdivisions: bool) -> SeriesPair:
+        # Vectorized version of get_base_label
+
+        if row_type == TYPE_GEOGRAPHIC:
+            label_nb, label_nn, _ = self._get_geographic_label_frame(df, row_type, include_subdivisions)
+            return label_nb, label_nn
+
+        elif row_type in [TYPE_PERSON, TYPE_PERSON_SUBJECT]:
+            label = self._get_label_and_detail_frame(df)
+            for column, delim in [('numeration', ' '), ('nationality', INNER_DELIM),
+                                  ('title', QUA_DELIM), ('date', INNER_DELIM)]:
+                value = _column(df, column)
+                label = _append(label, value.notnull(), delim + value.fillna(''), delim + value.fillna(''))
+            return label
+
+        elif row_type in [TYPE_CORPORATION, TYPE_CORPORATION_SUBJECT]:
+            label = self._get_label_and_detail_frame(df)
+            unit_nb, unit_nn, unit_mask = _lang_columns(df, 'sub_unit')
+            if self.transform:
+                return (label[0].where(~unit_mask, unit_nb + ' (' + label[0] + ')'),
+                        label[1].where(~unit_mask, unit_nn + ' (' + label[1] + ')'))
+            return _append(label, unit_mask, SUB_DELIM + unit_nb, SUB_DELIM + unit_nn)
+
+        elif row_type in [TYPE_EVENT, TYPE_EVENT_SUBJECT]:
+            label_nb, label_nn, _ = _lang_columns(df, 'label')
+            label = (label_nb, label_nn)
+            for column, delim in [('event_no', ' '), ('event_date', INNER_DELIM)]:
+                value = _column(df, column)
+                label = _append(label, value.notnull(), delim + value.fillna(''), delim + value.fillna(''))
+            detail_nb, detail_nn, detail_mask = _lang_columns(df, 'detail')
+            return _append(label, detail_mask, ' (' + detail_nb + ')', ' (' + detail_nn + ')')
+
+        elif row_type in [TYPE_WORK]:
+            label_nb, label_nn, _ = _lang_columns(df, 'label')
+            label = (label_nb, label_nn)
+            for column in ['language', 'creator_name']:
+                value = _column(df, column)
+                label = _append(label, value.notnull(), ' (' + value.fillna('') + ')', ' (' + value.fillna('') + ')')
+            return label
+
+        return self._get_label_and_detail_frame(df)
+
+    def _get_geographic_label_frame(self, df: pd.DataFrame, row_type: str,
+                                    include_subdivisions: bool) -> Tuple[pd.Series, pd.Series, pd.Series]:
+        """
+        Vectorized version of get_geographic_label. Returns (nb, nn, mask), where mask is true
+        for the rows that have a geographic part.
+        """
+        if include_subdivisions:
+            geo_nb, geo_nn, geo_mask = _subdivision_columns(df, 'sub_geo')
+        else:
+            geo_nb = geo_nn = pd.Series([[]] * len(df), index=df.index, dtype=object)
+            geo_mask = pd.Series(False, index=df.index)
+
+        if row_type == TYPE_GEOGRAPHIC:
+            base_nb, base_nn = self._get_label_and_detail_frame(df)
+            mask = pd.Series(True, index=df.index)
+        else:
+            base_nb = base_nn = pd.Series('', index=df.index, dtype=object)
+            mask = geo_mask
+
+        out = []
+        for base, parts in [(base_nb, geo_nb), (base_nn, geo_nn)]:
+            if self.transform:
+                # "Norge - Oslo - Grønland" → "Grønland (Oslo, Norge)"
+                rest = parts.str[:-1].str[::-1].str.join(INNER_DELIM)
+                if row_type == TYPE_GEOGRAPHIC:
+                    rest = base.where(parts.str.len() <= 1, rest + INNER_DELIM + base)
+                    has_rest = geo_mask
+                else:
+                    has_rest = geo_mask & (parts.str.len() > 1)
+                label = base.where(~geo_mask, parts.str[-1])
+                out.append(label.where(~has_rest, label + ' (' + rest + ')'))
+            else:
+                joined = parts.str.join(SUB_DELIM)
+                if row_type == TYPE_GEOGRAPHIC:
+                    out.append(base.where(~geo_mask, base + SUB_DELIM + joined))
+                else:
+                    out.append(joined.where(geo_mask, ''))
+
+        return out[0], out[1], mask
 
     def get_geographic_label(self, row: DataRow, include_subdivisions) -> LanguageMap:
         """
@@ -120,8 +331,10 @@ class LabelFactory:
         if self.transform:
             label = parts.pop()
             if len(parts) > 0:
-                label.nb += ' (%s)' % ', '.join([part.nb for part in parts[::-1]])
-                label.nn += ' (%s)' % ', '.join([part.nn for part in parts[::-1]])
+                label = LanguageMap(
+                    nb='%s (%s)' % (label.nb, ', '.join([part.nb for part in parts[::-1]])),
+                    nn='%s (%s)' % (label.nn, ', '.join([part.nn for part in parts[::-1]]))
+                )
         else:
             label = LanguageMap(
                 nb=SUB_DELIM.join([part.nb for part in parts]),
@@ -140,11 +353,11 @@ class LabelFactory:
 
         if sub_unit := row.get_lang_map('sub_unit'):
             if self.transform:
-                label.nb = sub_unit.nb + ' (%s)' % label.nb
-                label.nn = sub_unit.nn + ' (%s)' % label.nn
+                label = LanguageMap(nb='%s (%s)' % (sub_unit.nb, label.nb),
+                                    nn='%s (%s)' % (sub_unit.nn, label.nn))
             else:
-                label.nb += SUB_DELIM + sub_unit.nb
-                label.nn += SUB_DELIM + sub_unit.nn
+                label = LanguageMap(nb=SUB_DELIM.join([label.nb, sub_unit.nb]),
+                                    nn=SUB_DELIM.join([label.nn, sub_unit.nn]))
 
         # if pd.notnull(self.work_title):
         #     # Tittel på lover og musikkalbum (nynorsk-variant finnes ikke)
@@ -162,21 +375,24 @@ class LabelFactory:
         """
         label = self.get_label_and_detail(row)
 
+        # The person name components are the same in both languages
+        parts: List[str] = []
+
         if numeration := row.get('numeration'):
-            label.nb += ' ' + numeration
-            label.nn += ' ' + numeration
+            parts += [' ', numeration]
 
         if nationality := row.get('nationality'):
-            label.nb += INNER_DELIM + nationality
-            label.nn += INNER_DELIM + nationality
+            parts += [INNER_DELIM, nationality]
 
         if title := row.get('title'):
-            label.nb += QUA_DELIM + title
-            label.nn += QUA_DELIM + title
+            parts += [QUA_DELIM, title]
 
         if date := row.get('date'):
-            label.nb += INNER_DELIM + date
-            label.nn += INNER_DELIM + date
+            parts += [INNER_DELIM, date]
+
+        if len(parts):
+            suffix = ''.join(parts)
+            label = LanguageMap(nb=label.nb + suffix, nn=label.nn + suffix)
 
         # OBS, OBS: Ikke bare enkeltpersoner. Typ "slekten", "familien"
 
@@ -207,28 +423,30 @@ class LabelFactory:
         """
         # 1. Navn ($a)
         label = row.get_lang_map('label')
+        nb: List[str] = [label.nb]
+        nn: List[str] = [label.nn]
 
         # Nummer for arrangement (X11 $n)
         if event_no := row.get('event_no'):
-            label.nb += ' ' + event_no
-            label.nn += ' ' + event_no
+            nb += [' ', event_no]
+            nn += [' ', event_no]
 
         # Dato for arrangement (X11 $d)
         if event_date := row.get('event_date'):
-            label.nb += INNER_DELIM + event_date
-            label.nn += INNER_DELIM + event_date
+            nb += [INNER_DELIM, event_date]
+            nn += [INNER_DELIM, event_date]
 
         # 2. Forklarende tilføyelse i parentes
         if detail := row.get_lang_map('detail'):
-            label.nb += ' (%s)' % detail.nb
-            label.nn += ' (%s)' % detail.nn
+            nb += [' (', detail.nb, ')']
+            nn += [' (', detail.nn, ')']
 
         # Lokasjon for arrangement (X11 $c)
         # if event_location := row.get('event_location'):
         #     label.nb += QUA_DELIM + event_location
         #     label.nn += QUA_DELIM + event_location
 
-        return label
+        return LanguageMap(nb=''.join(nb), nn=''.join(nn))
 
     def get_work_label(self, row: DataRow) -> LanguageMap:
         """
@@ -236,13 +454,16 @@ class LabelFactory:
         combined into a single string.
         """
         label = row.get_lang_map('label')
+        parts: List[str] = []
 
         if language := row.get('language'):
-            label.nb += f" ({language})"
-            label.nn += f" ({language})"
+            parts.append(f" ({language})")
 
         if creator_name := row.get('creator_name'):
-            label.nb += f" ({creator_name})"
-            label.nn += f" ({creator_name})"
+            parts.append(f" ({creator_name})")
+
+        if len(parts):
+            suffix = ''.join(parts)
+            label = LanguageMap(nb=label.nb + suffix, nn=label.nn + suffix)
 
         return label
@@ -0,0 +1,88 @@
+"""
+Construction of entities in worker processes.
+
+Each table is split into chunks of entity groups (see `PromusTable.entity_groups`), and each chunk is
+handed to a worker process. The tables are not sent to the workers, but inherited when the workers are
+forked. The workers return the entities without their DataRows (which can't be pickled), together with
+the position of the main row, and the rows are reattached in the parent. The chunks are assembled in
+the same order as in the sequential path, so the resulting collections are identical.
+
+The labels are constructed in the parent before forking (see `PromusTable.make_labels`), so the workers
+inherit them, and the parent doesn't have to construct them again when adding relations.
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Dict, Generator, List, Optional, Tuple
+
+from .label import LabelFactory
+
+if TYPE_CHECKING:
+    from .entity_service import Entity
+    from .promus_service import EntityGroups, PromusTable
+
+log = logging.getLogger(__name__)
+
+# Worker process state, set by _init_worker
+_tables: Dict[str, PromusTable] = {}
+_groups: Dict[str, EntityGroups] = {}
+_label_factory: Optional[LabelFactory] = None
+
+
+def _init_worker(tables: Dict[str, PromusTable], groups: Dict[str, EntityGroups], label_factory: LabelFactory):
+    global _tables, _groups, _label_factory
+    _tables = tables
+    _groups = groups
+    _label_factory = label_factory
+
+
+def _make_entities_chunk(table_type: str, start: int, stop: int) -> List[Tuple[int, Entity]]:
+    table = _tables[table_type]
+    out = []
+    for position, entity in table.make_positioned_entities(_label_factory, _groups[table_type], start, stop):
+        entity.row = None
+        out.append((position, entity))
+    return out
+
+
+def make_chunks(groups: Dict[str, EntityGroups], chunk_size: int) -> List[Tuple[str, int, int]]:
+    # Split each table into chunks of at most chunk_size entity groups, as (table_type, start, stop)
+    chunks = []
+    for table_type, table_groups in groups.items():
+        n = len(table_groups.starts)
+        for start in range(0, n, chunk_size):
+            chunks.append((table_type, start, min(start + chunk_size, n)))
+    return chunks
+
+
+def make_entities_parallel(tables: Dict[str, PromusTable], label_factory: Optional[LabelFactory], workers: int,
+                           chunk_size: int = 20000) -> Generator[Tuple[PromusTable, List[Entity]]]:
+    """
+    Make entities from all the tables using a pool of worker processes.
+    Yields tuples (table, list of entities) for each chunk, in table order.
+    """
+    if label_factory is not None:
+        for table in tables.values():
+            table.make_labels(label_factory)
+    groups = {table.type: table.entity_groups() for table in tables.values()}
+    chunks = make_chunks(groups, chunk_size)
+    log.info('Constructing entities from %d tables in %d chunks using %d workers', len(tables), len(chunks), workers)
+
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker,
+                             initargs=(tables, groups, label_factory)) as executor:
+        futures = [executor.submit(_make_entities_chunk, *chunk) for chunk in chunks]
+
+        # While the workers are busy, prepare the rows to reattach to the entities
+        rows = {table.type: list(table.df.itertuples()) for table in tables.values()}
+
+        for (table_type, start, stop), future in zip(chunks, futures):
+            table = tables[table_type]
+            table_rows = rows[table_type]
+            entities = []
+            for position, entity in future.result():
+                entity.row = table.make_row(table_rows[position], table.subdivisions)
+                entities.append(entity)
+            yield table, entities
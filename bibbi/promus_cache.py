@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 import time
 import datetime
 from pathlib import Path
@@ -28,17 +29,36 @@ class PromusCache:
     def filename(self, table: PromusTable) -> Path:
         return Path('%s/%s.feather' % (self.path, table.type))
 
+    def references_filename(self, table: PromusTable) -> Path:
+        return Path('%s/%s.references.json' % (self.path, table.type))
+
     def extract(self, table: PromusTable):
         df = feather.read_dataframe(self.filename(table))
         df.set_index(table.index_column, drop=False, inplace=True)
         log.info('[%s] Loaded %d x %d table from cache',
                  table.type, df.shape[0], df.shape[1])
         table.df = df
+        self.extract_references(table)
         table.after_load_from_cache()
         return table
 
+    def extract_references(self, table: PromusTable):
+        # Restore the resolved reference map, if it was stored together with the current table data
+        references_file = self.references_filename(table)
+        if not hasattr(table, 'references') or not references_file.exists():
+            return
+        if references_file.stat().st_mtime < self.filename(table).stat().st_mtime:
+            log.info('[%s] Cached reference map is older than the table, ignoring it', table.type)
+            return
+        with references_file.open(encoding='utf-8') as fp:
+            table.references.from_dict(json.load(fp))
+        log.info('[%s] Loaded reference map from cache: %d references', table.type, len(table.references))
+
     def store(self, table: PromusTable):
         feather.write_dataframe(table.df, self.filename(table))
+        if hasattr(table, 'references'):
+            with self.references_filename(table).open('w', encoding='utf-8') as fp:
+                json.dump(table.references.to_dict(), fp)
         log.info('[%s] Saved %d x %d table to cache',
                  table.type, table.df.shape[0], table.df.shape[1])
         return table
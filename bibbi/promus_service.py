@@ -4,8 +4,10 @@ import re
 import sys
 from collections import namedtuple
 from dataclasses import fields
-from typing import Optional, Generator, List, Dict
+from functools import lru_cache
+from typing import Any, Optional, Generator, List, Dict, NamedTuple, Tuple, Union
 
+import numpy as np
 import pandas as pd
 from rdflib import Namespace, URIRef
 
@@ -15,13 +17,51 @@ from bibbi.label import LabelFactory
 
 from .constants import TYPE_GEOGRAPHIC, TYPE_PERSON, TYPE_TITLE_SUBJECT, TYPE_TITLE, TYPE_PERSON_SUBJECT, \
     TYPE_CORPORATION, TYPE_LAW, TYPE_CORPORATION_SUBJECT, TYPE_DEMOGRAPHIC_GROUP, TYPE_FICTIVE_PERSON, TYPE_EVENT, \
-    TYPE_EVENT_SUBJECT, TYPE_WORK
+    TYPE_EVENT_SUBJECT, TYPE_WORK, SUBDIV_SPLIT
 from .db import Db
 from .util import trim, to_str, LanguageMap
-from .references import ReferenceMap
+from .references import ReferenceMap, resolve_references
 
 log = logging.getLogger(__name__)
 
+SUBDIV_PATTERN = re.compile(SUBDIV_SPLIT)
+SUBDIV_TYPES = ['sub_geo', 'sub_topic', 'sub_unit']
+
+
+class Subdivisions(NamedTuple):
+    # Individual subdivisions of a row as (nb, nn) pairs. If the number of subdivisions differs
+    # between nb and nn, the subdivisions are misaligned, and the nb values are used for nn.
+    parts: Tuple[Tuple[str, str], ...]
+    misaligned: bool
+
+
+class EntityGroups(NamedTuple):
+    # The rows of a table grouped into entities. Each group is a contiguous slice
+    # positions[starts[n]:ends[n]] of row positions, where the first main_counts[n] rows are
+    # main rows (normally one), and the rest are references to the same entity.
+    keys: List[str]
+    positions: np.ndarray
+    starts: List[int]
+    ends: List[int]
+    main_counts: List[int]
+
+
+@lru_cache(maxsize=10000)
+def split_subdivisions(nb: str, nn: Optional[str]) -> Subdivisions:
+    nb_parts = SUBDIV_PATTERN.split(nb)
+    nn_parts = SUBDIV_PATTERN.split(nn) if nn is not None else []
+    if len(nb_parts) == len(nn_parts):
+        return Subdivisions(tuple(zip(nb_parts, nn_parts)), False)
+    return Subdivisions(tuple((part, part) for part in nb_parts), len(nn_parts) != 0)
+
+
+def warn_misaligned_subdivisions(subdiv_type: str, entity_id: str, subdivisions: Subdivisions, nn: str):
+    log.warning('Number of "%s" subdivisions differs for %s: "%s"@nb != "%s"@nn',
+                subdiv_type,
+                entity_id,
+                ' - '.join([part[0] for part in subdivisions.parts]),
+                ' - '.join(SUBDIV_PATTERN.split(nn)))
+
 
 class PromusService:
 
@@ -63,11 +103,14 @@ class PromusService:
 class DataRow:
     # Wrapper around a DataFrame row that adds domain specific methods for data extraction
 
-    def __init__(self, data: namedtuple, row_type: str, index_column: str, display_column: str):
+    def __init__(self, data: namedtuple, row_type: str, index_column: str, display_column: str,
+                 subdivisions: Optional[Dict[str, Dict[str, Subdivisions]]] = None):
         self.data = data
         self.type = row_type
         self.index_column = index_column
         self.display_column = display_column
+        # Subdivisions parsed in bulk by the table, {subdiv_type: {row_id: Subdivisions}}
+        self._subdivisions = subdivisions
 
     def __getattr__(self, key):
         return getattr(self.data, key)
@@ -122,34 +165,38 @@ class DataRow:
             return False
         return True
 
-    def get_subdivisions(self, subdiv_type: str):
+    def get_subdivision_parts(self, subdiv_type: str) -> Optional[Subdivisions]:
         """
-        Generates list of individual subdivisions as language maps.
+        Get the individual subdivisions of a given type, or None if the row has none.
 
         Args:
             subdiv_type (str): A valid subdivision type ('sub_topic', 'sub_geo' or 'sub_unit')
         """
-        if subdiv_type not in ['sub_geo', 'sub_topic', 'sub_unit']:
+        if subdiv_type not in SUBDIV_TYPES:
             raise ValueError('Invalid subdivision type: %s', subdiv_type)
+        if self._subdivisions is not None and subdiv_type in self._subdivisions:
+            # Parsed when the table was loaded
+            return self._subdivisions[subdiv_type].get(self.data.row_id)
         if not self.has(subdiv_type):
+            return None
+        nn = self.get(subdiv_type + '_nn')
+        subdivisions = split_subdivisions(self.get(subdiv_type), nn)
+        if subdivisions.misaligned:
+            warn_misaligned_subdivisions(subdiv_type, self.data.bibsent_id, subdivisions, nn)
+        return subdivisions
+
+    def get_subdivisions(self, subdiv_type: str):
+        """
+        Generates list of individual subdivisions as language maps.
+
+        Args:
+            subdiv_type (str): A valid subdivision type ('sub_topic', 'sub_geo' or 'sub_unit')
+        """
+        subdivisions = self.get_subdivision_parts(subdiv_type)
+        if subdivisions is None:
             return
-        nb_parts = re.split(r' - |\$z|\$x', self.get(subdiv_type))
-        nn_parts = []
-        if self.has(subdiv_type + '_nn'):
-            nn_parts = re.split(r' - |\$z|\$x', self.get(subdiv_type + '_nn'))
-        for k, part in enumerate(nb_parts):
-            if len(nb_parts) == len(nn_parts):
-                yield LanguageMap(nb=part, nn=nn_parts[k])
-            else:
-                if len(nn_parts) != 0:
-                    log.warning('Number of "%s" subdivisions differs for %s: "%s"@nb != "%s"@nn',
-                                subdiv_type,
-                                self.data.bibsent_id,
-                                # self.get('label'),
-                                ' - '.join(nb_parts),
-                                # self.get('label_nn') or self.get('label'),
-                                ' - '.join(nn_parts))
-                yield LanguageMap(nb=part, nn=part)  # fallback to nb for nn
+        for nb, nn in subdivisions.parts:
+            yield LanguageMap(nb=nb, nn=nn)
 
     def get_qualifier(self):
         return LanguageMap(nb=self.data.qualifier, nn=self.data.qualifier_nn)
@@ -173,6 +220,7 @@ class PromusTable:
 
     def __init__(self, df: Optional[pd.DataFrame] = None):
         self.df = df or pd.DataFrame()
+        self.subdivisions: Dict[str, Dict[str, Subdivisions]] = {}
 
     def get_select_query(self) -> str:
         return 'SELECT * FROM dbo.%s' % self.table_name
@@ -183,48 +231,146 @@ class PromusTable:
     def after_load_from_cache(self):
         return self
 
+    def parse_subdivisions(self):
+        """
+        Parse the subdivisions of all rows in bulk, so that DataRow.get_subdivisions don't have to
+        split the same strings over and over again.
+        """
+        self.subdivisions = {}
+        for subdiv_type in SUBDIV_TYPES:
+            if subdiv_type not in self.df.columns:
+                continue
+            nn_column = subdiv_type + '_nn'
+            df = self.df[self.df[subdiv_type].notnull()]
+            nb_values = df[subdiv_type].tolist()
+            nn_values = df[nn_column].where(df[nn_column].notnull(), None).tolist() \
+                if nn_column in df.columns else [None] * len(df)
+            parsed = {}
+            misaligned = 0
+            for row_id, entity_id, nb, nn in zip(df.row_id, df[self.index_column], nb_values, nn_values):
+                subdivisions = split_subdivisions(nb, nn)
+                if subdivisions.misaligned:
+                    warn_misaligned_subdivisions(subdiv_type, entity_id, subdivisions, nn)
+                    misaligned += 1
+                parsed[row_id] = subdivisions
+            self.subdivisions[subdiv_type] = parsed
+            log.info('[%s] Parsed "%s" subdivisions for %d rows (%d misaligned)',
+                     self.type, subdiv_type, len(parsed), misaligned)
+
     @classmethod
-    def make_row(cls, values: namedtuple) -> DataRow:
-        return DataRow(values, cls.type, cls.index_column, cls.display_column)
+    def make_row(cls, values: namedtuple, subdivisions: Optional[Dict[str, Dict[str, Subdivisions]]] = None) -> DataRow:
+        return DataRow(values, cls.type, cls.index_column, cls.display_column, subdivisions)
 
     def get_row(self, row_id: str) -> DataRow:
-        return self.make_row(self.df.loc[str(row_id)])
+        return self.make_row(self.df.loc[str(row_id)], self.subdivisions)
 
     def rows(self) -> Generator[DataRow]:
         """
         DataRow generator
         """
         for row in self.df.itertuples():  # Note: itertuples is *much* faster than iterrows! Cut loading time from 28s to 4s
-            yield self.make_row(row)
+            yield self.make_row(row, self.subdivisions)
 
     def search(self, value: str) -> Generator[DataRow]:
         results = self.df[self.df.apply(lambda row: row.str.contains(value, case=False).any(), axis=1)]
         for res in results.itertuples():
-            yield self.make_row(res)
+            yield self.make_row(res, self.subdivisions)
 
     def get_entity_id(self, row) -> str:
         return row[self.index_column]
 
-    def make_entities(self):
-        for row in self.rows():
-            kwargs = {
-                'id': self.get_entity_id(row),
-                'local_id': row['row_id'],
-                'row': row,
-                'namespace': self.namespace,
-                'type': row.type,
-                'source_type': row.type,
-                'pref_label': LanguageMap(nb=row.label, nn=row.label),
-                'alt_labels': [],
-            }
-            for field in fields(self.entity_class):
-                if field.name == 'approved' and field.name not in row:
-                    # Auto-approve form/genre terms that lack the 'approved' field
-                    kwargs['approved'] = '1'
-                elif field.name not in kwargs and field.name in row and pd.notnull(row[field.name]):
-                    kwargs[field.name] = row[field.name]
+    def entity_groups(self) -> EntityGroups:
+        """
+        Group the rows of the table into entities. By default, each row is an entity.
+        """
+        n = self.df.shape[0]
+        return EntityGroups(self.df[self.index_column].tolist(), np.arange(n), list(range(n)),
+                            list(range(1, n + 1)), [1] * n)
+
+    def iter_groups(self, groups: EntityGroups, start: int = 0, stop: Optional[int] = None) \
+            -> Generator[Tuple[str, int, Optional[DataRow], List[DataRow]]]:
+        """
+        Iterate over the groups number start to stop, yielding tuples
+        (entity ID, main row position, main row, [reference row 1, reference row 2, ...]), where
+        main row is None (and the position -1) if the group only contains references.
+        """
+        stop = len(groups.starts) if stop is None else stop
+        if start >= stop:
+            return
+        positions = groups.positions[groups.starts[start]:groups.ends[stop - 1]]
+        offset = groups.starts[start]
+
+        make_row = self.make_row
+        subdivisions = self.subdivisions
+        if len(positions) == self.df.shape[0]:
+            # Note: Reordering the list is faster than calling itertuples on the reordered DataFrame
+            rows = [make_row(row, subdivisions) for row in self.df.itertuples()]
+            rows = [rows[n] for n in positions.tolist()]
+        else:
+            # Only construct the rows needed for this range of groups (read in table order)
+            sorted_positions = np.sort(positions)
+            rows = dict(zip(sorted_positions.tolist(), self.df.iloc[sorted_positions].itertuples()))
+            rows = [make_row(rows[n], subdivisions) for n in positions.tolist()]
+
+        for n in range(start, stop):
+            group_start, group_end, main_count = groups.starts[n] - offset, groups.ends[n] - offset, groups.main_counts[n]
+            if main_count == 0:
+                yield groups.keys[n], -1, None, rows[group_start:group_end]
+            else:
+                # If there are duplicate main rows, the last one wins
+                main = group_start + main_count - 1
+                yield groups.keys[n], int(positions[main]), rows[main], rows[main + 1:group_end]
 
-            yield self.entity_class(**kwargs)
+    def make_entity(self, label_factory: LabelFactory, main_row: DataRow, reference_rows: List[DataRow]) -> Optional[Entity]:
+        kwargs = {
+            'id': self.get_entity_id(main_row),
+            'local_id': main_row['row_id'],
+            'row': main_row,
+            'namespace': self.namespace,
+            'type': main_row.type,
+            'source_type': main_row.type,
+            'pref_label': LanguageMap(nb=main_row.label, nn=main_row.label),
+            'alt_labels': [],
+        }
+        for field in fields(self.entity_class):
+            if field.name == 'approved' and field.name not in main_row:
+                # Auto-approve form/genre terms that lack the 'approved' field
+                kwargs['approved'] = '1'
+            elif field.name not in kwargs and field.name in main_row and pd.notnull(main_row[field.name]):
+                kwargs[field.name] = main_row[field.name]
+
+        return self.entity_class(**kwargs)
+
+    def make_labels(self, label_factory: LabelFactory):
+        """
+        Construct the labels of all rows in one vectorized pass, and add them to the label cache.
+        """
+        n = label_factory.cache_frame(self.df, self.type)
+        log.info('[%s] Constructed %d labels', self.type, n)
+
+    def make_entities(self, label_factory: Optional[LabelFactory] = None, groups: Optional[EntityGroups] = None,
+                      start: int = 0, stop: Optional[int] = None) -> Generator[Entity]:
+        """
+        Make entities from the table, or from the groups number start to stop if given.
+        """
+        for position, entity in self.make_positioned_entities(label_factory, groups, start, stop):
+            yield entity
+
+    def make_positioned_entities(self, label_factory: Optional[LabelFactory] = None,
+                                 groups: Optional[EntityGroups] = None, start: int = 0,
+                                 stop: Optional[int] = None) -> Generator[Tuple[int, Entity]]:
+        """
+        Same as make_entities, but yields tuples (main row position, entity).
+        """
+        label_factory = label_factory or LabelFactory()
+        groups = groups or self.entity_groups()
+        for entity_id, position, main_row, reference_rows in self.iter_groups(groups, start, stop):
+            if main_row is None:
+                log.warning('Ignoring entity without pref label: %s', entity_id)
+                continue
+            entity = self.make_entity(label_factory, main_row, reference_rows)
+            if entity is not None:
+                yield position, entity
 
 
 class PromusAuthorityTable(PromusTable):
@@ -286,45 +432,53 @@ class PromusAuthorityTable(PromusTable):
         log.info('[%s] Table extended to %d x %d', self.type, self.df.shape[0], self.df.shape[1])
         print(self.df.dtypes)
 
-        self.validate_references()
-        self.references.load(self)
+        resolved = self.validate_references()
+        self.references.load(self, resolved)
+        self.parse_subdivisions()
         return self
 
     def after_load_from_cache(self):
-        self.references.load(self)
+        if not self.references.loaded:
+            self.references.load(self)
+        self.parse_subdivisions()
 
-    def validate_references(self):
+    def validate_references(self) -> Dict[str, str]:
         """
         Validate references and remove rows containing invalid ones.
+
+        A reference is invalid if it points to a row that doesn't exist, to itself, or is part of
+        a reference cycle. References pointing to an invalid reference are also invalid, no matter
+        the length of the chain (If A -> B and B -> NULL, both A and B are invalid).
+
+        Returns the resolved references of the remaining rows, as a map `{row_id: main_row_id}`,
+        so that the reference map can be built without parsing the references again.
         """
-        ids = set(self.df.row_id.tolist())
+        if 'ref_id' not in self.df.columns:
+            return {}
+        ids = set(self.df.row_id)
         df_refs = self.df[self.df.ref_id.notnull()]
         refs = dict(zip(df_refs.row_id, df_refs.ref_id))
-        invalid = set()
-        for n in range(5):
-            # If A -> B and B -> NULL, the first pass will mark B as invalid
-            # and the second pass will mark A as invalid.
-            # We also mark self-references (A -> A)
-            log.info('[%s] Validating references: Pass %d', self.type, n + 1)
-            n1 = len(invalid)
-            for k, v in refs.items():
-                if k == v or v not in ids or v in invalid:
-                    invalid.add(k)
-                    # del refs[k]
-            n2 = len(invalid)
-            if n1 == n2:
-                break
+
+        # Each chain ends either in a main entry, a missing row or a cycle
+        resolved, cycles, invalid = resolve_references(refs)
+        for cycle in cycles:
+            log.error('[%s] Reference cycle: %s', self.type, ' -> '.join(cycle + cycle[:1]))
+        for row_id, target in resolved.items():
+            if target not in ids:
+                invalid.add(row_id)
+        resolved = {k: v for k, v in resolved.items() if k not in invalid}
 
         log.info('[%s] %d out of %d references were invalid', self.type, len(invalid), len(refs))
 
         # Remove all invalid rows
         rows_before = self.df.shape[0]
-        self.df = self.df[~self.df.row_id.isin(list(invalid))]
+        self.df = self.df[~self.df.row_id.isin(invalid)]
         rows_after = self.df.shape[0]
         if rows_before == rows_after:
             log.info('[%s] Validated dataframe', self.type)
         else:
             log.info('[%s] Validated dataframe. Rows reduced from %d to %d', self.type, rows_before, rows_after)
+        return resolved
 
     def normalize_row(self, row):
         """
@@ -382,33 +536,75 @@ class PromusAuthorityTable(PromusTable):
         results = self.df.query(query)
 
         for res in results.itertuples():
-            yield self.make_row(res)
+            yield self.make_row(res, self.subdivisions)
 
-    def _group_references(self) -> Dict[str, List[DataRow]]:
+    def entity_groups(self) -> EntityGroups:
         """
-        Group main entries and all references to each entry together, using a single for loop.
-        Returns the following structure:
-        {
-            "bibbi_id for main row": [main row, reference row 1, reference row 2, ...]
-        }
+        Group main entries and all references to each entry together.
+
+        The reference targets are resolved for the whole table at once, and the rows are sorted so that
+        each group forms a contiguous slice, with the main row first and then the references (in table order).
+        Groups are ordered by their first appearance in the table.
         """
-        out = {}
+        df = self.df
+        if df.shape[0] == 0:
+            return EntityGroups([], np.arange(0), [], [], [])
+        targets = self.references.get_all(df.bibsent_id)
+        is_ref = targets.notnull().to_numpy()
+        keys = targets.where(is_ref, df[self.index_column]).to_numpy()
+        codes, _ = pd.factorize(keys, sort=False)
+
+        # Stable sort by group, then main rows before references
+        order = np.lexsort((is_ref, codes))
+        codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)]
+        main_counts = np.add.reduceat((~is_ref[order]).astype(int), starts)
+
+        return EntityGroups(keys[order][starts].tolist(), order, starts.tolist(), ends.tolist(), main_counts.tolist())
+
+    # The fields get_entity_type depends on
+    entity_type_fields = ['bibsent_id', 'bs_nasj_id', 'detail', 'felles_id', 'work_title', 'work_title_part',
+                          'webdewey_nr', 'ddk5_nr', 'law']
+
+    @staticmethod
+    def get_entity_type(row_type: str, row: Union[DataRow, Dict[str, Any]]) -> str:
+        """
+        Get the entity type of a main row. The row can be a DataRow, or a dict with None for null values.
+        """
+        entity_type = row_type
+
+        if row.get('bs_nasj_id') is not None:
+            entity_type = TYPE_DEMOGRAPHIC_GROUP
 
-        for row in self.rows():
-            bibbi_id = self.refers_to(row)
-            if bibbi_id is not None:
-                if bibbi_id not in out:
-                    out[bibbi_id] = [None, row]
+        if row.get('detail') == 'fiktiv person':
+            entity_type = TYPE_FICTIVE_PERSON
+
+        if row.get('felles_id') is not None and row.get('felles_id') != row.get('bibsent_id'):
+            # Biautoriteter
+
+            if row_type == TYPE_PERSON:
+                if row.get('work_title') is not None or row.get('work_title_part') is not None:
+                    if row.get('webdewey_nr') or row.get('ddk5_nr'):
+                        entity_type = TYPE_TITLE_SUBJECT
+                    else:
+                        entity_type = TYPE_TITLE
                 else:
-                    out[bibbi_id] += [row]
-            else:
-                bibbi_id = self.get_entity_id(row)
-                if bibbi_id not in out:
-                    out[bibbi_id] = [row]
+                    entity_type = TYPE_PERSON_SUBJECT
+
+            elif row_type == TYPE_CORPORATION:
+                if row.get('work_title') is not None:
+                    if row.get('law') == '1':
+                        entity_type = TYPE_LAW
+                    #else:
+                    #    entity_type = TYPE_LAW or TYPE_MUSICALBUM or other?
                 else:
-                    out[bibbi_id][0] = row
+                    entity_type = TYPE_CORPORATION_SUBJECT
+
+            elif row_type == TYPE_EVENT:
+                entity_type = TYPE_EVENT_SUBJECT
 
-        return out
+        return entity_type
 
     def make_entity(self, label_factory: LabelFactory, main_row: DataRow, reference_rows: List[DataRow]) -> Optional[Entity]:
         entity_id = main_row[self.index_column]
@@ -434,11 +630,7 @@ class PromusAuthorityTable(PromusTable):
         if not main_row.is_main_entry():
             kwargs['complex'] = True
 
-        if main_row.has('bs_nasj_id'):
-            kwargs['type'] = TYPE_DEMOGRAPHIC_GROUP
-
-        if main_row.get('detail') == 'fiktiv person':
-            kwargs['type'] = TYPE_FICTIVE_PERSON
+        kwargs['type'] = self.get_entity_type(main_row.type, main_row)
 
         if main_row.has('date'):
             kwargs['date'] = main_row.get('date')
@@ -465,31 +657,9 @@ class PromusAuthorityTable(PromusTable):
             elif main_row.type == TYPE_CORPORATION:
                 kwargs['name'] = LanguageMap(nb=main_row.label, nn=main_row.label_nn)
 
-        if main_row.has('felles_id') and main_row.get('felles_id') != main_row.get('bibsent_id'):
-            # Biautoriteter
-
-            if main_row.type == TYPE_PERSON:
-                if main_row.has('work_title') or main_row.has('work_title_part'):
-                    if main_row.get('webdewey_nr') or main_row.get('ddk5_nr'):
-                        kwargs['type'] = TYPE_TITLE_SUBJECT
-                    else:
-                        kwargs['type'] = TYPE_TITLE
-                else:
-                    kwargs['type'] = TYPE_PERSON_SUBJECT
-
-            elif main_row.type == TYPE_CORPORATION:
-                if main_row.has('work_title'):
-                    if main_row.law == '1':
-                        kwargs['type'] = TYPE_LAW
-                        kwargs['legislation'] = LanguageMap(nb=main_row.label, nn=main_row.label_nn)
-                        # OBS: Alle lovene har samme Felles_ID ! De er altså alle biautoriteter uten en hovedautoritet
-                    #else:
-                    #    kwargs['type'] = TYPE_LAW or TYPE_MUSICALBUM or other?
-                else:
-                    kwargs['type'] = TYPE_CORPORATION_SUBJECT
-
-            elif main_row.type == TYPE_EVENT:
-                kwargs['type'] = TYPE_EVENT_SUBJECT
+        if kwargs['type'] == TYPE_LAW:
+            kwargs['legislation'] = LanguageMap(nb=main_row.label, nn=main_row.label_nn)
+            # OBS: Alle lovene har samme Felles_ID ! De er altså alle biautoriteter uten en hovedautoritet
 
         for field in fields(self.entity_class):
             if field.name not in kwargs:
@@ -499,17 +669,6 @@ class PromusAuthorityTable(PromusTable):
                 #     kwargs[field.name] = None
         return self.entity_class(**kwargs)
 
-    def make_entities(self):
-        label_factory = LabelFactory()
-        grouped_rows = self._group_references()
-        for entity_id, row_group in grouped_rows.items():
-            if row_group[0] is None:
-                log.warning('Ignoring entity without pref label: %s', entity_id)
-                continue
-            entity = self.make_entity(label_factory, row_group[0], row_group[1:])
-            if entity is not None:
-                yield entity
-
 
 class TopicTable(PromusAuthorityTable):
     type = 'topical'
@@ -1,43 +1,123 @@
-import sys
 import logging
-from typing import Optional
+from typing import Optional, Dict, List, Set, Tuple
 
 log = logging.getLogger(__name__)
 
 
+def resolve_references(refs: Dict[str, str]) -> Tuple[Dict[str, str], List[List[str]], Set[str]]:
+    """
+    Compute the transitive closure of a map of references `{from_id: to_id}`, so that each
+    ID maps directly to the main entry at the end of its reference chain.
+
+    Each chain is only followed once: All IDs on a chain are resolved as soon as the end of the
+    chain is found (path compression), and later chains stop as soon as they reach an ID that has
+    already been resolved. The total work is therefore linear in the number of references.
+
+    Returns a tuple (resolved, cycles, broken), where cycles is a list of reference cycles
+    (like A -> B -> A) and broken is the set of IDs that are part of a cycle or lead into one.
+    """
+    resolved: Dict[str, str] = {}
+    cycles: List[List[str]] = []
+    broken: Set[str] = set()
+
+    for start in refs:
+        if start in resolved or start in broken:
+            continue
+        path: List[str] = []
+        on_path: Dict[str, int] = {}
+        node = start
+        while True:
+            if node in resolved:
+                target = resolved[node]
+                break
+            if node in broken:
+                target = None
+                break
+            if node not in refs:
+                # Main entry
+                target = node
+                break
+            if node in on_path:
+                cycles.append(path[on_path[node]:])
+                target = None
+                break
+            on_path[node] = len(path)
+            path.append(node)
+            node = refs[node]
+
+        for node in path:
+            if target is None:
+                broken.add(node)
+            else:
+                resolved[node] = target
+
+    return resolved, cycles, broken
+
+
 class ReferenceMap:
     # Map of references `{from_id: to_id}` where from_id and to_id are Bibsent IDs.
+    # The references are resolved when the map is loaded, so that to_id is always a main entry,
+    # even if the row refers to another row which is also a reference (multiple hops).
 
     def __init__(self):
-        self._map = {}
+        self._map: Dict[str, str] = {}
+        self.cycles: List[List[str]] = []
+        self.loaded = False
+
+    def load(self, table, resolved: Optional[Dict[str, str]] = None):
+        """
+        Build the map from the table's ref_id column.
 
-    def load(self, table):
-        # Build the map
+        :param resolved: Already resolved references `{row_id: main_row_id}`, as returned by
+            `PromusAuthorityTable.validate_references`. If given, the references are not parsed again.
+        """
         df = table.df
         if 'ref_id' not in df.columns:
             log.info('[%s] Skipping reference map generation', table.type)
+            self.loaded = True
             return
+        if resolved is None:
+            df2 = df[df.ref_id.notnull()]
+            resolved, self.cycles, _ = resolve_references(dict(zip(df2.row_id, df2.ref_id)))
+            for cycle in self.cycles:
+                log.error('[%s] Reference cycle: %s', table.type, ' -> '.join(cycle + cycle[:1]))
         bibsent_ids = dict(zip(df.row_id, df.bibsent_id))
-        df2 = df[df.ref_id.notnull()]
-        refs = dict(zip(df2.row_id, df2.ref_id))
-        self._map.update({bibsent_ids[k]: bibsent_ids[v] for k, v in refs.items()})
+        self._map = {
+            bibsent_ids[k]: bibsent_ids[v]
+            for k, v in resolved.items()
+            if k in bibsent_ids and v in bibsent_ids
+        }
+        self.loaded = True
         log.info('[%s] Reference map loaded: %d references', table.type, len(self))
 
+    def update(self, refs: Dict[str, str]):
+        # Add references to the map and resolve all reference chains.
+        # References that are part of a cycle or lead into one are left out of the map.
+        resolved, cycles, broken = resolve_references({**self._map, **refs})
+        self._map = resolved
+        self.cycles = cycles
+        self.loaded = True
+
     def get(self, bibbi_id) -> Optional[str]:
-        # Returns the ID that the row with ID <bibbi_id> refers to, or None if the row is not a reference
-        # In case the row refers to another row which is also a reference (multiple hops), the method
-        # will continue until a main entry row is found.
-        if bibbi_id not in self._map:
-            return None
-        parts = []
-        while bibbi_id in self._map:
-            parts.append(bibbi_id)
-            if len(parts) > 10:
-                log.info('Endless loop!')
-                print(parts)
-                sys.exit(1)
-            bibbi_id = self._map[bibbi_id]
-        return bibbi_id
+        # Returns the ID of the main entry that the row with ID <bibbi_id> refers to,
+        # or None if the row is not a reference.
+        return self._map.get(bibbi_id)
+
+    def get_all(self, bibbi_ids):
+        # Vectorized version of get: Takes a Series of IDs and returns a Series with the ID of
+        # the main entry for each reference, and NaN for rows that are not references.
+        return bibbi_ids.map(self._map)
+
+    def to_dict(self) -> dict:
+        # Serialize the resolved map, for caching
+        return {'map': self._map, 'cycles': self.cycles}
+
+    def from_dict(self, data: dict):
+        # Restore a resolved map serialized with to_dict
+        self._map = data['map']
+        self.cycles = data['cycles']
+        self.loaded = True
+        return self
 
     def __len__(self):
         return len(self._map)
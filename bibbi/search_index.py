@@ -0,0 +1,122 @@
+"""
+Bulk indexing of catalog documents in Elasticsearch.
+
+The documents are split into batches of chunk_size documents, and each batch is sent with
+`helpers.streaming_bulk` from a pool of threads. streaming_bulk retries documents rejected with
+429 (Too Many Requests) with exponential backoff, so a busy cluster slows the indexing down instead
+of failing it. This also applies when the whole request is rejected: With raise_on_exception=False,
+streaming_bulk turns an error on the request (a 429, or a connection error) into a failure for each
+document in it, so the documents are retried or reported like any other failure, and nothing is raised.
+At most 2 * thread_count batches are in flight at a time, so the documents are streamed rather than
+read into memory. Errors are reported per batch.
+"""
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Deque, Generator, Iterable, List, NamedTuple
+
+from elasticsearch import Elasticsearch, helpers
+
+log = logging.getLogger(__name__)
+
+
+class BatchResult(NamedTuple):
+    batch_no: int
+    actions: int
+    errors: List[dict]
+
+
+def make_actions(records: Iterable[dict], index: str) -> Generator[dict, None, None]:
+    """
+    Make bulk actions from catalog documents, or from the delta operations written by the incremental
+    catalog export ({"op": "upsert", "doc": ...} and {"op": "delete", "_id": ...}).
+    """
+    for record in records:
+        op = record.get('op')
+        if op == 'delete':
+            yield {'_op_type': 'delete', '_index': index, '_id': record['_id']}
+            continue
+        doc = record['doc'] if op == 'upsert' else record
+        yield {
+            '_op_type': 'index',
+            '_index': index,
+            '_id': doc['_id'],
+            '_source': {k: v for k, v in doc.items() if k != '_id'},
+        }
+
+
+def make_batches(actions: Iterable[dict], chunk_size: int) -> Generator[List[dict], None, None]:
+    actions = iter(actions)
+    while True:
+        batch = list(islice(actions, chunk_size))
+        if not batch:
+            return
+        yield batch
+
+
+class BulkIndexer:
+
+    def __init__(self, client: Elasticsearch, index: str, chunk_size: int = 500, thread_count: int = 4,
+                 max_retries: int = 5, initial_backoff: float = 2, max_backoff: float = 600):
+        self.client = client
+        self.index_name = index
+        self.chunk_size = chunk_size
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def is_missing_delete(info: dict) -> bool:
+        # Deleting a document that is not in the index is not an error
+        return 'delete' in info and info['delete'].get('status') == 404
+
+    def send_batch(self, batch_no: int, batch: List[dict]) -> BatchResult:
+        errors = [
+            info for ok, info in helpers.streaming_bulk(
+                self.client,
+                batch,
+                chunk_size=len(batch),
+                max_retries=self.max_retries,
+                initial_backoff=self.initial_backoff,
+                max_backoff=self.max_backoff,
+                raise_on_error=False,
+                raise_on_exception=False,
+                yield_ok=False,
+            )
+            if not self.is_missing_delete(info)
+        ]
+        return BatchResult(batch_no, len(batch), errors)
+
+    def index(self, records: Iterable[dict]) -> dict:
+        """
+        Index the records, and return the number of documents indexed and failed.
+        """
+        stats = {'batches': 0, 'ok': 0, 'failed': 0}
+
+        def handle(result: BatchResult):
+            stats['batches'] += 1
+            stats['ok'] += result.actions - len(result.errors)
+            stats['failed'] += len(result.errors)
+            if result.errors:
+                action, info = next(iter(result.errors[0].items()))
+                log.warning('Batch %d: %d of %d actions failed. First error: %s %s: %s',
+                            result.batch_no, len(result.errors), result.actions, action, info.get('status'),
+                            info.get('error'))
+            else:
+                log.debug('Batch %d: %d actions ok', result.batch_no, result.actions)
+
+        pending: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            batches = make_batches(make_actions(records, self.index_name), self.chunk_size)
+            for batch_no, batch in enumerate(batches, start=1):
+                pending.append(executor.submit(self.send_batch, batch_no, batch))
+                if len(pending) >= 2 * self.thread_count:
+                    handle(pending.popleft().result())
+            while pending:
+                handle(pending.popleft().result())
+
+        log.info('Indexed %d documents in %s (%d failed, %d batches)',
+                 stats['ok'], self.index_name, stats['failed'], stats['batches'])
+        return stats
@@ -19,6 +19,9 @@ from ..constants import TYPE_TOPICAL, TYPE_GEOGRAPHIC, TYPE_GENRE, TYPE_PERSON,
     TYPE_WORK
 from ..entity_service import Entity, BibbiEntity, Nation
 
+if TYPE_CHECKING:
+    from ..entity_table import EntityTable
+
 log = logging.getLogger(__name__)
 
 # namespaces: bibbi eller bibsent ?
@@ -45,10 +48,35 @@ class ConceptScheme:
     modified: datetime
 
 
+@dataclass
+class ExportProfile:
+    """
+    A subset of the entities to export to a separate file. An entity is included if it matches all the criteria.
+    """
+    name: str
+    filename: str
+    entity_types: Optional[List[str]] = None
+    concept_group: Optional[str] = None  # 'film', 'spill' or 'nasj'
+    approved_only: bool = False
+
+    def matches(self, entity: Entity) -> bool:
+        if self.entity_types is not None and entity.type not in self.entity_types:
+            return False
+        if self.concept_group is not None:
+            if not isinstance(entity, BibbiEntity):
+                return False
+            if entity.concept_group != self.concept_group and not (
+                    self.concept_group == 'nasj' and entity.type == TYPE_DEMOGRAPHIC_GROUP):
+                return False
+        if self.approved_only and isinstance(entity, BibbiEntity) and entity.approved == '0':
+            return False
+        return True
+
+
 class RdfSerializer:
 
     def __init__(self, graph=None):
-        self.graph = graph or Graph()
+        self.graph = graph if graph is not None else Graph()
         self.staged = []
         self.concept_schemes: List[ConceptScheme] = []
 
@@ -115,14 +143,34 @@ class RdfEntityAndMappingSerializer(RdfEntitySerializer):
 class RdfMappingSerializer(RdfSerializer):
     reverse = False
 
+    def __init__(self, graph=None):
+        super().__init__(graph)
+        self.staged_tables: List[EntityTable] = []
+
+    def add_table(self, table: EntityTable):
+        self.staged_tables.append(table)
+        return self
+
     def build_graph(self):
         self.graph.add_mappings(self.staged, reverse=self.reverse)
+        for table in self.staged_tables:
+            self.graph.add_table_mappings(table, reverse=self.reverse)
 
 
 class RdfReverseMappingSerializer(RdfMappingSerializer):
     reverse = True
 
 
+class RdfProfileSerializer(RdfEntityAndMappingSerializer):
+    """
+    Serializes the entities and mappings to one file per export profile, building all the graphs in one pass.
+    The target passed to serialize is the directory the profile filenames are relative to.
+    """
+
+    def __init__(self, profiles: List[ExportProfile]):
+        super().__init__(RoutingGraph(profiles))
+
+
 class Graph:
 
     class_order = [
@@ -152,24 +200,39 @@ class Graph:
             self.add_entity_mappings(entity, reverse)
 
     def add_entity_mappings(self, entity: Entity, reverse: bool = False):
+        self.add_uri_mappings(entity.uri(), entity.webdewey_nr, entity.webdewey_approved, entity.noraf_id,
+                              entity.external_uri, reverse)
 
-        if entity.webdewey_nr is not None and entity.webdewey_approved == '1':
+    def add_table_mappings(self, table: EntityTable, reverse: bool = False):
+        """
+        Same as add_mappings, but reading the fields column-wise from an EntityTable.
+        """
+        columns = table.columns
+        for uri, webdewey_nr, webdewey_approved, noraf_id, external_uri in zip(table.uris(),
+                                                                               columns['webdewey_nr'],
+                                                                               columns['webdewey_approved'],
+                                                                               columns['noraf_id'],
+                                                                               columns['external_uri']):
+            self.add_uri_mappings(uri, webdewey_nr, webdewey_approved, noraf_id, external_uri, reverse)
+
+    def add_uri_mappings(self, uri: URIRef, webdewey_nr: Optional[str], webdewey_approved: Optional[str],
+                         noraf_id: Optional[str], external_uri: Optional[str], reverse: bool = False):
+
+        if webdewey_nr is not None and webdewey_approved == '1':
             # Note that we skip numbers that are not approved!
-            webdewey_nr = re.sub('[^0-9.]', '', entity.webdewey_nr)
+            webdewey_nr = re.sub('[^0-9.]', '', webdewey_nr)
             webdewey_uri = URIRef('http://dewey.info/class/%s/e23/' % webdewey_nr)
             if reverse:
-                self.add_raw(webdewey_uri, SKOS.closeMatch, entity.uri())
+                self.add_raw(webdewey_uri, SKOS.closeMatch, uri)
             else:
-                self.add_raw(entity.uri(), SKOS.closeMatch, webdewey_uri)
+                self.add_raw(uri, SKOS.closeMatch, webdewey_uri)
 
-        if entity.noraf_id is not None:
+        if noraf_id is not None:
             # authority.bibsys.no doesn't deliver RDF, and livedata.bibsys.no is no more,
-            uri = URIRef('https://bsaut.toolforge.org/show/' + entity.noraf_id)
-            self.add(entity, SKOS.exactMatch, uri)
+            self.add_raw(uri, SKOS.exactMatch, URIRef('https://bsaut.toolforge.org/show/' + noraf_id))
 
-        if entity.external_uri is not None:
-            uri = URIRef(entity.external_uri)
-            self.add(entity, SKOS.exactMatch, uri)
+        if external_uri is not None:
+            self.add_raw(uri, SKOS.exactMatch, URIRef(external_uri))
 
     def add_entities(self, entities: Iterable[Entity], concept_schemes: List[ConceptScheme]):
         for entity in entities:
@@ -443,3 +506,60 @@ class Graph:
 
     def triples(self, s=None, p=None, o=None):
         return self.graph.triples((s, p, o))
+
+
+class RoutingGraph(Graph):
+    """
+    A set of graphs, one per export profile, that are built together.
+
+    Triples added while adding an entity (or its mappings) are routed to the graphs of the profiles
+    matching that entity. Other triples, like the concept scheme data, go to all the graphs.
+    """
+
+    def __init__(self, profiles: List[ExportProfile]):
+        self.profiles = profiles
+        self.graphs = {profile.name: Graph() for profile in profiles}
+        self._all_targets = [graph.graph for graph in self.graphs.values()]
+        self._targets = self._all_targets
+
+    def __len__(self) -> int:
+        return sum(len(graph) for graph in self.graphs.values())
+
+    def _route(self, entity: Entity):
+        self._targets = [self.graphs[profile.name].graph for profile in self.profiles if profile.matches(entity)]
+
+    def add(self, entity: Entity, prop, val):
+        self.add_raw(entity.uri(), prop, val)
+
+    def add_raw(self, s, p, o):
+        for graph in self._targets:
+            graph.add((s, p, o))
+
+    def add_entity(self, entity: Entity, concept_schemes: List[ConceptScheme]):
+        self._route(entity)
+        try:
+            if len(self._targets):
+                super().add_entity(entity, concept_schemes)
+        finally:
+            self._targets = self._all_targets
+
+    def add_mappings(self, entities: Iterable[Entity], reverse: bool = False):
+        for entity in entities:
+            self._route(entity)
+            try:
+                if len(self._targets):
+                    self.add_entity_mappings(entity, reverse)
+            finally:
+                self._targets = self._all_targets
+
+    def skosify(self):
+        for graph in self.graphs.values():
+            graph.skosify()
+
+    def load(self, filename: str, format: str):
+        for graph in self.graphs.values():
+            graph.load(filename, format)
+
+    def serialize(self, target: str, file_format: str):
+        for profile in self.profiles:
+            self.graphs[profile.name].serialize(os.path.join(target, profile.filename), file_format)
@@ -1,4 +1,5 @@
 import os
+import unicodedata
 import pandas as pd
 
 
@@ -10,8 +11,8 @@ def as_generator(result):
 
 def ensure_parent_dir_exists(filename):
     dirname = os.path.dirname(filename)
-    if not os.path.exists(dirname):
-        os.mkdir(dirname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
 
 
 def trim(value):
@@ -23,6 +24,12 @@ def trim(value):
     return value
 
 
+def normalize_label(value: str) -> str:
+    # Normalized form of a label for use as a lookup key: NFC-normalized (so that "å" is the same
+    # whether it was stored precomposed or with a combining ring) and casefolded.
+    return unicodedata.normalize('NFC', value).casefold()
+
+
 def to_str(value):
     if value is None:
         return None
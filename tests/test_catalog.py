@@ -0,0 +1,333 @@
+import gzip
+from datetime import datetime
+from types import SimpleNamespace
+
+import orjson
+import pandas as pd
+from openpyxl import load_workbook
+
+from bibbi.console.config import Config
+from bibbi.console.extract_catalog import (AUTHORITY_LINKS_QUERY, Cache, ITEM_STATE_QUERY, ITEMS_QUERY,
+                                           MARC_DATA_QUERY, OrderedGroups, Report, ReportHeader, Runner,
+                                           pivot_marc_data)
+
+
+def make_catalog_data():
+    items = pd.DataFrame([
+        {'item_id': str(n), 'cataloguing_date': datetime(2020, 1, n), 'approve_date': datetime(2021, 1, n),
+         'pub_year': '2019', 'title_ax': 'Tittel %d' % n, 'varenr': 'v%d' % n, 'bibbi_id': 'b%d' % n}
+        for n in [1, 2, 3, 5, 8]
+    ])
+    marc_data = pd.DataFrame([
+        {'item_id': '1', 'field': '245', 'subfield': 'a', 'value': 'En bok'},
+        {'item_id': '1', 'field': '245', 'subfield': 'b', 'value': 'en roman'},
+        {'item_id': '2', 'field': '019', 'subfield': 'd', 'value': 'R'},
+        {'item_id': '4', 'field': '245', 'subfield': 'a', 'value': 'Ikke med'},
+        {'item_id': '8', 'field': '082', 'subfield': 'a', 'value': '839.82/3'},
+        {'item_id': '8', 'field': '245', 'subfield': 'a', 'value': 'En annen bok'},
+    ])
+    authority_links = pd.DataFrame([
+        {'field_id': 10, 'item_id': '1', 'local_id': '100', 'field': '100'},
+        {'field_id': 11, 'item_id': '1', 'local_id': '200', 'field': '650'},
+        {'field_id': 12, 'item_id': '3', 'local_id': '101', 'field': '700'},
+        {'field_id': 13, 'item_id': '8', 'local_id': '999', 'field': '650'},
+        {'field_id': 14, 'item_id': '8', 'local_id': '200', 'field': '650'},
+    ])
+    authorities = {
+        '00': pd.DataFrame([
+            {'local_id': '100', 'bibsent_id': 'p100', 'not_in_use': 'False', 'approved': 'True', 'title': None,
+             'label': 'Person, En'},
+            {'local_id': '101', 'bibsent_id': 'p101', 'not_in_use': 'False', 'approved': 'False', 'title': None,
+             'label': 'Person, To'},
+        ]),
+        '50': pd.DataFrame([
+            {'local_id': '200', 'bibsent_id': 't200', 'not_in_use': 'False', 'approved': 'True', 'title': None,
+             'label': 'Emne'},
+        ]),
+    }
+    export2ax = pd.DataFrame([
+        {'id': 1, 'item_id': '1', 'ean': '123', 'doc_type': 'Bok'},
+        {'id': 2, 'item_id': '1', 'ean': '123', 'doc_type': 'Lydbok'},
+    ])
+    roles = pd.DataFrame([{'field_id': 10, 'value': 'forfatter'}])
+    doc_types = pd.DataFrame([{'code': 'l', 'value': 'Bok'}])
+    return items, export2ax, marc_data, roles, doc_types, authority_links, authorities
+
+
+class FakeDb:
+    # Answers the catalog queries from the frames returned by make_catalog_data. The incremental queries
+    # (with parameters) only return the items in `changed`, and the items whose IDs are passed after the date.
+
+    def __init__(self, data, changed):
+        self.items, self.export2ax, self.marc_data, self.roles, self.doc_types, self.authority_links, \
+            self.authorities = data
+        self.changed = changed
+
+    def select_typed(self, query, schema, params=None, chunk_size=10000):
+        def select(df):
+            return df[df.item_id.isin(self.changed + [str(x) for x in params[1:]])] if params else df
+        if query.startswith(ITEM_STATE_QUERY):
+            return self.items[['item_id', 'bibbi_id', 'approve_date']]
+        if query.startswith(ITEMS_QUERY):
+            return select(self.items)
+        if query.startswith(MARC_DATA_QUERY):
+            return select(self.marc_data)
+        if query.startswith(AUTHORITY_LINKS_QUERY):
+            return select(self.authority_links)
+        if 'Export_PromusToAx' in query:
+            return self.export2ax
+        if 'SubField_ID = 33' in query:
+            return self.roles
+        if 'EnumDocTypes' in query:
+            return self.doc_types
+        for key, name in [('00', 'AuthorityPerson'), ('50', 'AuthorityTopic')]:
+            if 'FROM %s' % name in query:
+                return self.authorities[key]
+        return self.authorities['50'].iloc[:0]
+
+
+def make_runner(tmp_path, conn=None, max_report_rows=None) -> Runner:
+    return Runner(SimpleNamespace(connection=conn), Cache(tmp_path / 'cache', 0),
+                  Config(dest_dir=tmp_path, ingest_apikey=''), max_report_rows)
+
+
+class TestCatalog:
+
+    def test_ordered_groups(self):
+        rows = pd.DataFrame({'item_id': ['1', '1', '2', '4', '4', '9']}).itertuples()
+        groups = OrderedGroups(rows)
+        assert len(groups.take(1)) == 2
+        assert groups.take(3) == []
+        assert len(groups.take(4)) == 2
+        assert groups.take(10) == []
+
+    def test_stream_same_as_batch(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        items, export2ax, marc_data, roles, doc_types, authority_links, authorities = make_catalog_data()
+
+        runner = make_runner(tmp_path)
+        expected = list(runner.convert(items, export2ax, marc_data, roles, doc_types, authority_links,
+                                       authorities))
+        docs = list(runner.convert_stream(items.itertuples(), export2ax, marc_data.itertuples(), roles,
+                                          doc_types, authority_links.itertuples(), authorities))
+
+        assert docs == expected
+        assert [doc['_id'] for doc in docs] == ['b1', 'b2', 'b3', 'b5', 'b8']
+        assert docs[0]['title'] == 'En bok : en roman'
+        assert docs[0]['doc_type'] == 'Lydbok'
+        assert docs[0]['authorities'] == [
+            {'id': 'p100', 'label': 'Person, En', 'type': 'creator', 'role': 'forfatter', 'is_person': True},
+            {'id': 't200', 'label': 'Emne', 'type': 'topic'},
+        ]
+        assert docs[1]['form'] == 'Roman'
+        assert docs[2]['authorities'] == []
+        assert docs[4]['webdewey'] == '839.823'
+
+    def test_categorical_columns(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        data = make_catalog_data()
+        runner = make_runner(tmp_path)
+        expected = list(runner.convert(*data))
+
+        items, export2ax, marc_data, roles, doc_types, authority_links, authorities = make_catalog_data()
+        marc_data = marc_data.astype({'field': 'category', 'subfield': 'category'})
+        authority_links = authority_links.astype({'field': 'category'})
+        export2ax = export2ax.astype({'doc_type': 'category'})
+        roles = roles.astype({'value': 'category'})
+        authorities = {
+            key: df.astype({'not_in_use': 'category', 'approved': 'category'})
+            for key, df in authorities.items()
+        }
+        docs = list(runner.convert(items, export2ax, marc_data, roles, doc_types, authority_links, authorities))
+        assert docs == expected
+
+    def test_chunked_same_as_sequential(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        data = make_catalog_data()
+        runner = make_runner(tmp_path)
+        expected = list(runner.convert(*data))
+
+        runner.write_chunked(runner.prepare(*data), tmp_path / 'catalog.jsonl', workers=2, chunk_size=2)
+        lines = (tmp_path / 'catalog.jsonl').read_bytes().splitlines()
+        assert [orjson.loads(line) for line in lines] == orjson.loads(orjson.dumps(expected))
+
+        runner.write_chunked(runner.prepare(*data), tmp_path / 'catalog.jsonl', workers=2, chunk_size=2,
+                             compression='gzip', parts=True)
+        index = orjson.loads((tmp_path / 'catalog.index.json').read_bytes())
+        assert [part['file'] for part in index['parts']] == [
+            'catalog.00001.jsonl.gz', 'catalog.00002.jsonl.gz', 'catalog.00003.jsonl.gz',
+        ]
+        assert index['records'] == 5
+        lines = []
+        for part in index['parts']:
+            lines += gzip.decompress((tmp_path / part['file']).read_bytes()).splitlines()
+        assert [orjson.loads(line) for line in lines] == orjson.loads(orjson.dumps(expected))
+
+        # Workers that are not forked (like on Windows) get a pickled copy of the catalog data
+        runner.write_chunked(runner.prepare(*data), tmp_path / 'catalog.jsonl', workers=2, chunk_size=2,
+                             start_method='spawn')
+        lines = (tmp_path / 'catalog.jsonl').read_bytes().splitlines()
+        assert [orjson.loads(line) for line in lines] == orjson.loads(orjson.dumps(expected))
+
+        # More chunks than the 2 * workers that are kept in flight
+        runner.write_chunked(runner.prepare(*data), tmp_path / 'catalog.jsonl', workers=1, chunk_size=1)
+        lines = (tmp_path / 'catalog.jsonl').read_bytes().splitlines()
+        assert [orjson.loads(line) for line in lines] == orjson.loads(orjson.dumps(expected))
+
+    def test_incremental(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        data = make_catalog_data()
+        runner = make_runner(tmp_path)
+
+        # First run: No state, so a full export is made
+        runner.conn = FakeDb(data, [])
+        runner.run(incremental=True)
+        full = [orjson.loads(line) for line in (tmp_path / 'catalog.jsonl').read_bytes().splitlines()]
+        assert [doc['_id'] for doc in full] == ['b1', 'b2', 'b3', 'b5', 'b8']
+        assert not (tmp_path / 'catalog.delta.jsonl').exists()
+
+        # Second run: Item 2 has been changed and item 5 removed
+        items = data[0]
+        items.loc[items.item_id == '2', 'title_ax'] = 'Ny tittel'
+        items.loc[items.item_id == '2', 'approve_date'] = datetime(2022, 1, 1)
+        data = (items[items.item_id != '5'],) + data[1:]
+        data[2].loc[data[2].item_id == '2', 'value'] = 'D'
+        runner.conn = FakeDb(data, ['2'])
+        runner.run(incremental=True)
+
+        delta = [orjson.loads(line) for line in (tmp_path / 'catalog.delta.jsonl').read_bytes().splitlines()]
+        assert [(op['op'], op.get('_id') or op['doc']['_id']) for op in delta] == [('upsert', 'b2'), ('delete', 'b5')]
+        assert delta[0]['doc']['form'] == 'Dikt'
+
+        docs = [orjson.loads(line) for line in (tmp_path / 'catalog.jsonl').read_bytes().splitlines()]
+        assert [doc['_id'] for doc in docs] == ['b1', 'b3', 'b8', 'b2']
+        assert docs[3] == delta[0]['doc']
+
+        state = orjson.loads((tmp_path / 'catalog.state.json').read_bytes())
+        assert state['approve_date'] == '2022-01-01T00:00:00'
+        assert sorted(state['items']) == ['1', '2', '3', '8']
+
+        # Third run: Item 3 has got a new Bibbi ID, without being approved again
+        items = data[0].copy()
+        items.loc[items.item_id == '3', 'bibbi_id'] = 'b33'
+        data = (items,) + data[1:]
+        runner.conn = FakeDb(data, [])
+        runner.run(incremental=True)
+
+        delta = [orjson.loads(line) for line in (tmp_path / 'catalog.delta.jsonl').read_bytes().splitlines()]
+        assert [(op['op'], op.get('_id') or op['doc']['_id']) for op in delta] == [('upsert', 'b33'), ('delete', 'b3')]
+        docs = [orjson.loads(line) for line in (tmp_path / 'catalog.jsonl').read_bytes().splitlines()]
+        assert [doc['_id'] for doc in docs] == ['b1', 'b8', 'b2', 'b33']
+
+    def test_pivot_marc_data(self):
+        marc_data = pd.DataFrame([
+            {'item_id': '1', 'field': '020', 'subfield': 'a', 'value': 'isbn1'},
+            {'item_id': '1', 'field': '020', 'subfield': 'a', 'value': 'isbn2'},
+            {'item_id': '1', 'field': '245', 'subfield': 'a', 'value': 'Tittel'},
+            {'item_id': '1', 'field': '245', 'subfield': 'c', 'value': 'Ikke med'},
+            {'item_id': '2', 'field': '245', 'subfield': 'a', 'value': 'Tittel 2'},
+        ])
+        keys = ['020$a', '245$a', '260$b']
+
+        last = pivot_marc_data(marc_data, keys, item_ids=['2', '3', '1']).to_dict('records')
+        assert last == [
+            {'020$a': None, '245$a': 'Tittel 2', '260$b': None},
+            {'020$a': None, '245$a': None, '260$b': None},
+            {'020$a': 'isbn2', '245$a': 'Tittel', '260$b': None},
+        ]
+
+        first = pivot_marc_data(marc_data, keys, 'first')
+        assert first.loc['1', '020$a'] == 'isbn1'
+
+        all_values = pivot_marc_data(marc_data, keys, 'all')
+        assert all_values.loc['1', '020$a'] == ['isbn1', 'isbn2']
+        assert all_values.loc['2', '020$a'] is None
+
+
+class TestCache:
+
+    def make_frame(self):
+        # Like the frames returned by Db.select_typed
+        return pd.DataFrame({
+            'item_id': pd.Series(['1', '2', '3'], dtype=object),
+            'field_id': pd.Series([10, None, 12], dtype='Int64'),
+            'title': pd.Series(['En', None, 'Tre'], dtype=object),
+            'approved': pd.Series(['True', 'False', None], dtype='category'),
+            'approve_date': pd.Series([datetime(2021, 1, 1), None, datetime(2021, 1, 3)], dtype='datetime64[ns]'),
+            'field': pd.Series(['100', '650', '100'], dtype='category'),
+        })
+
+    def test_round_trip(self, tmp_path):
+        cache = Cache(tmp_path, 3600)
+        df = self.make_frame()
+        key = cache.make_key('SELECT 1', ['a'])
+        cache.put(key, df, 'SELECT 1', ['a'])
+
+        loaded = cache.get(key)
+        pd.testing.assert_frame_equal(loaded, df)
+        assert list(loaded.title) == ['En', None, 'Tre']
+        assert loaded.field_id.isna().tolist() == [False, True, False]
+        assert loaded.field.dtype == 'category'
+
+        manifest = cache.get_manifest(key)
+        assert manifest['query'] == 'SELECT 1'
+        assert manifest['params'] == ['a']
+        assert manifest['rows'] == 3
+
+    def test_projection(self, tmp_path):
+        cache = Cache(tmp_path, 3600)
+        key = cache.make_key('SELECT 1')
+        cache.put(key, self.make_frame(), 'SELECT 1')
+
+        loaded = cache.get(key, columns=['item_id', 'title'])
+        assert list(loaded.columns) == ['item_id', 'title']
+        assert list(loaded.title) == ['En', None, 'Tre']
+
+    def test_key_and_max_age(self, tmp_path):
+        cache = Cache(tmp_path, 3600)
+        assert cache.make_key('SELECT 1', [1]) != cache.make_key('SELECT 1', [2])
+        assert cache.make_key('SELECT 1', [1], {'field': 'str'}) != \
+            cache.make_key('SELECT 1', [1], {'field': 'category'})
+
+        key = cache.make_key('SELECT 1')
+        assert cache.get(key) is None
+        cache.put(key, self.make_frame(), 'SELECT 1')
+        cache.max_age = -1
+        assert cache.get(key) is None
+
+
+class TestReport:
+
+    def test_streaming_with_cap(self, tmp_path):
+        filename = str(tmp_path / 'report.xlsx')
+        report = Report([ReportHeader('Vare', 'ID', 12), ReportHeader('', 'Feil', 30)], filename,
+                        max_rows_per_category=2, category_column=1)
+        for n in range(5):
+            report.add(['{BIBBI}%d' % n, 'a' if n < 4 else 'b'])
+        report.save()
+
+        ws = load_workbook(filename).active
+        rows = [[cell.value for cell in row] for row in ws.iter_rows()]
+        assert rows == [['Vare', None], ['ID', 'Feil'], ['0', 'a'], ['1', 'a'], ['4', 'b']]
+        assert ws['A3'].hyperlink.target == 'https://id.bs.no/bibbi/0'
+        assert ws.auto_filter.ref == 'A2:B5'
+
+        overflow = (tmp_path / 'report.csv').read_text(encoding='utf-8').splitlines()
+        assert overflow == ['ID,Feil', '{BIBBI}2,a', '{BIBBI}3,a']
+
+        # The next run has no overflow, so the old overflow file is removed
+        report = Report([ReportHeader('Vare', 'ID', 12), ReportHeader('', 'Feil', 30)], filename,
+                        max_rows_per_category=2, category_column=1)
+        report.add(['{BIBBI}1', 'a'])
+        report.save()
+        assert not (tmp_path / 'report.csv').exists()
+
+    def test_buffered(self, tmp_path):
+        report = Report([ReportHeader('Vare', 'ID', 12)])
+        report.add_rows([['1'], ['2']])
+        assert report.data == [['1'], ['2']]
+        report.save(str(tmp_path / 'report.xlsx'))
+
+        ws = load_workbook(str(tmp_path / 'report.xlsx')).active
+        rows = [[cell.value for cell in row] for row in ws.iter_rows()]
+        assert rows == [['Vare'], ['ID'], ['1'], ['2']]
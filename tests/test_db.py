@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pytest
+
+from bibbi.db import Db
+
+
+class FakeCursor:
+
+    def __init__(self, columns, rows):
+        self.description = [(column,) for column in columns]
+        self.rows = rows
+        self.fetches = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches += 1
+        return rows
+
+
+def make_db(cursor: FakeCursor) -> Db:
+    db = Db.__new__(Db)
+    db.connection = type('FakeConnection', (), {'cursor': lambda self: cursor})()
+    return db
+
+
+class TestSelectTyped:
+
+    def test_types_and_nulls(self):
+        cursor = FakeCursor(['id', 'label', 'year', 'approved', 'date', 'field'], [
+            (1, 'En', 2019, True, datetime(2020, 1, 1), '650'),
+            (2, None, None, None, None, '100'),
+            (3, 'Tre', 2021, False, datetime(2021, 1, 1), '650'),
+        ])
+        df = make_db(cursor).select_typed('SELECT', {
+            'id': 'int',
+            'label': 'str',
+            'year': 'int',
+            'approved': 'bool',
+            'date': 'date',
+            'field': 'category',
+        }, chunk_size=2)
+
+        assert cursor.fetches == 3
+        assert [str(x) for x in df.dtypes] == ['Int64', 'object', 'Int64', 'boolean', 'datetime64[ns]', 'category']
+        assert list(df.label) == ['En', None, 'Tre']
+        assert df.year.isna().tolist() == [False, True, False]
+        assert df.year[2] == 2021
+        assert df.approved.isna().tolist() == [False, True, False]
+        assert df.date.isna().tolist() == [False, True, False]
+        assert list(df.field.cat.categories) == ['100', '650']
+
+    def test_bits_as_str(self):
+        cursor = FakeCursor(['not_in_use'], [(True,), (False,), (None,)])
+        df = make_db(cursor).select_typed('SELECT', {'not_in_use': 'str'})
+        assert list(df.not_in_use) == ['True', 'False', None]
+
+    def test_empty_result(self):
+        df = make_db(FakeCursor(['id', 'label'], [])).select_typed('SELECT', {'id': 'int', 'label': 'str'})
+        assert len(df) == 0
+        assert list(df.columns) == ['id', 'label']
+
+    def test_undeclared_column(self):
+        with pytest.raises(ValueError):
+            make_db(FakeCursor(['id', 'label'], [])).select_typed('SELECT', {'id': 'int'})
@@ -0,0 +1,50 @@
+from rdflib import Namespace
+
+from bibbi.constants import TYPE_PERSON
+from bibbi.diagnostics import Diagnostics
+from bibbi.entity_service import BibbiEntity
+from bibbi.util import LanguageMap
+
+
+def make_entity(entity_id: str, label: str) -> BibbiEntity:
+    return BibbiEntity(
+        id=entity_id,
+        namespace=Namespace('https://id.bs.no/bibbi/'),
+        row=None,
+        source_type=TYPE_PERSON,
+        type=TYPE_PERSON,
+        pref_label=LanguageMap(nb=label, nn=label),
+        alt_labels=[],
+        local_id=entity_id,
+    )
+
+
+class TestDiagnostics:
+
+    def test_counts_and_bounded_samples(self):
+        diagnostics = Diagnostics(max_samples=2)
+        for n in range(5):
+            diagnostics.add('Nasjonalitetskode ble ikke funnet', make_entity(str(n), 'Person %d' % n), 'xyz.')
+        diagnostics.add('Biautoritet mangler hovedautoritet', make_entity('9', 'Person 9'))
+
+        assert len(diagnostics) == 6
+        assert diagnostics.counts['Nasjonalitetskode ble ikke funnet'] == 5
+        assert diagnostics.samples['Nasjonalitetskode ble ikke funnet'] == [
+            ('0', 'Person 0', 'xyz.'),
+            ('1', 'Person 1', 'xyz.'),
+        ]
+
+    def test_write_report(self, tmp_path):
+        diagnostics = Diagnostics(max_samples=1)
+        diagnostics.add('Biautoritet mangler hovedautoritet', make_entity('1', 'A'))
+        diagnostics.add('Biautoritet mangler hovedautoritet', make_entity('2', 'B'))
+        report_file = tmp_path.joinpath('diagnostics.txt')
+        diagnostics.write_report(report_file)
+
+        assert report_file.read_text(encoding='utf-8') == '\n'.join([
+            'Biautoritet mangler hovedautoritet: 2 entities',
+            '    1 "A"',
+            '    (... and 1 more)',
+            '',
+            '',
+        ])
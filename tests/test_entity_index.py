@@ -0,0 +1,177 @@
+import unicodedata
+from datetime import datetime
+
+from rdflib import Namespace
+
+from bibbi.constants import TYPE_PERSON, TYPE_TITLE, TYPE_TOPICAL
+from bibbi.entity_service import BibbiEntity, EntityCollection, EntityIndex
+from bibbi.util import LanguageMap
+
+
+def make_entity(entity_id: str, entity_type: str, label: str, alt_labels=None, source_type=None) -> BibbiEntity:
+    return BibbiEntity(
+        id=entity_id,
+        namespace=Namespace('https://id.bs.no/bibbi/'),
+        row=None,
+        source_type=source_type or entity_type,
+        type=entity_type,
+        pref_label=LanguageMap(nb=label, nn=label),
+        alt_labels=[LanguageMap(nb=x, nn=x) for x in alt_labels or []],
+        local_id='L' + entity_id,
+    )
+
+
+class TestEntityIndex:
+
+    def test_find_by_label_is_normalized(self):
+        index = EntityIndex()
+        index.add_entity(make_entity('1', TYPE_TOPICAL, 'Ærfugl', ['Øyer']))
+
+        decomposed = unicodedata.normalize('NFD', 'ÆRFUGL')
+        assert index.find(label=decomposed, entity_type=TYPE_TOPICAL) == ('1',)
+        assert index.find(label='øyer', entity_type=TYPE_TOPICAL) == ('1',)
+        assert index.find(label='ærfugl', entity_type=TYPE_PERSON) == ()
+
+    def test_find_by_source_type_and_local_id(self):
+        index = EntityIndex()
+        index.add_entity(make_entity('1', TYPE_TITLE, 'Ringenes herre', source_type=TYPE_PERSON))
+
+        assert index.find(label='Ringenes herre', source_type=TYPE_PERSON) == ('1',)
+        assert index.find(local_id='L1', entity_type=TYPE_TITLE) == ('1',)
+
+    def test_same_label_multiple_entities(self):
+        index = EntityIndex()
+        index.add_entity(make_entity('1', TYPE_TOPICAL, 'Impresjonisme'))
+        index.add_entity(make_entity('2', TYPE_TOPICAL, 'Impresjonisme', ['impresjonisme']))
+
+        assert index.find(label='Impresjonisme', entity_type=TYPE_TOPICAL) == ('1', '2')
+
+    def test_find_prefix(self):
+        index = EntityIndex()
+        index.add_entity(make_entity('1', TYPE_TOPICAL, 'Ålesund'))
+        index.add_entity(make_entity('2', TYPE_PERSON, 'Åse, Per'))
+        index.add_entity(make_entity('3', TYPE_TOPICAL, 'Åker'))
+        index.add_entity(make_entity('4', TYPE_TOPICAL, 'Bergen'))
+
+        assert index.find_prefix('å') == ['3', '1', '2']
+        assert index.find_prefix('Å', entity_type=TYPE_TOPICAL) == ['3', '1']
+        assert index.find_prefix('å', limit=1) == ['3']
+        assert index.find_prefix('x') == []
+
+
+class TestEntityCollection:
+
+    def test_index_is_updated_incrementally(self):
+        collection = EntityCollection('bibbi')
+        collection.add(make_entity('1', TYPE_TOPICAL, 'Alger'))
+        collection.extend([
+            make_entity('2', TYPE_TOPICAL, 'Oslo'),
+            make_entity('3', TYPE_TOPICAL, 'Oslo'),
+        ])
+
+        assert collection.find(label='Alger', entity_type=TYPE_TOPICAL)[0].id == '1'
+        assert [x.id for x in collection.find(label='Oslo', entity_type=TYPE_TOPICAL)] == ['2', '3']
+
+        collection.remove('2')
+        assert [x.id for x in collection.find(label='Oslo', entity_type=TYPE_TOPICAL)] == ['3']
+
+        # Replacing an entity also replaces its index entries
+        collection.add(make_entity('1', TYPE_TOPICAL, 'Algerie'))
+        assert collection.find(label='Alger', entity_type=TYPE_TOPICAL) == []
+        assert collection.find_first(label='Algerie', entity_type=TYPE_TOPICAL).id == '1'
+        assert len(collection) == 2
+
+    def test_type_partitions(self):
+        collection = EntityCollection('bibbi', {
+            '1': make_entity('1', TYPE_PERSON, 'Ibsen, Henrik'),
+            '2': make_entity('2', TYPE_TOPICAL, 'Oslo'),
+        })
+        collection.extend([
+            make_entity('3', TYPE_PERSON, 'Hamsun, Knut'),
+            make_entity('4', TYPE_TITLE, 'Sult'),
+        ])
+        assert [x.id for x in collection.of_type(TYPE_PERSON)] == ['1', '3']
+        assert [x.id for x in collection.of_type(TYPE_TITLE, TYPE_TOPICAL)] == ['4', '2']
+
+        # Changing the type of an entity moves it to another partition
+        collection.add(make_entity('1', TYPE_TOPICAL, 'Ibsen'))
+        collection.remove('3')
+        assert list(collection.of_type(TYPE_PERSON)) == []
+        assert [x.id for x in collection.of_type(TYPE_TOPICAL)] == ['2', '1']
+
+    def test_find_by_local_ids(self):
+        collection = EntityCollection('bibbi')
+        collection.extend([
+            make_entity('1', TYPE_PERSON, 'Ibsen, Henrik'),
+            make_entity('2', TYPE_TOPICAL, 'Oslo'),
+        ])
+        results = collection.find_by_local_ids(['L1', 'L2', None, 'L3'], TYPE_PERSON)
+        assert [x.id if x is not None else None for x in results] == ['1', None, None, None]
+
+    def test_statistics(self):
+        entities = [make_entity(str(n), TYPE_TOPICAL if n < 3 else TYPE_PERSON, 'Emne %d' % n) for n in range(5)]
+        for n, entity in enumerate(entities):
+            entity.modified = datetime(2020, 1, n + 1)
+            entity.approved = '1' if n % 2 == 0 else '0'
+            entity.items_as_entry = n
+        collection = EntityCollection('bibbi')
+        collection.extend(entities)
+
+        assert collection.last_modified == datetime(2020, 1, 5)
+        assert collection.type_counts == {TYPE_TOPICAL: 3, TYPE_PERSON: 2}
+        assert collection.approval_counts == {'1': 3, '0': 2}
+        assert collection.items_totals == {'items_as_entry': 10, 'items_as_subject': 0}
+
+        collection.remove('4')
+        assert collection.last_modified == datetime(2020, 1, 4)
+        assert collection.approval_counts == {'1': 2, '0': 2}
+        assert collection.items_totals['items_as_entry'] == 6
+        assert collection.get_statistics()['entities'] == 4
+
+    def test_filter_views(self):
+        entities = [make_entity(str(n), TYPE_TOPICAL if n < 4 else TYPE_PERSON, 'Emne %d' % n) for n in range(6)]
+        for n, entity in enumerate(entities):
+            entity.approved = '1' if n % 2 == 0 else '0'
+            entity.noraf_id = 'N%d' % n if n == 5 else None
+        collection = EntityCollection('bibbi')
+        collection.extend(entities)
+
+        view = collection.filter(entity_type=TYPE_TOPICAL, approved='1')
+        assert [x.id for x in view] == ['0', '2']
+        assert len(view) == 2
+        assert '2' in view and '1' not in view
+        assert view.find_first(label='Emne 1', entity_type=TYPE_TOPICAL) is None
+        assert view.find_first(label='Emne 2', entity_type=TYPE_TOPICAL).id == '2'
+
+        persons = collection.filter(lambda x: x.noraf_id is not None, entity_type=TYPE_PERSON)
+        assert [x.id for x in persons] == ['5']
+        assert len(collection.filter(entity_type=TYPE_PERSON)) == 2
+        assert len(collection.filter(approved='0')) == 3
+
+        # Views are live
+        collection.add(make_entity('6', TYPE_PERSON, 'Emne 6'))
+        collection.get('6').noraf_id = 'N6'
+        assert [x.id for x in persons] == ['5', '6']
+        assert [x.id for x in persons.filter(approved='1')] == []
+
+    def test_filter_views_keep_collection_order(self):
+        types = [TYPE_PERSON, TYPE_TOPICAL, TYPE_PERSON, TYPE_TOPICAL, TYPE_TOPICAL, TYPE_PERSON]
+        entities = [make_entity(str(n), entity_type, 'Emne %d' % n) for n, entity_type in enumerate(types)]
+        for n, entity in enumerate(entities):
+            entity.approved = '1' if n < 5 else '0'
+        collection = EntityCollection('bibbi')
+        collection.extend(entities)
+        replacement = make_entity('1', TYPE_TOPICAL, 'Emne 1')
+        replacement.approved = '1'
+        collection.add(replacement)  # Replaced, so moved to the end
+
+        expected = ['0', '2', '3', '4', '5', '1']
+        assert [x.id for x in collection] == expected
+        assert [x.id for x in collection.filter(entity_type=[TYPE_TOPICAL, TYPE_PERSON])] == expected
+        assert [x.id for x in collection.filter(entity_type=[TYPE_PERSON, TYPE_TOPICAL])] == expected
+        assert [x.id for x in collection.filter(entity_type=[TYPE_PERSON, TYPE_TOPICAL], approved='1')] == \
+            ['0', '2', '3', '4', '1']
+        assert [x.id for x in collection.filter(entity_type=TYPE_TOPICAL, approved='1')] == ['3', '4', '1']
+
+        collection.remove('2')
+        assert [x.id for x in collection.filter(entity_type=[TYPE_TOPICAL, TYPE_PERSON])] == ['0', '3', '4', '5', '1']
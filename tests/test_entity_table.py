@@ -0,0 +1,81 @@
+from datetime import datetime
+
+from bibbi.constants import TYPE_PERSON, TYPE_TOPICAL, TYPE_CORPORATION, TYPE_TITLE, TYPE_PERSON_SUBJECT, \
+    TYPE_LAW, TYPE_CORPORATION_SUBJECT
+from bibbi.entity_service import EntityCollection
+from bibbi.entity_table import EntityTable
+from bibbi.label import LabelFactory
+from bibbi.serializers.rdf import RdfReverseMappingSerializer
+from bibbi.promus_service import TopicTable, PersonTable, CorporationTable
+from .util import make_dataframe
+
+
+def make_table(table_class, row_type, rows):
+    table = table_class()
+    table.df = make_dataframe(row_type, rows)
+    table.parse_subdivisions()
+    table.references.load(table)
+    return table
+
+
+def make_tables():
+    return [
+        make_table(TopicTable, TYPE_TOPICAL, [
+            {'row_id': '1', 'bibsent_id': '11', 'label': 'Filmkunst', 'approved': '1',
+             'modified': datetime(2020, 1, 2), 'webdewey_nr': '791.43', 'webdewey_approved': '1'},
+            {'row_id': '2', 'bibsent_id': '12', 'label': 'Film', 'ref_id': '1'},
+            {'row_id': '3', 'bibsent_id': '13', 'label': 'Norge', 'approved': '0',
+             'webdewey_nr': '948.1', 'webdewey_approved': '0', 'external_uri': 'http://example.org/13'},
+            {'row_id': '4', 'bibsent_id': '14', 'label': 'Noreg', 'ref_id': '3'},
+        ]),
+        make_table(PersonTable, TYPE_PERSON, [
+            {'row_id': '5', 'bibsent_id': '15', 'felles_id': '15', 'label': 'Ibsen, Henrik',
+             'normalized_name': 'Ibsen, Henrik', 'items_as_entry': 5, 'items_as_subject': 2,
+             'noraf_id': '90054127', 'modified': datetime(2021, 3, 4)},
+            {'row_id': '6', 'bibsent_id': '16', 'felles_id': '15', 'label': 'Ibsen, Henrik',
+             'work_title': 'Peer Gynt', 'items_as_entry': 1},
+            {'row_id': '7', 'bibsent_id': '17', 'felles_id': '15', 'label': 'Ibsen, Henrik'},
+            # Replaces the topic with the same ID
+            {'row_id': '8', 'bibsent_id': '13', 'label': 'Norge, Ola', 'approved': '1'},
+        ]),
+        make_table(CorporationTable, TYPE_CORPORATION, [
+            {'row_id': '9', 'bibsent_id': '19', 'felles_id': '20', 'label': 'Norge',
+             'work_title': 'Grunnloven', 'law': '1', 'items_as_subject': 3},
+            {'row_id': '10', 'bibsent_id': '20', 'felles_id': '21', 'label': 'Stortinget'},
+        ]),
+    ]
+
+
+def make_collection(tables) -> EntityCollection:
+    collection = EntityCollection('bibbi')
+    for table in tables:
+        collection.import_table(table, LabelFactory())
+    return collection
+
+
+class TestEntityTable:
+
+    def test_columns(self):
+        table = EntityTable.from_tables(make_tables())
+
+        assert list(table.columns['id']) == ['11', '15', '16', '17', '13', '19', '20']
+        assert list(table.columns['type']) == [TYPE_TOPICAL, TYPE_PERSON, TYPE_TITLE, TYPE_PERSON_SUBJECT,
+                                               TYPE_PERSON, TYPE_LAW, TYPE_CORPORATION_SUBJECT]
+        assert table.columns['local_id'][4] == '8'
+        assert str(next(table.uris())) == 'https://id.bs.no/bibbi/11'
+
+    def test_same_as_collection(self):
+        tables = make_tables()
+        collection = make_collection(tables)
+        table = EntityTable.from_tables(tables)
+
+        assert [(x.id, x.type) for x in collection] == list(zip(table.columns['id'], table.columns['type']))
+        assert table.get_statistics() == collection.get_statistics()
+        assert table.get_statistics()['items'] == {'items_as_entry': 6, 'items_as_subject': 5}
+
+        from_collection = RdfReverseMappingSerializer().add_entities(collection)
+        from_collection.build_graph()
+        from_table = RdfReverseMappingSerializer().add_table(table)
+        from_table.build_graph()
+        assert len(from_table.graph) == 2
+        assert set(from_table.graph.graph) == set(from_collection.graph.graph)
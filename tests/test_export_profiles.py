@@ -0,0 +1,45 @@
+import argparse
+
+import pytest
+from rdflib import Literal
+from rdflib.namespace import DCTERMS
+
+from bibbi.console.extract_authorities import EXPORT_PROFILES, parse_profiles
+from bibbi.constants import TYPE_PERSON, TYPE_TOPICAL
+from bibbi.serializers.rdf import ExportProfile, RoutingGraph
+from .test_entity_index import make_entity
+
+
+class TestExportProfiles:
+
+    def test_triples_are_routed_to_matching_profiles(self):
+        entities = [
+            make_entity('1', TYPE_TOPICAL, 'Film'),
+            make_entity('2', TYPE_TOPICAL, 'Spill'),
+            make_entity('3', TYPE_PERSON, 'Ibsen, Henrik'),
+        ]
+        entities[0].concept_group = 'film'
+        entities[1].approved = '0'
+
+        graph = RoutingGraph([
+            ExportProfile('all', 'all.nt'),
+            ExportProfile('topical', 'topical.nt', entity_types=[TYPE_TOPICAL]),
+            ExportProfile('approved', 'approved.nt', approved_only=True),
+            ExportProfile('film', 'film.nt', concept_group='film'),
+        ])
+        graph.add_entities(entities, [])
+
+        def identifiers(name):
+            return sorted(str(o) for s, p, o in graph.graphs[name].triples(p=DCTERMS.identifier))
+
+        assert identifiers('all') == ['1', '2', '3']
+        assert identifiers('topical') == ['1', '2']
+        assert identifiers('approved') == ['1', '3']
+        assert identifiers('film') == ['1']
+        assert (entities[2].uri(), DCTERMS.identifier, Literal('3')) not in graph.graphs['topical'].graph
+
+    def test_parse_profiles(self):
+        assert parse_profiles('topical,film') == ['topical', 'film']
+        assert parse_profiles('all') == [profile.name for profile in EXPORT_PROFILES]
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_profiles('topical,films')
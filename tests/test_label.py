@@ -1,8 +1,8 @@
 import pytest
 
-from bibbi.label import LabelService
+from bibbi.label import LabelFactory
 from bibbi.constants import TYPE_GEOGRAPHIC, TYPE_TOPICAL, TYPE_CORPORATION, TYPE_PERSON
-from .util import make_datarow
+from .util import make_datarow, make_dataframe
 
 
 class TestLabel:
@@ -243,8 +243,8 @@ class TestLabel:
     @pytest.mark.parametrize("row_type,row_data,expected", examples)
     def test_get_label_without_transform(row_type, row_data, expected):
         row = make_datarow(row_type, **row_data)
-        label_service = LabelService()
-        label = label_service.get_label(row)
+        label_factory = LabelFactory()
+        label = label_factory.make(row)
 
         assert label.nb == expected['original']['nb']
         assert label.nn == expected['original']['nn']
@@ -253,8 +253,45 @@ class TestLabel:
     @pytest.mark.parametrize("row_type,row_data,expected", examples)
     def test_get_label_with_transform(row_type, row_data, expected):
         row = make_datarow(row_type, **row_data)
-        label_service = LabelService(transform=True)
-        label = label_service.get_label(row)
+        label_factory = LabelFactory(transform=True)
+        label = label_factory.make(row)
 
         assert label.nb == expected['transformed']['nb']
         assert label.nn == expected['transformed']['nn']
+
+    @staticmethod
+    @pytest.mark.parametrize("transform", [False, True])
+    @pytest.mark.parametrize("include_subdivisions", [False, True])
+    @pytest.mark.parametrize("include_qualifier", [False, True])
+    @pytest.mark.parametrize("row_type,row_data,expected", examples)
+    def test_make_frame_matches_make(row_type, row_data, expected, transform, include_subdivisions,
+                                     include_qualifier):
+        row = make_datarow(row_type, **row_data)
+        df = make_dataframe(row_type, [row_data])
+        label_factory = LabelFactory(transform=transform)
+        label = label_factory.make(row, include_subdivisions=include_subdivisions,
+                                   include_qualifier=include_qualifier)
+        labels = label_factory.make_frame(df, row_type, include_subdivisions=include_subdivisions,
+                                          include_qualifier=include_qualifier)
+
+        assert labels.nb.tolist() == [label.nb]
+        assert labels.nn.tolist() == [label.nn]
+
+    @staticmethod
+    @pytest.mark.parametrize("transform", [False, True])
+    @pytest.mark.parametrize("row_type", [TYPE_TOPICAL, TYPE_GEOGRAPHIC, TYPE_CORPORATION, TYPE_PERSON])
+    def test_cache_frame_matches_make(row_type, transform):
+        # All the examples of the type in one frame, plus the first one again with a different ID
+        rows = [dict(row_data, row_id=str(n)) for n, (example_type, row_data, expected) in enumerate(TestLabel.examples)
+                if example_type == row_type]
+        rows.append(dict(rows[0], row_id='x'))
+        label_factory = LabelFactory(transform=transform)
+
+        assert label_factory.cache_frame(make_dataframe(row_type, rows), row_type) == len(rows)
+
+        for row_data in rows:
+            row = make_datarow(row_type, **row_data)
+            cached = label_factory.make(row)
+            label = LabelFactory(transform=transform).make(row)
+            assert (cached.nb, cached.nn) == (label.nb, label.nn)
+        assert len(label_factory._cache) == len(rows)
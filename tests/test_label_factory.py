@@ -0,0 +1,32 @@
+from bibbi.constants import TYPE_PERSON
+from bibbi.label import LabelFactory
+from .util import make_row
+
+
+class TestLabelFactory:
+
+    def test_labels_are_cached_per_variant(self):
+        row = make_row(TYPE_PERSON, {
+            'row_id': '12345',
+            'label': 'Tolkien, John Ronald Reuel',
+            'nationality': 'eng.',
+            'date': '1892-1973',
+            'work_title': 'Ringenes herre',
+            'sub_topic': 'Humor',
+        })
+        label_factory = LabelFactory()
+
+        label = label_factory.make(row)
+        assert label.nb == 'Tolkien, John Ronald Reuel, eng., 1892-1973 - Humor - Ringenes herre'
+        assert label_factory.make(row) is label
+
+        label = label_factory.make(row, include_subdivisions=False)
+        assert label.nb == 'Tolkien, John Ronald Reuel, eng., 1892-1973 - Ringenes herre'
+        assert label_factory.make(row, include_subdivisions=False) is label
+
+    def test_rows_without_id_are_not_cached(self):
+        row = make_row(TYPE_PERSON, {'label': 'Thunberg, Greta'})
+        label_factory = LabelFactory()
+
+        assert label_factory.make(row).nb == 'Thunberg, Greta'
+        assert len(label_factory._cache) == 0
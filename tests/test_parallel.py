@@ -0,0 +1,44 @@
+from bibbi.label import LabelFactory
+from bibbi.parallel import make_entities_parallel
+from bibbi.promus_service import TopicTable
+from .util import make_dataframe
+
+
+class TestParallel:
+
+    def test_same_entities_as_sequential(self):
+        table = TopicTable()
+        table.df = make_dataframe('topical', [
+            {'row_id': str(n), 'bibsent_id': 'b%d' % n, 'label': 'Emne %d' % n,
+             'ref_id': str(n - 1) if n % 3 == 2 else None}
+            for n in range(20)
+        ])
+        table.references.load(table)
+
+        expected = [(x.id, x.pref_label.nb, [y.nb for y in x.alt_labels], x.row.row_id)
+                    for x in table.make_entities()]
+
+        entities = []
+        for chunk_table, chunk in make_entities_parallel({table.type: table}, None, workers=2, chunk_size=4):
+            assert chunk_table is table
+            entities += [(x.id, x.pref_label.nb, [y.nb for y in x.alt_labels], x.row.row_id) for x in chunk]
+
+        assert entities == expected
+        assert len(entities) == 14
+
+    def test_labels_are_kept_in_parent(self):
+        table = TopicTable()
+        table.df = make_dataframe('topical', [
+            {'row_id': str(n), 'bibsent_id': 'b%d' % n, 'label': 'Emne %d' % n} for n in range(10)
+        ])
+        table.references.load(table)
+        label_factory = LabelFactory()
+
+        entities = []
+        for chunk_table, chunk in make_entities_parallel({table.type: table}, label_factory, workers=2, chunk_size=4):
+            entities += chunk
+
+        assert len(entities) == 10
+        assert len(label_factory._cache) == 10
+        assert label_factory.make(entities[3].row) is label_factory.make(entities[3].row)
+        assert label_factory.make(entities[3].row).nb == entities[3].pref_label.nb == 'Emne 3'
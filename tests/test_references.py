@@ -0,0 +1,92 @@
+from bibbi.promus_service import TopicTable
+from bibbi.references import ReferenceMap, resolve_references
+
+from .util import make_dataframe
+
+
+class TestReferences:
+
+    def test_resolve_chains(self):
+        resolved, cycles, broken = resolve_references({
+            'A': 'B',
+            'B': 'C',
+            'C': 'D',  # D is a main entry
+            'E': 'C',
+            'F': 'D',
+        })
+
+        assert resolved == {'A': 'D', 'B': 'D', 'C': 'D', 'E': 'D', 'F': 'D'}
+        assert cycles == []
+        assert broken == set()
+
+    def test_resolve_cycles(self):
+        resolved, cycles, broken = resolve_references({
+            'A': 'B',
+            'B': 'C',
+            'C': 'B',  # Cycle B -> C -> B
+            'D': 'D',  # Self-reference
+            'E': 'F',
+        })
+
+        assert resolved == {'E': 'F'}
+        assert cycles == [['B', 'C'], ['D']]
+        assert broken == {'A', 'B', 'C', 'D'}
+
+    def test_long_chain(self):
+        refs = {str(n): str(n + 1) for n in range(100)}
+        resolved, cycles, broken = resolve_references(refs)
+
+        assert set(resolved.values()) == {'100'}
+        assert len(resolved) == 100
+
+    def test_serialize(self):
+        references = ReferenceMap()
+        references.update({'A': 'B', 'B': 'C', 'X': 'Y', 'Y': 'X'})
+
+        restored = ReferenceMap().from_dict(references.to_dict())
+        assert restored.get('A') == 'C'
+        assert restored.get('C') is None
+        assert restored.get('X') is None
+        assert restored.cycles == [['X', 'Y']]
+
+    def test_validate_table(self):
+        table = TopicTable()
+        rows = [{'row_id': str(n), 'bibsent_id': 'b%d' % n, 'label': 'L%d' % n, 'ref_id': str(n + 1)}
+                for n in range(10)]  # Chain 0 -> 1 -> ... -> 10
+        rows += [
+            {'row_id': '10', 'bibsent_id': 'b10', 'label': 'L10'},
+            {'row_id': '20', 'bibsent_id': 'b20', 'label': 'L20', 'ref_id': '21'},  # Missing target
+            {'row_id': '22', 'bibsent_id': 'b22', 'label': 'L22', 'ref_id': '23'},
+            {'row_id': '23', 'bibsent_id': 'b23', 'label': 'L23', 'ref_id': '22'},  # Cycle
+            {'row_id': '24', 'bibsent_id': 'b24', 'label': 'L24', 'ref_id': '20'},  # Leads to missing target
+        ]
+        table.df = make_dataframe('topical', rows)
+
+        resolved = table.validate_references()
+        table.references.load(table, resolved)
+
+        assert sorted(table.df.row_id) == sorted(str(n) for n in range(11))
+        assert table.references.get('b0') == 'b10'
+        assert table.references.get('b10') is None
+        assert table.references.get('b24') is None
+
+    def test_group_references(self):
+        table = TopicTable()
+        table.df = make_dataframe('topical', [
+            {'row_id': '1', 'bibsent_id': 'b1', 'label': 'Ref to 3', 'ref_id': '3'},
+            {'row_id': '2', 'bibsent_id': 'b2', 'label': 'Main 2'},
+            {'row_id': '3', 'bibsent_id': 'b3', 'label': 'Main 3'},
+            {'row_id': '4', 'bibsent_id': 'b4', 'label': 'Ref to 1', 'ref_id': '1'},
+            {'row_id': '5', 'bibsent_id': 'b5', 'label': 'Ref to 2', 'ref_id': '2'},
+        ])
+        table.references.load(table)
+
+        groups = [
+            (entity_id, position, main_row.label, [row.label for row in reference_rows])
+            for entity_id, position, main_row, reference_rows in table.iter_groups(table.entity_groups())
+        ]
+
+        assert groups == [
+            ('b3', 2, 'Main 3', ['Ref to 3', 'Ref to 1']),
+            ('b2', 1, 'Main 2', ['Ref to 2']),
+        ]
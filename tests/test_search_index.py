@@ -0,0 +1,103 @@
+import json
+import threading
+from types import SimpleNamespace
+
+from elasticsearch import TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from bibbi.search_index import BulkIndexer, make_actions
+
+
+class FakeElasticsearch:
+    # Stand-in for the Elasticsearch client that keeps the index in a dict. Documents with IDs in
+    # `busy` are rejected with 429 the first time they are sent, and documents with IDs in `invalid`
+    # are always rejected with 400. The first `rejected_requests` requests are rejected as a whole with 429.
+
+    def __init__(self, busy=(), invalid=(), rejected_requests=0):
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.docs = {}
+        self.busy = set(busy)
+        self.invalid = set(invalid)
+        self.requests = 0
+        self.rejected_requests = rejected_requests
+        self.lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines()]
+        items = []
+        with self.lock:
+            self.requests += 1
+            if self.requests <= self.rejected_requests:
+                raise TransportError(429, 'es_rejected_execution_exception', 'rejected')
+            while lines:
+                (op, meta), = lines.pop(0).items()
+                result = {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}
+                if meta['_id'] in self.busy:
+                    self.busy.remove(meta['_id'])
+                    result.update(status=429, error='rejected')
+                elif meta['_id'] in self.invalid:
+                    result.update(status=400, error='mapper_parsing_exception')
+                elif op == 'delete':
+                    if self.docs.pop(meta['_id'], None) is None:
+                        result.update(status=404)
+                else:
+                    self.docs[meta['_id']] = lines[0]
+                if op != 'delete':
+                    lines.pop(0)
+                items.append({op: result})
+        return {'took': 1, 'errors': any(x[op]['status'] >= 300 for x in items), 'items': items}
+
+
+class TestSearchIndex:
+
+    def test_make_actions(self):
+        actions = list(make_actions([
+            {'_id': 'b1', 'title': 'En'},
+            {'op': 'upsert', 'doc': {'_id': 'b2', 'title': 'To'}},
+            {'op': 'delete', '_id': 'b3'},
+        ], 'catalog'))
+        assert actions == [
+            {'_op_type': 'index', '_index': 'catalog', '_id': 'b1', '_source': {'title': 'En'}},
+            {'_op_type': 'index', '_index': 'catalog', '_id': 'b2', '_source': {'title': 'To'}},
+            {'_op_type': 'delete', '_index': 'catalog', '_id': 'b3'},
+        ]
+
+    def test_index_with_retries_and_errors(self):
+        client = FakeElasticsearch(busy=['b3', 'b12'], invalid=['b7'])
+        docs = [{'_id': 'b%d' % n, 'title': 'Tittel %d' % n} for n in range(25)]
+
+        stats = BulkIndexer(client, 'catalog', chunk_size=10, thread_count=2, initial_backoff=0).index(docs)
+
+        assert stats == {'batches': 3, 'ok': 24, 'failed': 1}
+        assert sorted(client.docs) == sorted('b%d' % n for n in range(25) if n != 7)
+        assert client.docs['b3'] == {'title': 'Tittel 3'}
+        assert client.requests == 5  # 3 batches + 2 retries
+
+    def test_delete(self):
+        client = FakeElasticsearch()
+        client.docs['b1'] = {'title': 'En'}
+
+        stats = BulkIndexer(client, 'catalog', initial_backoff=0).index([
+            {'op': 'delete', '_id': 'b1'},
+            {'op': 'delete', '_id': 'b2'},
+        ])
+
+        assert stats == {'batches': 1, 'ok': 2, 'failed': 0}
+        assert client.docs == {}
+
+    def test_rejected_requests(self):
+        docs = [{'_id': 'b%d' % n, 'title': 'Tittel %d' % n} for n in range(5)]
+
+        # Retried like rejected documents
+        client = FakeElasticsearch(rejected_requests=2)
+        stats = BulkIndexer(client, 'catalog', initial_backoff=0, max_retries=2).index(docs)
+        assert stats == {'batches': 1, 'ok': 5, 'failed': 0}
+        assert len(client.docs) == 5
+        assert client.requests == 3
+
+        # Reported as failed documents after the last retry
+        client = FakeElasticsearch(rejected_requests=10)
+        stats = BulkIndexer(client, 'catalog', initial_backoff=0, max_retries=2).index(docs)
+        assert stats == {'batches': 1, 'ok': 0, 'failed': 5}
+        assert client.docs == {}
+        assert client.requests == 3
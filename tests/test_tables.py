@@ -0,0 +1,62 @@
+from bibbi.constants import TYPE_TOPICAL
+from bibbi.label import LabelFactory
+from bibbi.promus_service import TopicTable, Subdivisions
+from .util import make_dataframe
+
+
+class TestSubdivisions:
+
+    def test_parse_subdivisions(self):
+        table = TopicTable()
+        table.df = make_dataframe(TYPE_TOPICAL, [
+            {'row_id': '1', 'bibsent_id': '11', 'label': 'Filmkunst',
+             'sub_geo': 'USA$zCalifornia', 'sub_topic': 'Fortellinger'},
+            {'row_id': '2', 'bibsent_id': '12', 'label': 'Titanic',
+             'sub_topic': 'Dataspill - Historie', 'sub_topic_nn': 'Dataspel - Historie'},
+            {'row_id': '3', 'bibsent_id': '13', 'label': 'A',
+             'sub_topic': 'B - C', 'sub_topic_nn': 'Bn'},
+            {'row_id': '4', 'bibsent_id': '14', 'label': 'Alger'},
+        ])
+        table.parse_subdivisions()
+
+        assert table.subdivisions['sub_geo'] == {
+            '1': Subdivisions((('USA', 'USA'), ('California', 'California')), False),
+        }
+        assert table.subdivisions['sub_topic'] == {
+            '1': Subdivisions((('Fortellinger', 'Fortellinger'),), False),
+            '2': Subdivisions((('Dataspill', 'Dataspel'), ('Historie', 'Historie')), False),
+            '3': Subdivisions((('B', 'B'), ('C', 'C')), True),
+        }
+
+        rows = {row.row_id: row for row in table.rows()}
+        assert [x.nn for x in rows['2'].get_subdivisions('sub_topic')] == ['Dataspel', 'Historie']
+        assert list(rows['4'].get_subdivisions('sub_topic')) == []
+
+
+class TestLabels:
+
+    def test_entities_use_table_labels(self):
+        table = TopicTable()
+        table.df = make_dataframe(TYPE_TOPICAL, [
+            {'row_id': '1', 'bibsent_id': '11', 'label': 'Filmkunst',
+             'sub_geo': 'USA$zCalifornia', 'sub_topic': 'Fortellinger'},
+            {'row_id': '2', 'bibsent_id': '12', 'label': 'Titanic', 'detail': 'skip', 'detail_nn': 'skip (nn)',
+             'sub_topic': 'Dataspill - Historie', 'sub_topic_nn': 'Dataspel - Historie'},
+            {'row_id': '3', 'bibsent_id': '13', 'label': 'Film', 'ref_id': '1'},
+            {'row_id': '4', 'bibsent_id': '14', 'label': 'Alger'},
+        ])
+        table.parse_subdivisions()
+        table.references.load(table)
+
+        def labels(entities):
+            return [(x.pref_label.nb, x.pref_label.nn, [y.nb for y in x.alt_labels]) for x in entities]
+
+        expected = labels(table.make_entities(LabelFactory()))
+
+        label_factory = LabelFactory()
+        table.make_labels(label_factory)
+        assert len(label_factory._cache) == 4
+        assert labels(table.make_entities(label_factory)) == expected
+        assert len(label_factory._cache) == 4
+        assert expected[0] == ('Filmkunst - USA - California - Fortellinger',
+                               'Filmkunst - USA - California - Fortellinger', ['Film'])
@@ -1,5 +1,7 @@
 from collections import namedtuple
-from typing import Dict, Union
+from typing import Dict, List, Union
+
+import pandas as pd
 
 from bibbi.constants import TYPE_TOPICAL, TYPE_GEOGRAPHIC, TYPE_PERSON, TYPE_CORPORATION
 from bibbi.promus_service import DataRow, TopicTable, GeographicTable, CorporationTable, PersonTable
@@ -23,12 +25,27 @@ def get_table_type(row_type):
     return row_types[row_type]
 
 
-def make_row(row_type: str, params: Dict[str, Union[str, int, None]]) -> DataRow:
+def make_values(row_type: str, params: Dict[str, Union[str, int, None]]) -> Dict[str, Union[str, int, None]]:
     table = get_table_type(row_type)
     keys = list(table.columns.values()) + extra_columns[row_type]
     values = {k: None for k in keys}
     values.update(params)
+    return values
+
+
+def make_row(row_type: str, params: Dict[str, Union[str, int, None]]) -> DataRow:
+    table = get_table_type(row_type)
+    keys = list(table.columns.values()) + extra_columns[row_type]
+    values = make_values(row_type, params)
     print(params)
     RowTuple = namedtuple('Row', keys)
     row_tuple = RowTuple(**values)
     return table.make_row(row_tuple)
+
+
+def make_datarow(row_type: str, **params: Union[str, int, None]) -> DataRow:
+    return make_row(row_type, params)
+
+
+def make_dataframe(row_type: str, rows: List[Dict[str, Union[str, int, None]]]) -> pd.DataFrame:
+    return pd.DataFrame([make_values(row_type, params) for params in rows], dtype=object)